@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Synthetic corpora for benchmarks: a MARCXML file of bib records and a
+directory of EAD finding aids, drawing their headings from a fixed vocabulary
+with a Zipf-like skew (a few headings are very common, most are rare), which
+is roughly what real batches look like and what the caches have to cope with.
+
+Names have commas ("Surname, Forename, 1900-1970"), subjects don't; the stub
+uses that to tell them apart. The same seed always gives the same corpus.
+"""
+from bisect import bisect
+from xml.sax.saxutils import escape, quoteattr
+import os
+import random
+
+from marcio import MRX_HEADER, MRX_FOOTER
+
+EAD_NS = "urn:isbn:1-931666-22-9"
+
+TOPICS = ["Agriculture", "Architecture", "Bridges", "Canals", "Cartography",
+	"Education", "Engineering", "Folk music", "Fortification", "Libraries",
+	"Manuscripts", "Mathematics", "Medicine", "Mining", "Navigation",
+	"Painting", "Printing", "Railroads", "Shipbuilding", "Theater"]
+SUBDIVISIONS = ["History", "Bibliography", "Periodicals", "Sources",
+	"Biography", "Congresses", "Maps", "Pictorial works"]
+SURNAMES = ["Adams", "Baker", "Clark", "Davis", "Evans", "Fischer", "Garcia",
+	"Hughes", "Ito", "Jensen", "Kowalski", "Lopez", "Moreau", "Nakamura",
+	"Olsen", "Petrov", "Quinn", "Rossi", "Schmidt", "Tanaka"]
+FORENAMES = ["Anna", "Bruno", "Clara", "David", "Elena", "Felix", "Greta",
+	"Hugo", "Iris", "Jonas", "Karin", "Leo", "Maria", "Nils", "Olga"]
+
+#===============================================================================
+# Vocabulary
+#===============================================================================
+class Vocabulary(object):
+	"""
+	A fixed set of names and subjects, and a skewed way of drawing from them.
+	"""
+	def __init__(self, distinct=1000, skew=1.0, seed=1):
+		"""
+		@param distinct: how many names, and how many subjects, there are
+		@param skew: the Zipf exponent; 0 draws uniformly
+		@param seed: for the random choices
+		"""
+		self.random = random.Random(seed)
+		self.names = []
+		self.subjects = []
+		for i in xrange(distinct):
+			born = 1800 + (i * 7) % 180
+			self.names.append((u"%s, %s %d," % (SURNAMES[i % len(SURNAMES)], FORENAMES[(i // len(SURNAMES)) % len(FORENAMES)], i),
+				u"%d-%d." % (born, born + 30 + i % 50)))
+			self.subjects.append((u"%s %d" % (TOPICS[i % len(TOPICS)], i), SUBDIVISIONS[i % len(SUBDIVISIONS)] + u"."))
+		weights = [1.0 / (rank ** skew) for rank in xrange(1, distinct + 1)]
+		total = 0.0
+		self._cumulative = []
+		for w in weights:
+			total += w
+			self._cumulative.append(total)
+		self.used = set()
+		"""(kind, index) of every heading drawn so far"""
+
+	def _draw(self):
+		return min(bisect(self._cumulative, self.random.random() * self._cumulative[-1]), len(self._cumulative) - 1)
+
+	def name(self):
+		i = self._draw()
+		self.used.add(("nam", i))
+		return self.names[i]
+
+	def subject(self):
+		i = self._draw()
+		self.used.add(("sub", i))
+		return self.subjects[i]
+
+#===============================================================================
+# marcxml
+#===============================================================================
+def _subfields(pairs):
+	return "".join('<subfield code="%s">%s</subfield>' % (code, escape(value).encode("utf-8")) for code, value in pairs)
+
+def marcxml(path, records=1000, vocabulary=None, subjects_per_record=3):
+	"""
+	@param path: the MARCXML file to write
+	@param records: how many bib records
+	@param vocabulary: a Vocabulary; a default one if None
+	@param subjects_per_record: up to this many 650s per record (at least 1)
+	@return: a dict with the number of records, heading occurrences, and
+	distinct headings and OCLC numbers
+	"""
+	vocab = vocabulary or Vocabulary()
+	occurrences = 0
+	with open(path, "wb") as fh:
+		fh.write(MRX_HEADER)
+		for n in xrange(1, records + 1):
+			fh.write('<record><leader>00000nam a2200000 a 4500</leader>')
+			fh.write('<controlfield tag="001">bench%07d</controlfield>' % n)
+			fh.write('<datafield tag="035" ind1=" " ind2=" ">%s</datafield>' % _subfields([("a", u"(OCoLC)%d" % (100000 + n))]))
+			name, dates = vocab.name()
+			fh.write('<datafield tag="100" ind1="1" ind2=" ">%s</datafield>' % _subfields([("a", name), ("d", dates)]))
+			fh.write('<datafield tag="245" ind1="1" ind2="0">%s</datafield>' % _subfields([("a", u"Benchmark record %d." % n)]))
+			count = 1 + vocab.random.randrange(subjects_per_record)
+			for i in xrange(count):
+				topic, subdivision = vocab.subject()
+				fh.write('<datafield tag="650" ind1=" " ind2="0">%s</datafield>' % _subfields([("a", topic), ("x", subdivision)]))
+			occurrences += 1 + count
+			fh.write('</record>\n')
+		fh.write(MRX_FOOTER)
+	return {"records": records, "occurrences": occurrences, "distinct": len(vocab.used), "ocns": records}
+
+#===============================================================================
+# ead
+#===============================================================================
+def ead(dirpath, documents=20, headings_per_document=50, vocabulary=None):
+	"""
+	@param dirpath: the directory to write the EAD files to (created if need be)
+	@param documents: how many finding aids
+	@param headings_per_document: controlaccess entries per finding aid, about
+	half names and half subjects
+	@param vocabulary: a Vocabulary; a default one if None
+	@return: a dict with the number of documents, heading occurrences and
+	distinct headings
+	"""
+	vocab = vocabulary or Vocabulary()
+	if not os.path.isdir(dirpath):
+		os.makedirs(dirpath)
+	occurrences = 0
+	for n in xrange(1, documents + 1):
+		path = os.path.join(dirpath, "ead%05d.xml" % n)
+		with open(path, "wb") as fh:
+			fh.write('<?xml version="1.0" encoding="UTF-8"?>\n<ead xmlns="%s">' % EAD_NS)
+			fh.write('<eadheader><eadid>bench%05d</eadid></eadheader>' % n)
+			fh.write('<archdesc level="collection"><did><unittitle>Benchmark papers %d</unittitle></did><controlaccess>' % n)
+			for i in xrange(headings_per_document):
+				if i % 2:
+					name, dates = vocab.name()
+					label = (name + u" " + dates).rstrip(u".")
+					fh.write('<persname source="lcnaf">%s</persname>' % escape(label).encode("utf-8"))
+				else:
+					topic, subdivision = vocab.subject()
+					label = (topic + u"--" + subdivision).rstrip(u".")
+					fh.write('<subject source=%s>%s</subject>' % (quoteattr("lcsh"), escape(label).encode("utf-8")))
+				occurrences += 1
+			fh.write('</controlaccess></archdesc></ead>\n')
+	return {"records": documents, "occurrences": occurrences, "distinct": len(vocab.used)}
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Micro-benchmark for normalize.lc_heading: headings/sec over a realistic
+stream of catalog headings (skewed, as in bench/corpus.py, plus real-world
+LC headings that exercise every rule), with the memo empty ("cold") and full
+("warm"), against the unmemoized implementation it replaced ("reference").
+Every heading is also checked to normalize exactly as the reference does.
+
+"single_pass" times the alternative to lc_heading's chain of str.replace
+calls: one re.sub over the heading, with one alternation for every rule. 
+It is what the chain is kept against.
+
+Usage:
+	python bench/normalize.py [--headings N] [--distinct N] [--skew S] [--json]
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from time import time
+import json
+import os
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import corpus
+import normalize
+
+SAMPLES = [
+	"Washington (D.C.)", "Washington (D.C.)--History--Civil War, 1861-1865.",
+	"Smith, J.", "Smith, John,  1900-1980.", "Smith, John, 1900-1980--Correspondence.",
+	"Bach, Johann Sebastian, 1685-1750. Brandenburgische Konzerte.",
+	"Shakespeare, William, 1564-1616 -- Criticism and interpretation.",
+	"United States.--Congress.--House.", "Paris (France) - Description and travel.",
+	"Art, Modern--20th century--Exhibitions.", "Cookery, etc.", "Tools, implements, etc.",
+	"Dogs,--Training.", "Music--(Periodicals)", "Luther, Martin, d. 1546.",
+	"Jones, Mary Harris,   1837-1930.", "Catholic Church.--Pope (1958-1963 : John XXIII)",
+	"Lincoln, Abraham, 1809-1865--Assassination.", "Great Britain.--Army.",
+	"World War, 1939-1945--Campaigns--France.", "Women--Employment--U.S.",
+	"Doe, Jane,", "Poets, American--19th century--Biography.",
+]
+"""Real-world headings, as they come out of MARC subfields, covering each
+rule: whitespace, hyphens, ',--', '--(', ' d. ', '.--', 'etc.' and initials"""
+
+#===============================================================================
+# _reference
+#===============================================================================
+def _reference(heading):
+	"""
+	@note: mrc._normalize_heading as it was before it was memoized, for the
+	comparison and the correctness check.
+	"""
+	collapsed = " ".join(heading.split()).replace(" -", "-").replace("- ", "-").replace(",--",", ").replace("--("," (").replace(' d. ',' -').replace('.--','--')
+	abbrev = re.search("[\.\s][A-Z][a-z]?\.$",collapsed)
+	a = ' '
+	if abbrev is not None:
+		a = abbrev.group(0)
+	if (collapsed.endswith(".") or collapsed.endswith(",")) and not collapsed.endswith("etc.") and not collapsed.endswith(a):
+		stripped = collapsed[:-1]
+	else:
+		stripped = collapsed
+	return stripped
+
+SINGLE_PASS = re.compile(r"[,.]? ?-+ ?\(?| d\. ")
+"""Every stretch of a heading the rules rewrite: a run of hyphens, with the
+spaces around it, a ',' or '.' before and a '(' after; and ' d. '"""
+_rewritten = {}
+
+def _rewrite(m):
+	stretch = m.group(0)
+	out = _rewritten.get(stretch)
+	if out is None:
+		out = _rewritten[stretch] = stretch.replace(" -", "-").replace("- ", "-").replace(",--",", ").replace("--("," (").replace(' d. ',' -').replace('.--','--')
+	return out
+
+def _single_pass(heading):
+	"""
+	@note: normalize.lc_heading, unmemoized, with the str.replace chain done
+	as one re.sub pass.
+	"""
+	collapsed = SINGLE_PASS.sub(_rewrite, " ".join(heading.split()))
+	if collapsed.endswith(",") or (collapsed.endswith(".") and not collapsed.endswith("etc.") and normalize.ABBREVIATION.search(collapsed) is None):
+		return collapsed[:-1]
+	return collapsed
+
+#===============================================================================
+# headings
+#===============================================================================
+def headings(count, distinct, skew, seed=1):
+	"""
+	@return: a list of count raw headings (UTF-8), as mrc._heading_fields
+	gives them: subfields joined with "--"
+	"""
+	vocab = corpus.Vocabulary(distinct, skew, seed)
+	out = []
+	for i in xrange(count):
+		r = vocab.random.random()
+		if r < 0.05:
+			out.append(SAMPLES[vocab.random.randrange(len(SAMPLES))])
+		elif r < 0.4:
+			out.append("--".join(vocab.name()).encode("utf-8"))
+		else:
+			out.append("--".join(vocab.subject()).encode("utf-8"))
+	return out
+
+def _rate(fn, stream):
+	start = time()
+	for h in stream:
+		fn(h)
+	seconds = time() - start
+	return {"seconds": round(seconds, 4), "per_sec": int(len(stream) / seconds) if seconds else None,
+		"usec": round(seconds * 1e6 / len(stream), 3)}
+
+#===============================================================================
+# main
+#===============================================================================
+def main(argv=None):
+	parser = ArgumentParser(description=__doc__.strip().split("\n\n")[0], formatter_class=RawDescriptionHelpFormatter)
+	parser.add_argument("--headings", type=int, default=500000, help="Heading occurrences to normalize.")
+	parser.add_argument("--distinct", type=int, default=5000, help="Distinct names, and distinct subjects.")
+	parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent for drawing headings.")
+	parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+	args = parser.parse_args(argv)
+
+	stream = headings(args.headings, args.distinct, args.skew)
+	wrong = [h for h in set(stream) if normalize.lc_heading(h) != _reference(h)]
+	results = {"headings": len(stream), "distinct": len(set(stream)), "mismatches": len(wrong)}
+	results["reference"] = _rate(_reference, stream)
+	results["single_pass"] = _rate(_single_pass, stream)
+	results["single_pass"]["mismatches"] = len([h for h in set(stream) if _single_pass(h) != _reference(h)])
+	normalize._memo.clear()
+	results["cold"] = _rate(normalize.lc_heading, stream)
+	results["warm"] = _rate(normalize.lc_heading, stream)
+
+	if args.json:
+		sys.stdout.write(json.dumps(results, sort_keys=True) + "\n")
+	else:
+		sys.stdout.write("%(headings)d headings, %(distinct)d distinct, %(mismatches)d mismatches\n" % results)
+		for name in ("reference", "single_pass", "cold", "warm"):
+			r = results[name]
+			sys.stdout.write("%-12s %10d headings/sec  %7.3f usec/heading\n" % (name, r["per_sec"] or 0, r["usec"]))
+		for h in wrong[:10]:
+			sys.stdout.write("MISMATCH %r: %r != %r\n" % (h, normalize.lc_heading(h), _reference(h)))
+	return 1 if wrong else 0
+
+if __name__ == "__main__": sys.exit(main())
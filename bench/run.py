@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Benchmarks mrc.py, ead.py and owi.py end to end against the local stub (see
+stub.py), so that throughput can be measured, and compared between changes,
+without touching id.loc.gov, VIAF or xID.
+
+Each tool runs twice over the same synthetic corpus in a scratch directory:
+once with an empty cache ("cold") and once more with the cache the first run
+left ("warm"). For each run we report records/sec, headings/sec, the cache
+hit ratio (distinct headings not sent to the stub) and peak RSS.
+
+Usage:
+	python bench/run.py [--records N] [--distinct N] [--latency S] ...
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from time import time
+import json
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import corpus
+import ratelimit
+import stub
+
+HOSTS = ("id.loc.gov", "viaf.org", "xisbn.worldcat.org")
+
+CONFIG = """[Paths]
+outpath : %(workdir)s/out/r_out.xml
+lcindex : %(workdir)s/db/no-index.sqlite
+
+[Booleans]
+recursive : False
+names : True
+subjects : True
+annotate : False
+verbose : False
+ignore_cache : False
+log : False
+
+[RateLimits]
+id.loc.gov : %(rate)s, %(burst)s
+viaf.org : %(rate)s, %(burst)s
+xisbn.worldcat.org : %(rate)s, %(burst)s
+
+[Resolver]
+workers : %(workers)s
+"""
+
+#===============================================================================
+# _run
+#===============================================================================
+def _run(workdir, script, argv, proxy, rate, burst):
+	"""
+	Runs one of the scripts as __main__ in a child process, in workdir, with
+	its HTTP going through the stub.
+
+	@return: a 3-tuple (exit status, seconds, peak RSS in KB)
+	"""
+	start = time()
+	pid = os.fork()
+	if pid == 0:
+		status = 0
+		try:
+			os.chdir(workdir)
+			os.environ["http_proxy"] = proxy
+			os.environ.pop("no_proxy", None)
+			os.environ.pop("NO_PROXY", None)
+			log = os.open(os.path.join(workdir, "log", os.path.basename(script) + ".out"), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+			os.dup2(log, 1)
+			os.dup2(log, 2)
+			for host in HOSTS:
+				ratelimit.configure(host, rate, burst)
+			sys.argv = [script] + argv
+			runpy.run_path(os.path.join(ROOT, script), run_name="__main__")
+		except SystemExit, e:
+			status = e.code or 0
+		except BaseException:
+			import traceback
+			traceback.print_exc()
+			status = 1
+		finally:
+			sys.stdout.flush()
+			sys.stderr.flush()
+			os._exit(status if isinstance(status, int) else 1)
+	pid, status, usage = os.wait4(pid, 0)
+	return os.WEXITSTATUS(status), time() - start, usage.ru_maxrss
+
+#===============================================================================
+# Bench
+#===============================================================================
+class Bench(object):
+	def __init__(self, server, workdir, rate, burst, workers):
+		self.server = server
+		self.workdir = workdir
+		self.rate = rate
+		self.burst = burst
+		self.workers = workers
+		for d in ("cfg", "db", "in", "log", "out", "reports"):
+			os.mkdir(os.path.join(workdir, d))
+		self.config = os.path.join(workdir, "cfg", "bench.cfg")
+		with open(self.config, "wb") as fh:
+			fh.write(CONFIG % {"workdir": workdir, "rate": rate, "burst": burst, "workers": workers})
+
+	def measure(self, tool, label, script, argv, stats):
+		"""
+		@param stats: what the corpus generator returned
+		@return: a dict of results
+		"""
+		self.server.reset()
+		status, seconds, rss = _run(self.workdir, script, argv, self.server.proxy, self.rate, self.burst)
+		counts = self.server.counts
+		lookups = sum(counts.get((host, "lookups"), 0) for host in HOSTS)
+		distinct = stats.get("distinct") or stats.get("ocns") or 0
+		return {
+			"tool": tool,
+			"run": label,
+			"status": status,
+			"seconds": round(seconds, 3),
+			"records_per_sec": round(stats["records"] / seconds, 2),
+			"headings_per_sec": round(stats.get("occurrences", stats.get("ocns", 0)) / seconds, 2),
+			"cache_hit_ratio": round(max(0.0, 1.0 - float(lookups) / distinct), 4) if distinct else None,
+			"lookups": lookups,
+			"requests": sum(counts.get((host, "requests"), 0) for host in HOSTS),
+			"errors": sum(counts.get((host, "errors"), 0) for host in HOSTS),
+			"peak_rss_kb": rss,
+		}
+
+	def mrc(self, path, stats):
+		out = os.path.join(self.workdir, "out", "mrc_out.xml")
+		argv = ["-c", self.config, "-m", "-n", "-s", "-w", str(self.workers), "-f", path, "-o", out]
+		return [self.measure("mrc", run, "mrc.py", argv, stats) for run in ("cold", "warm")]
+
+	def ead(self, dirpath, stats, jobs):
+		argv = ["-c", self.config, "-n", "-s", "-w", str(self.workers), "-j", str(jobs), dirpath]
+		return [self.measure("ead", run, "ead.py", argv, stats) for run in ("cold", "warm")]
+
+	def owi(self, path, stats):
+		out = os.path.join(self.workdir, "out", "owi_out.xml")
+		return [self.measure("owi", run, "owi.py", [path, out], stats) for run in ("cold", "warm")]
+
+#===============================================================================
+# main
+#===============================================================================
+def main(argv=None):
+	parser = ArgumentParser(description=__doc__.strip().split("\n\n")[0], formatter_class=RawDescriptionHelpFormatter)
+	parser.add_argument("--tools", default="mrc,ead,owi", help="Comma-separated: any of mrc, ead, owi.")
+	parser.add_argument("--records", type=int, default=500, help="MARC records in the corpus.")
+	parser.add_argument("--documents", type=int, default=20, help="EAD files in the corpus.")
+	parser.add_argument("--headings", type=int, default=50, help="Headings per EAD file.")
+	parser.add_argument("--distinct", type=int, default=300, help="Size of the heading vocabulary.")
+	parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent for drawing headings (0 = uniform).")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--latency", type=float, default=0.02, help="Mean stub latency, in seconds.")
+	parser.add_argument("--error-rate", type=float, default=0.0, dest="error_rate", help="Fraction of stub responses that are 503s.")
+	parser.add_argument("--quota", type=int, default=1000, help="xID requests before 'overlimit'.")
+	parser.add_argument("--rate", type=float, default=100.0, help="Requests per second allowed to each host.")
+	parser.add_argument("--burst", type=int, default=10)
+	parser.add_argument("--workers", type=int, default=4, help="Resolver threads.")
+	parser.add_argument("--jobs", type=int, default=2, help="ead.py batch processes.")
+	parser.add_argument("--keep", action="store_true", help="Keep the scratch directory (its path is printed).")
+	parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+	args = parser.parse_args(argv)
+	tools = [t.strip() for t in args.tools.split(",") if t.strip()]
+
+	workdir = tempfile.mkdtemp(prefix="addauths-bench-")
+	behaviour = stub.Behaviour(latency=args.latency, error_rate=args.error_rate, quota=args.quota)
+	server = stub.StubServer(behaviour).start()
+	results = []
+	try:
+		bench = Bench(server, workdir, args.rate, args.burst, args.workers)
+		if "mrc" in tools or "owi" in tools:
+			path = os.path.join(workdir, "in", "bench.xml")
+			stats = corpus.marcxml(path, args.records, corpus.Vocabulary(args.distinct, args.skew, args.seed))
+			if "mrc" in tools: results += bench.mrc(path, stats)
+			if "owi" in tools: results += bench.owi(path, {"records": stats["records"], "ocns": stats["ocns"]})
+		if "ead" in tools:
+			dirpath = os.path.join(workdir, "in", "ead")
+			stats = corpus.ead(dirpath, args.documents, args.headings, corpus.Vocabulary(args.distinct, args.skew, args.seed))
+			results += bench.ead(dirpath, stats, args.jobs)
+	finally:
+		server.stop()
+		if args.keep: sys.stderr.write("Scratch directory: " + workdir + "\n")
+		else: shutil.rmtree(workdir, ignore_errors=True)
+
+	if args.json:
+		sys.stdout.write(json.dumps(results, indent=2) + "\n")
+	else:
+		columns = ("tool", "run", "status", "seconds", "records_per_sec", "headings_per_sec", "cache_hit_ratio", "lookups", "errors", "peak_rss_kb")
+		sys.stdout.write("\t".join(columns) + "\n")
+		for r in results:
+			sys.stdout.write("\t".join(str(r[c]) for c in columns) + "\n")
+	return 0 if all(r["status"] == 0 for r in results) else 1
+
+if __name__ == "__main__": sys.exit(main())
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+A local stand-in for id.loc.gov, VIAF and xID, for benchmarks. It runs as an
+HTTP proxy: point http_proxy at it and the scripts' requests for
+http://id.loc.gov/..., http://viaf.org/... and http://xisbn.worldcat.org/...
+land here without any change to their URLs.
+
+It reproduces just what the scripts depend on:
+ * id.loc.gov known-label service: a 302 to the authority, which answers 200
+   with x-uri and x-preflabel headers (no x-preflabel, and a "Use Instead"
+   HTML page, for deprecated headings), or a 404
+ * VIAF search: RSS with opensearch:totalResults and title/link items
+ * xID getMetadata: XML with an @owi, or stat="overlimit" past the quota
+
+Whether a label is found, missing, deprecated or ambiguous is a function of
+the label alone, so repeated runs see the same answers. Latency and the rate
+of 503 errors are configurable.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urllib import quote, unquote_plus
+from urlparse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+import random
+import re
+import threading
+import time
+import zlib
+
+#===============================================================================
+# Behaviour
+#===============================================================================
+class Behaviour(object):
+	def __init__(self, latency=0.05, jitter=0.5, error_rate=0.0, retry_after=0,
+		not_found=10, deprecated=2, multiple=5, quota=1000):
+		self.latency = latency
+		"""Mean seconds added to every response"""
+		self.jitter = jitter
+		"""Latency varies by up to this fraction either way"""
+		self.error_rate = error_rate
+		"""Fraction of requests answered with a 503"""
+		self.retry_after = retry_after
+		"""Retry-After sent with the 503s (seconds), or None for none"""
+		self.not_found = not_found
+		"""Percent of labels that aren't found"""
+		self.deprecated = deprecated
+		"""Percent of labels that are deprecated (id.loc.gov)"""
+		self.multiple = multiple
+		"""Percent of names with several VIAF hits"""
+		self.quota = quota
+		"""xID requests allowed before 'overlimit'"""
+
+	def outcome(self, label):
+		"""
+		@return: 'notfound', 'deprecated', 'multiple' or 'found', fixed for
+		any given label
+		"""
+		bucket = zlib.crc32(label.encode("utf-8") if isinstance(label, unicode) else label) % 100
+		if bucket < self.not_found: return "notfound"
+		bucket -= self.not_found
+		if bucket < self.deprecated: return "deprecated"
+		bucket -= self.deprecated
+		if bucket < self.multiple: return "multiple"
+		return "found"
+
+def _id(label):
+	return "%08d" % (zlib.crc32(label) & 0x7fffffff)
+
+#===============================================================================
+# Handler
+#===============================================================================
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	wbufsize = -1
+	"""Buffer each response and send it in one go (flushed per request), so
+	that headers and body don't wait on each other's ACKs"""
+
+	def log_message(self, *args):
+		pass
+
+	def _send(self, status, body="", headers=None, content_type="application/xml"):
+		self.send_response(status)
+		for k, v in (headers or {}).items():
+			self.send_header(k, v)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		server = self.server
+		url = urlparse(self.path)
+		host = url.netloc or self.headers.get("Host", "")
+		host = host.split(":")[0]
+		path = url.path
+		b = server.behaviour
+		if b.latency:
+			time.sleep(max(0.0, b.latency * (1 + random.uniform(-b.jitter, b.jitter))))
+		server.count(host, "requests")
+		if b.error_rate and random.random() < b.error_rate:
+			server.count(host, "errors")
+			headers = {}
+			if b.retry_after is not None: headers["Retry-After"] = str(b.retry_after)
+			return self._send(503, "Service Unavailable", headers, "text/plain")
+		if host == "id.loc.gov": return self._lc(path)
+		if host == "viaf.org": return self._viaf(parse_qs(url.query))
+		if host == "xisbn.worldcat.org": return self._xid(path)
+		self._send(404, "Unknown host " + host, content_type="text/plain")
+
+	def _lc(self, path):
+		m = re.match(r"^/(?:authorities|vocabulary/subject)/label/(.*)$", path)
+		if m:
+			self.server.count("id.loc.gov", "lookups")
+			label = unquote_plus(m.group(1))
+			outcome = self.server.behaviour.outcome(label)
+			if outcome == "notfound":
+				return self._send(404, "Not Found", content_type="text/plain")
+			scheme = "names" if "," in label else "subjects"
+			prefix = "d" if outcome == "deprecated" else ""
+			location = "http://id.loc.gov/authorities/%s/%s%s" % (scheme, prefix, _id(label))
+			self.server.labels[location] = label
+			return self._send(302, "", {"Location": location}, "text/plain")
+		uri = "http://id.loc.gov" + path
+		label = self.server.labels.get(uri)
+		if label is None:
+			return self._send(404, "Not Found", content_type="text/plain")
+		if "/d" in path:
+			instead = label + " (new)"
+			body = "<html><body><h1>%s</h1><h3>Use Instead</h3><ul><li><div><a href=\"%s\">%s</a></div></li></ul></body></html>" % (
+				escape(label), "/authorities/subjects/" + _id(instead), escape(instead))
+			return self._send(200, body, {"x-uri": uri}, "text/html")
+		return self._send(200, "<rdf:RDF/>", {"x-uri": uri, "x-preflabel": quote(label, " ,-()'")})
+
+	def _viaf(self, params):
+		self.server.count("viaf.org", "lookups")
+		query = (params.get("query") or [""])[0]
+		m = re.search(r'"([^"]*)"', query)
+		name = m and m.group(1) or ""
+		outcome = self.server.behaviour.outcome(name)
+		if outcome == "notfound": items = []
+		elif outcome == "multiple": items = [name + " (%d)" % i for i in range(3)]
+		else: items = [name]
+		body = '<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/"><channel>'
+		body += "<opensearch:totalResults>%d</opensearch:totalResults>" % len(items)
+		for title in items:
+			body += "<item><title>%s</title><link>http://viaf.org/viaf/%s</link></item>" % (escape(title), _id(title))
+		body += "</channel></rss>"
+		self._send(200, body, content_type="application/rss+xml")
+
+	def _xid(self, path):
+		ocn = path.rstrip("/").split("/")[-1]
+		used = self.server.count("xisbn.worldcat.org", "lookups")
+		if used > self.server.behaviour.quota:
+			return self._send(200, '<?xml version="1.0"?><rsp xmlns="http://worldcat.org/xid/oclcnum/" stat="overlimit"/>')
+		if self.server.behaviour.outcome(ocn) == "notfound":
+			return self._send(200, '<?xml version="1.0"?><rsp xmlns="http://worldcat.org/xid/oclcnum/" stat="invalidId"/>')
+		body = '<?xml version="1.0"?><rsp xmlns="http://worldcat.org/xid/oclcnum/" stat="ok"><oclcnum owi="owi%s">%s</oclcnum></rsp>' % (_id(ocn), escape(ocn))
+		self._send(200, body)
+
+#===============================================================================
+# StubServer
+#===============================================================================
+class StubServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, behaviour=None, port=0):
+		"""
+		@param behaviour: a Behaviour; defaults are used if None
+		@param port: 0 to pick a free one (see self.port)
+		"""
+		HTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+		self.behaviour = behaviour or Behaviour()
+		self.labels = {}
+		self.counts = {}
+		self._lock = threading.Lock()
+		self._thread = None
+
+	@property
+	def port(self):
+		return self.server_address[1]
+
+	@property
+	def proxy(self):
+		"""
+		@return: the value for http_proxy
+		"""
+		return "http://127.0.0.1:%d" % self.port
+
+	def count(self, host, what):
+		with self._lock:
+			key = (host, what)
+			self.counts[key] = self.counts.get(key, 0) + 1
+			return self.counts[key]
+
+	def reset(self):
+		with self._lock:
+			self.counts = {}
+
+	def start(self):
+		self._thread = threading.Thread(target=self.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+if __name__ == "__main__":
+	from argparse import ArgumentParser
+	parser = ArgumentParser(description="Run the stub in the foreground (use it as http_proxy).")
+	parser.add_argument("-p", "--port", type=int, default=8099)
+	parser.add_argument("--latency", type=float, default=0.05)
+	parser.add_argument("--error-rate", type=float, default=0.0, dest="error_rate")
+	args = parser.parse_args()
+	server = StubServer(Behaviour(latency=args.latency, error_rate=args.error_rate), args.port)
+	print("http_proxy=%s" % server.proxy)
+	server.serve_forever()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Bulk heading resolution as a library, for ETL that has headings rather than
+files: no argv, no directories, no exit(). resolve_many() takes any iterable
+of headings as they come in the data, normalizes them as mrc.py (or ead.py,
+for VIAF) does, resolves each distinct one that isn't cached once, through
+the shared cache, the local index and the network, and streams back one
+Result per heading, in order.
+
+	import bulk
+	for result in bulk.resolve_many(["Cats.", "Smith, John, 1900-1980."]):
+		print result.heading, result.status, result.uri
+
+The input is taken a batch at a time (batch_size), so a generator of
+millions of headings is never held in memory at once.
+"""
+from itertools import islice
+import cache
+import metrics
+import mrc
+import normalize
+import resolver
+
+BATCH_SIZE = 10000
+"""Headings taken from the input, and resolved together, at a time"""
+
+FOUND = "found"
+NOT_FOUND = "not_found"
+DEPRECATED = "deprecated"
+MULTIPLE = "multiple"
+ERROR = "error"
+"""The lookup failed (e.g. the service was down); nothing was cached"""
+
+SOURCES = {
+	cache.LC: mrc.ID_SUBJECT_RESOLVER,
+	cache.VIAF_PERSONAL: "viaf.org",
+	cache.VIAF_CORPORATE: "viaf.org"
+}
+"""The vocabularies resolve_many knows, and the source recorded for what is
+looked up in each"""
+
+#===============================================================================
+# Result
+#===============================================================================
+class Result(object):
+	def __init__(self, heading, normalized, vocabulary, status, uri=None, label=None, alternatives=(), error=None):
+		self.heading = heading
+		"""The heading as given"""
+		self.normalized = normalized
+		"""The heading as normalized, and cached"""
+		self.vocabulary = vocabulary
+		self.status = status
+		"""FOUND, NOT_FOUND, DEPRECATED, MULTIPLE or ERROR"""
+		self.uri = uri
+		"""The URI when FOUND, else None"""
+		self.label = label
+		"""The authorized label when FOUND, else None"""
+		self.alternatives = list(alternatives)
+		"""(uri, label) 2-tuples: the match, the candidates when MULTIPLE, or
+		what to use instead when DEPRECATED (if known)"""
+		self.error = error
+		"""What went wrong, when ERROR"""
+
+	def as_dict(self):
+		"""
+		@return: a dict (JSON-ready) of the result
+		"""
+		d = dict(self.__dict__)
+		d["alternatives"] = [list(a) for a in self.alternatives]
+		if self.error is None:
+			del d["error"]
+		return d
+
+	def __repr__(self):
+		return "<Result %s %r %s>" % (self.status, self.normalized, self.uri or "")
+
+#===============================================================================
+# status
+#===============================================================================
+def status(record):
+	"""
+	@param record: a cached Heading
+	@return: FOUND, MULTIPLE, DEPRECATED or NOT_FOUND, as mrc.py and ead.py
+	would count it
+	"""
+	if record.found == True and len(record.alternatives) == 1:
+		return FOUND
+	if len(record.alternatives) > 1:
+		return MULTIPLE
+	if record.value.startswith(cache.DEPRECATED):
+		return DEPRECATED
+	return NOT_FOUND
+
+def _lookups(vocabulary):
+	"""
+	@return: a 2-tuple (normalize, fetch) for the vocabulary, where fetch
+	takes a normalized heading and an lcindex.LocalIndex (or None)
+	"""
+	if vocabulary == cache.LC:
+		return normalize.lc_heading, mrc._fetch_heading
+	if vocabulary not in SOURCES:
+		raise ValueError("Unknown vocabulary: %s" % vocabulary)
+	import ead # (and libxml2) only for VIAF
+	heading_type = ead.Heading.PERSONAL
+	if vocabulary == cache.VIAF_CORPORATE:
+		heading_type = ead.Heading.CORPORATE
+	return ead._normalize_heading, lambda heading, index: ead._fetch_heading(heading, heading_type)
+
+#===============================================================================
+# look_up
+#===============================================================================
+def look_up(misses, fetch, shelf, workers=resolver.WORKERS, flight=None):
+	"""
+	@param misses: (heading, vocabulary) keys that aren't in the cache
+	@param fetch: takes a key and returns a Heading; called from worker
+	threads
+	@param shelf: the cache, where the results go
+	@param flight: a resolver.SingleFlight shared with other threads
+	resolving at the same time, if any
+	@return: a dict of key -> error message, for the lookups that failed
+
+	@note: Keys another thread is already looking up (through the same
+	flight) are waited for rather than looked up twice; their results are
+	then in the cache.
+	"""
+	theirs = []
+	if flight is not None:
+		misses, theirs = flight.claim(misses)
+		metrics.incr("lookup.shared", len(theirs))
+	errors = {}
+	try:
+		for key, record, error in resolver.resolve(misses, fetch, workers):
+			if error is not None:
+				metrics.incr("lookup.error")
+				errors[key] = str(error).strip() or error.__class__.__name__
+				continue
+			shelf[key] = record
+	finally:
+		if flight is not None:
+			flight.release(misses)
+	for event in theirs:
+		event.wait()
+	return errors
+
+#===============================================================================
+# resolve_many
+#===============================================================================
+def resolve_many(headings, vocab=cache.LC, shelf=None, workers=resolver.WORKERS, index=None, ignore_cache=False, batch_size=BATCH_SIZE, flight=None):
+	"""
+	@param headings: an iterable of headings as they come in the data (not
+	normalized); str (UTF-8) or unicode
+	@param vocab: cache.LC, cache.VIAF_PERSONAL or cache.VIAF_CORPORATE
+	@param shelf: the cache; the shared one (cache.CACHE_FILE) is opened,
+	and closed when done, if None
+	@param workers: worker threads for the lookups
+	@param index: an lcindex.LocalIndex to try before id.loc.gov
+	@param ignore_cache: look every heading up again
+	@param batch_size: headings resolved together
+	@param flight: a resolver.SingleFlight, when other threads resolve into
+	the same cache at the same time
+	@return: a generator of Results, one per heading, in the order given
+
+	@raise ValueError: for a vocabulary we don't know
+
+	@note: Each distinct heading in a batch is looked up at most once, and
+	what is looked up is cached, found or not, as by mrc.py and ead.py.
+	"""
+	normalize, fetch = _lookups(vocab)
+	opened = shelf is None
+	if opened:
+		shelf = cache.open_cache(cache.CACHE_FILE, source=SOURCES[vocab], vocabulary=cache.LC)
+	try:
+		headings = iter(headings)
+		while True:
+			batch = [h.encode("utf-8") if isinstance(h, unicode) else h for h in islice(headings, batch_size)]
+			if not batch:
+				break
+			with metrics.timer("normalize"):
+				keys = [(normalize(h), vocab) for h in batch]
+			distinct = set(keys)
+			misses = [k for k in distinct if ignore_cache or k not in shelf]
+			metrics.incr("prefetch.distinct", len(distinct))
+			metrics.incr("prefetch.miss", len(misses))
+			metrics.incr("cache.hit", len(distinct) - len(misses))
+			metrics.incr("cache.miss", len(misses))
+			with metrics.timer("prefetch"):
+				errors = look_up(misses, lambda key: fetch(key[0], index), shelf, workers, flight)
+			for heading, key in zip(batch, keys):
+				record = None if key in errors else shelf.get(key)
+				if record is None:
+					yield Result(heading, key[0], vocab, ERROR, error=errors.get(key, "Not resolved"))
+					continue
+				outcome = status(record)
+				metrics.incr("heading." + outcome)
+				uri = label = None
+				if outcome == FOUND:
+					uri, label = record.alternatives[0]
+				yield Result(heading, key[0], vocab, outcome, uri, label, [a for a in record.alternatives if a])
+	finally:
+		if opened:
+			shelf.close()
@@ -0,0 +1,1020 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+SQLite-backed authority cache for Heading records, in place of the old shelve
+caches. One file (db/cache.sqlite) is shared by mrc.py, ead.py and owi.py, so
+a heading resolved by one is a hit for the others: one row per normalized 
+heading and vocabulary (LC, LCSH, VIAF personal or corporate names, OCLC 
+work ids) with typed columns. WAL mode, so readers never block (and aren't blocked by) 
+a writer, whichever process they are in; writes are buffered and committed 
+in batches, each in one short transaction.
+
+Keys are (heading, vocabulary) 2-tuples; a plain heading means the 
+vocabulary the cache was opened with.
+
+Entries expire: found, not-found and deprecated headings each have their own
+TTL (see the [Cache] section of the config file). An expired heading is
+treated as not cached, so it's looked up again the next time it comes up;
+stale() lists them all for a refresh.
+
+open_cache() puts a FrontCache in front of the SQLite file: a bounded,
+in-memory LRU of the headings used in this run, so the hot ones (the same
+few subjects over and over) are read from disk once, and a write-behind
+buffer that hands new lookups to the store in batches.
+
+Maintenance: stats (entries by vocabulary and outcome, age, how much of the
+file is free pages), vacuum, export and import (TSV or JSON lines), prune
+and migrate. Each works through SQL aggregates or streams rows off a 
+cursor, so none of them loads the cache into memory.
+
+Usage:
+	python cache.py stats [--json]
+	python cache.py vacuum
+	python cache.py export [-f tsv|jsonl] [-o FILE] [--vocabulary V]
+	python cache.py import [-f tsv|jsonl] FILE
+	python cache.py prune --older-than DAYS [--vocabulary V]
+	python cache.py migrate OLD_CACHE [CACHE_FILE]
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import OrderedDict
+from time import time
+import ConfigParser
+import json
+import metrics
+import os
+import pickle
+import re
+import shelve
+import sqlite3
+import sys
+import threading
+import whichdb
+
+CACHE_FILE = "./db/cache.sqlite"
+BATCH_SIZE = 500
+"""Number of writes buffered before they are committed"""
+TIMEOUT = 30.0
+"""Seconds to wait on a lock held by another process before giving up"""
+FRONT_SIZE = 20000
+"""Headings kept in memory by the FrontCache; 0 for none"""
+WRITE_BEHIND = BATCH_SIZE
+"""New records the FrontCache holds before handing them to the store"""
+
+DAY = 86400.0
+TTL_FOUND = 180 * DAY
+"""Seconds before a heading that was found is looked up again"""
+TTL_NOT_FOUND = 7 * DAY
+"""Seconds before a heading that wasn't found is tried again; LC adds new
+authorities every day"""
+TTL_DEPRECATED = 30 * DAY
+"""Seconds before a deprecated heading is looked up again"""
+
+DEPRECATED = "(DEPRECATED) "
+"""How the scripts mark the value of a deprecated heading"""
+
+LC = "lc"
+"""Names and subjects looked up by label in all of id.loc.gov's authorities 
+(or in lcindex), by mrc.py"""
+LCSH = "lcsh"
+"""Subjects looked up by label in id.loc.gov's subject headings alone, by 
+ead.py; kept apart from LC since the same label can resolve differently"""
+VIAF_PERSONAL = "viaf-personal"
+VIAF_CORPORATE = "viaf-corporate"
+OWI = "owi"
+"""OCLC numbers -> OCLC Work Ids, from xID"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS authorities (
+	heading TEXT NOT NULL,
+	vocabulary TEXT NOT NULL,
+	value TEXT NOT NULL,
+	type TEXT NOT NULL DEFAULT '',
+	found INTEGER NOT NULL DEFAULT 0,
+	alternatives TEXT NOT NULL DEFAULT '[]',
+	fetched_at REAL NOT NULL,
+	source TEXT NOT NULL DEFAULT '',
+	PRIMARY KEY (heading, vocabulary)
+);
+CREATE INDEX IF NOT EXISTS authorities_fetched_at ON authorities (fetched_at);
+CREATE TABLE IF NOT EXISTS migrated (
+	path TEXT PRIMARY KEY,
+	migrated_at REAL NOT NULL
+);
+"""
+
+COLUMNS = "heading, vocabulary, value, type, found, alternatives, fetched_at, source"
+
+OLD_COLUMNS = "heading, value, type, found, alternatives, fetched_at, source"
+"""The single-vocabulary 'headings' table the cache files used to have"""
+
+STATUS_SQL = """CASE 
+	WHEN found = 1 AND json_array_length(alternatives) = 1 THEN 'found'
+	WHEN json_array_length(alternatives) > 1 THEN 'multiple'
+	WHEN substr(value, 1, 13) = '(DEPRECATED) ' THEN 'deprecated'
+	ELSE 'not_found' END"""
+"""A row's outcome, as the scripts count it: found, multiple, deprecated or
+not_found"""
+
+EXPIRED_SQL = """fetched_at + CASE 
+	WHEN substr(value, 1, 13) = '(DEPRECATED) ' THEN ?
+	WHEN found = 1 THEN ? 
+	ELSE ? END < ?"""
+"""_expired, in SQL; takes the three TTLs and the time now"""
+
+VOCABULARY_SQL = """CASE 
+	WHEN source = 'id.loc.gov' OR type = 'subject' THEN 'lc'
+	WHEN type = 'corporate' THEN 'viaf-corporate'
+	WHEN type = 'personal' OR source = 'viaf.org' THEN 'viaf-personal'
+	ELSE ? END"""
+"""vocabulary_for, for rows copied from an old 'headings' table"""
+
+#===============================================================================
+# Heading
+#===============================================================================
+class Heading(object):
+	def __init__(self):
+		self.value = ""
+		"""Heading label (string) normalized from the source data"""
+		self.type = ""
+		"""'corporate', 'personal', or 'subject'"""
+		self.found = ""
+		"""boolean, True if one or more URIs was found"""
+		self.alternatives = ""
+		""""A list of 2-tuple (uri, label) possibilities"""
+		self.fetched_at = None
+		"""When the heading was looked up (seconds since the epoch)"""
+		self.source = ""
+		"""The service the heading was looked up in, e.g. 'id.loc.gov'"""
+
+#===============================================================================
+# AuthorityCache
+#===============================================================================
+class AuthorityCache(object):
+	"""
+	A dict-like ((heading, vocabulary) -> Heading) cache that can stand in 
+	for the shelf. Any number of processes can have the same file open.
+	"""
+	def __init__(self, path=CACHE_FILE, source="", vocabulary=LC, batch_size=BATCH_SIZE):
+		"""
+		@param path: the SQLite file; created if it doesn't exist
+		@param source: the source recorded for records that don't name one
+		@param vocabulary: the vocabulary of keys given as a plain heading
+		@param batch_size: writes to buffer before committing
+		"""
+		self.path = path
+		self.source = source
+		self.vocabulary = vocabulary
+		self.batch_size = batch_size
+		self._pending = {}
+		cachedir = os.path.dirname(path)
+		if cachedir and not os.path.isdir(cachedir):
+			os.makedirs(cachedir)
+		self.conn = sqlite3.connect(path, timeout=TIMEOUT, check_same_thread=False)
+		self.conn.text_factory = str
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("PRAGMA synchronous=NORMAL")
+		self.conn.executescript(SCHEMA)
+		self.conn.commit()
+		self._upgrade()
+
+	def _upgrade(self):
+		"""
+		@note: Moves the rows of an old single-vocabulary 'headings' table 
+		into 'authorities'. Done in an IMMEDIATE transaction, so of several 
+		processes opening the file at once only one does it.
+		"""
+		if not self._has_table("headings"):
+			return
+		self.conn.isolation_level = None
+		try:
+			self.conn.execute("BEGIN IMMEDIATE")
+			try:
+				if self._has_table("headings"):
+					self.conn.execute("INSERT OR IGNORE INTO authorities (" + COLUMNS + ") SELECT heading, " + VOCABULARY_SQL + ", value, type, found, alternatives, fetched_at, source FROM headings", (self.vocabulary or LC,))
+					self.conn.execute("DROP TABLE headings")
+				self.conn.execute("COMMIT")
+			except:
+				self.conn.execute("ROLLBACK")
+				raise
+		finally:
+			self.conn.isolation_level = ""
+
+	def _has_table(self, name, schema="main"):
+		sql = "SELECT 1 FROM " + schema + ".sqlite_master WHERE type = 'table' AND name = ?"
+		return self.conn.execute(sql, (name,)).fetchone() is not None
+
+	def key(self, key):
+		"""
+		@param key: a heading, or a (heading, vocabulary) 2-tuple
+		@return: the (heading, vocabulary) 2-tuple
+		"""
+		if isinstance(key, tuple): return key
+		return (key, self.vocabulary)
+
+	def _row(self, key):
+		start = time()
+		row = self.conn.execute("SELECT " + COLUMNS + " FROM authorities WHERE heading = ? AND vocabulary = ?", key).fetchone()
+		metrics.add_time("cache", time() - start)
+		return row
+
+	def __contains__(self, key):
+		"""
+		@note: False for an expired heading, though self[key] still has it.
+		"""
+		key = self.key(key)
+		if key in self._pending:
+			return True
+		row = self._row(key)
+		if row is None:
+			return False
+		if _expired(row[2], row[4], row[6], time()):
+			metrics.incr("cache.stale")
+			return False
+		return True
+
+	def __getitem__(self, key):
+		key = self.key(key)
+		if key in self._pending:
+			return self._pending[key]
+		row = self._row(key)
+		if row is None:
+			raise KeyError(key)
+		return _from_row(row)
+
+	def get(self, heading, default=None):
+		try:
+			return self[heading]
+		except KeyError:
+			return default
+
+	def __setitem__(self, key, record):
+		self._pending[self.key(key)] = record
+		if len(self._pending) >= self.batch_size:
+			self.flush()
+
+	def __delitem__(self, key):
+		key = self.key(key)
+		self._pending.pop(key, None)
+		with self.conn:
+			self.conn.execute("DELETE FROM authorities WHERE heading = ? AND vocabulary = ?", key)
+
+	def __len__(self):
+		self.flush()
+		return self.conn.execute("SELECT COUNT(*) FROM authorities").fetchone()[0]
+
+	def __iter__(self):
+		"""
+		@note: Streams the (heading, vocabulary) keys off a cursor rather 
+		than loading them all.
+		"""
+		self.flush()
+		for row in self.conn.execute("SELECT heading, vocabulary FROM authorities"):
+			yield (row[0], row[1])
+
+	def records(self):
+		"""
+		@return: a generator of ((heading, vocabulary), Heading) 2-tuples, 
+		streamed
+		"""
+		self.flush()
+		for row in self.conn.execute("SELECT " + COLUMNS + " FROM authorities"):
+			yield (row[0], row[1]), _from_row(row)
+
+	def stale(self, vocabulary=None, now=None):
+		"""
+		@param vocabulary: only headings in this vocabulary (e.g. LC), or 
+		all of them if None
+		@return: a list of ((heading, vocabulary), Heading) 2-tuples for the 
+		headings whose TTL has passed, oldest first
+
+		@note: A list rather than a generator, since writing the refreshed 
+		records back would reset a cursor still open on this connection.
+		"""
+		self.flush()
+		now = now or time()
+		sql = "SELECT " + COLUMNS + " FROM authorities WHERE fetched_at < ?"
+		params = [now - min(TTL_FOUND, TTL_NOT_FOUND, TTL_DEPRECATED)]
+		if vocabulary is not None:
+			sql += " AND vocabulary = ?"
+			params.append(vocabulary)
+		rows = self.conn.execute(sql + " ORDER BY fetched_at", params)
+		return [((row[0], row[1]), _from_row(row)) for row in rows if _expired(row[2], row[4], row[6], now)]
+
+	def flush(self):
+		"""
+		@note: Commit the buffered writes in one transaction.
+		"""
+		if not self._pending:
+			return
+		now = time()
+		rows = [_to_row(k, r, self.source, now) for k, r in self._pending.iteritems()]
+		with self.conn:
+			self.conn.executemany("INSERT OR REPLACE INTO authorities (" + COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+		self._pending.clear()
+		metrics.add_time("cache", time() - now)
+
+	def close(self):
+		self.flush()
+		self.conn.close()
+
+#===============================================================================
+# FrontCache
+#===============================================================================
+class FrontCache(object):
+	"""
+	A bounded LRU (heading -> Heading) in front of a persistent cache (an 
+	AuthorityCache, or anything dict-like), with a write-behind buffer. 
+
+	Keys are normalized by the store (see AuthorityCache.key), so a plain
+	heading and its (heading, vocabulary) 2-tuple are the same entry.
+	Hot headings are answered from memory; a miss reads the store once and 
+	keeps the record, so "heading in cache" followed by cache[heading] costs 
+	one read, not two. Writes go into the LRU and a buffer, which is handed 
+	to the store (and flushed) every write_behind records, on flush() and on 
+	close(). Safe to share between threads.
+
+	Each lookup is counted once, as a hit if it was answered from memory and
+	a miss if it went to the store: "heading in cache" only counts the
+	headings it says are not there (missing or expired), and leaves the rest
+	to be counted by the cache[heading] that follows.
+	"""
+	def __init__(self, store, size=FRONT_SIZE, write_behind=WRITE_BEHIND):
+		"""
+		@param store: the persistent cache
+		@param size: the most headings to keep in memory
+		@param write_behind: new records to buffer before writing them out
+		"""
+		self.store = store
+		self.size = size
+		self.write_behind = write_behind
+		self._lru = OrderedDict()
+		self._dirty = {}
+		self._read = set()
+		"""Headings __contains__ read from the store, whose miss the next
+		__getitem__ counts"""
+		self._lock = threading.RLock()
+		self.key = getattr(store, "key", lambda key: key)
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def _remember(self, heading, record):
+		self._lru[heading] = record
+		if len(self._lru) > self.size:
+			# the oldest; if it's still dirty, _dirty keeps it until written
+			oldest, _ = self._lru.popitem(last=False)
+			self._read.discard(oldest)
+			self.evictions += 1
+			metrics.incr("cache.front.evict")
+
+	def _lookup(self, heading):
+		"""
+		@param heading: a normalized key
+		@return: a 2-tuple (record or None, True if it was in memory)
+		"""
+		record = self._lru.pop(heading, None)
+		if record is None:
+			record = self._dirty.get(heading)
+		if record is not None:
+			self._lru[heading] = record # most recently used
+			return record, True
+		record = self.store.get(heading)
+		if record is not None:
+			self._remember(heading, record)
+		return record, False
+
+	def _count(self, hit):
+		if hit:
+			self.hits += 1
+			metrics.incr("cache.front.hit")
+		else:
+			self.misses += 1
+			metrics.incr("cache.front.miss")
+
+	def __contains__(self, heading):
+		"""
+		@note: False for an expired heading, as for AuthorityCache.
+		"""
+		heading = self.key(heading)
+		with self._lock:
+			record, in_memory = self._lookup(heading)
+			if record is not None:
+				fetched_at = getattr(record, "fetched_at", None)
+				if fetched_at and _expired(record.value, record.found, fetched_at, time()):
+					metrics.incr("cache.stale")
+					record = None
+			if record is None:
+				self._read.discard(heading)
+				self._count(False)
+				return False
+			if not in_memory:
+				self._read.add(heading)
+		return True
+
+	def __getitem__(self, heading):
+		heading = self.key(heading)
+		with self._lock:
+			record, in_memory = self._lookup(heading)
+			if heading in self._read:
+				# __contains__ went to the store for it
+				self._read.discard(heading)
+				in_memory = False
+			self._count(in_memory)
+		if record is None:
+			raise KeyError(heading)
+		return record
+
+	def get(self, heading, default=None):
+		try:
+			return self[heading]
+		except KeyError:
+			return default
+
+	def __setitem__(self, heading, record):
+		heading = self.key(heading)
+		with self._lock:
+			self._lru.pop(heading, None)
+			self._read.discard(heading)
+			self._remember(heading, record)
+			self._dirty[heading] = record
+			if len(self._dirty) >= self.write_behind:
+				self._write()
+
+	def __delitem__(self, heading):
+		heading = self.key(heading)
+		with self._lock:
+			self._lru.pop(heading, None)
+			self._read.discard(heading)
+			self._dirty.pop(heading, None)
+			del self.store[heading]
+
+	def __len__(self):
+		self.flush()
+		return len(self.store)
+
+	def __iter__(self):
+		self.flush()
+		return iter(self.store)
+
+	def records(self):
+		self.flush()
+		return self.store.records()
+
+	def stale(self, vocabulary=None, now=None):
+		self.flush()
+		return self.store.stale(vocabulary, now)
+
+	def stats(self):
+		"""
+		@return: a dict of hits, misses, evictions and the headings held
+		"""
+		with self._lock:
+			return {"hits": self.hits, "misses": self.misses,
+				"evictions": self.evictions, "size": len(self._lru)}
+
+	def _write(self):
+		for heading, record in self._dirty.iteritems():
+			self.store[heading] = record
+		self._dirty.clear()
+		if hasattr(self.store, "flush"):
+			self.store.flush()
+
+	def flush(self):
+		"""
+		@note: Write the buffered records through to the store, and commit.
+		"""
+		with self._lock:
+			self._write()
+
+	def close(self):
+		self.flush()
+		self.store.close()
+
+#===============================================================================
+# _expired
+#===============================================================================
+def _expired(value, found, fetched_at, now):
+	"""
+	@return: True if a heading with this value, found flag and timestamp is
+	past its TTL
+	"""
+	if value.startswith(DEPRECATED): ttl = TTL_DEPRECATED
+	elif found: ttl = TTL_FOUND
+	else: ttl = TTL_NOT_FOUND
+	return fetched_at + ttl < now
+
+#===============================================================================
+# configure / configure_from
+#===============================================================================
+def configure(ttl_found=None, ttl_not_found=None, ttl_deprecated=None, front_size=None, write_behind=None):
+	"""
+	@param ttl_found: days before a found heading is looked up again
+	@param ttl_not_found: days before a heading that wasn't found is tried 
+	again
+	@param ttl_deprecated: days before a deprecated heading is looked up again
+	@param front_size: headings to keep in memory (0 turns the FrontCache off)
+	@param write_behind: new records to buffer before writing them out
+	"""
+	global TTL_FOUND, TTL_NOT_FOUND, TTL_DEPRECATED, FRONT_SIZE, WRITE_BEHIND
+	if ttl_found is not None: TTL_FOUND = float(ttl_found) * DAY
+	if ttl_not_found is not None: TTL_NOT_FOUND = float(ttl_not_found) * DAY
+	if ttl_deprecated is not None: TTL_DEPRECATED = float(ttl_deprecated) * DAY
+	if front_size is not None: FRONT_SIZE = int(front_size)
+	if write_behind is not None: WRITE_BEHIND = max(1, int(write_behind))
+
+def configure_from(config, section='Cache'):
+	"""
+	@param config: a ConfigParser that has already read the config file
+	@param section: the section holding ttl_found, ttl_not_found and 
+	ttl_deprecated, in days, and front_size and write_behind. Missing 
+	options keep their defaults.
+	"""
+	if not config.has_section(section):
+		return
+	opts = {}
+	for k in ('ttl_found', 'ttl_not_found', 'ttl_deprecated'):
+		if config.has_option(section, k): opts[k] = config.getfloat(section, k)
+	for k in ('front_size', 'write_behind'):
+		if config.has_option(section, k): opts[k] = config.getint(section, k)
+	configure(**opts)
+
+#===============================================================================
+# _to_row / _from_row
+#===============================================================================
+def _to_row(key, record, source, now):
+	heading, vocabulary = key
+	rtype = record.type if isinstance(record.type, basestring) else ""
+	fetched_at = getattr(record, "fetched_at", None) or now
+	return (heading, vocabulary, record.value or heading, rtype, int(record.found == True),
+		json.dumps(list(record.alternatives or [])), fetched_at,
+		getattr(record, "source", "") or source)
+
+def _utf8(s):
+	if isinstance(s, unicode): return s.encode("utf-8")
+	return s
+
+def _from_row(row):
+	record = Heading()
+	record.value = row[2]
+	record.type = row[3]
+	record.found = bool(row[4])
+	alternatives = []
+	for alt in json.loads(row[5]):
+		if isinstance(alt, list): alternatives.append(tuple(_utf8(a) for a in alt))
+		else: alternatives.append(_utf8(alt))
+	record.alternatives = alternatives
+	record.fetched_at = row[6]
+	record.source = row[7]
+	return record
+
+#===============================================================================
+# vocabulary_for
+#===============================================================================
+def vocabulary_for(source, type, default=LC):
+	"""
+	@param source: the service a heading was looked up in, if known
+	@param type: 'subject', 'personal', 'corporate' or ''
+	@return: the vocabulary a heading from an old, single-vocabulary cache 
+	belongs in
+	"""
+	if source == "id.loc.gov" or type == "subject": return LC
+	if type == "corporate": return VIAF_CORPORATE
+	if type == "personal" or source == "viaf.org": return VIAF_PERSONAL
+	return default
+
+#===============================================================================
+# _ShelfUnpickler
+#===============================================================================
+class _ShelfUnpickler(pickle.Unpickler):
+	"""
+	The shelves were written by the scripts run as __main__, so their Heading
+	class could have been pickled under any module name. Map them all here.
+	"""
+	def find_class(self, module, name):
+		if name == "Heading":
+			return Heading
+		return pickle.Unpickler.find_class(self, module, name)
+
+#===============================================================================
+# migrate_shelf
+#===============================================================================
+def migrate_shelf(shelf_file, authcache, source=""):
+	"""
+	@param shelf_file: path to an old shelve cache (e.g. db/cache.db)
+	@param authcache: the AuthorityCache to copy into
+	@param source: the source to record for the migrated headings
+	@return: the number of headings copied
+
+	@note: The shelf has no timestamps, so migrated rows are stamped with the
+	file's modification time. Each heading goes in the vocabulary its type 
+	and source say (see vocabulary_for); headings the cache already has are 
+	left as they are.
+	"""
+	from cStringIO import StringIO
+	mtime = os.path.getmtime(shelf_file) if os.path.exists(shelf_file) else time()
+	shelf = shelve.open(shelf_file, flag="r")
+	rows = []
+	try:
+		for key in shelf.dict.keys():
+			try:
+				record = _ShelfUnpickler(StringIO(shelf.dict[key])).load()
+			except Exception, e:
+				sys.stderr.write("Skipping unreadable entry " + key + ": " + str(e) + "\n")
+				continue
+			if isinstance(record, basestring):
+				# owi.db: OCLC number -> work id URI
+				uri = record
+				record = Heading()
+				record.value = key
+				record.found = True
+				record.alternatives = [(uri, "")]
+			if not hasattr(record, "alternatives"):
+				continue
+			record.fetched_at = mtime
+			record.source = source
+			vocabulary = vocabulary_for(source, record.type, authcache.vocabulary)
+			rows.append(_to_row((key, vocabulary), record, source, mtime))
+	finally:
+		shelf.close()
+	authcache.flush()
+	with authcache.conn:
+		authcache.conn.executemany("INSERT OR IGNORE INTO authorities (" + COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+	return len(rows)
+
+#===============================================================================
+# merge_cache
+#===============================================================================
+def merge_cache(cache_file, authcache):
+	"""
+	@param cache_file: another SQLite cache (e.g. the old db/ead.cache.sqlite)
+	@param authcache: the AuthorityCache to copy into
+	@return: the number of headings copied
+
+	@note: Headings the cache already has are left as they are.
+	"""
+	authcache.flush()
+	conn = authcache.conn
+	before = conn.total_changes
+	conn.execute("ATTACH DATABASE ? AS other", (cache_file,))
+	try:
+		with conn:
+			if authcache._has_table("authorities", "other"):
+				conn.execute("INSERT OR IGNORE INTO authorities (" + COLUMNS + ") SELECT " + COLUMNS + " FROM other.authorities")
+			if authcache._has_table("headings", "other"):
+				conn.execute("INSERT OR IGNORE INTO authorities (" + COLUMNS + ") SELECT heading, " + VOCABULARY_SQL + ", value, type, found, alternatives, fetched_at, source FROM other.headings", (authcache.vocabulary or LC,))
+	finally:
+		conn.execute("DETACH DATABASE other")
+	return conn.total_changes - before
+
+def migrate(old_file, authcache, source=""):
+	"""
+	@param old_file: an old cache, SQLite or shelve
+	@return: the number of headings copied
+	"""
+	sqlite = False
+	if os.path.isfile(old_file):
+		with open(old_file, "rb") as fh:
+			sqlite = fh.read(16) == "SQLite format 3\x00"
+	if sqlite:
+		return merge_cache(old_file, authcache)
+	return migrate_shelf(old_file, authcache, source)
+
+#===============================================================================
+# Maintenance: stats / compact / dump / load / prune
+#===============================================================================
+TSV = "tsv"
+JSONL = "jsonl"
+DUMP_COLUMNS = ("heading", "vocabulary", "status", "value", "type", "found", "alternatives", "fetched_at", "source")
+"""Columns of an export; status is for reading and is ignored on import"""
+AGES = ((1, "1d"), (7, "7d"), (30, "30d"), (180, "180d"), (365, "1y"))
+"""Age buckets for stats: days, label"""
+PRUNE_BATCH = 10000
+"""Rows deleted per transaction, so running jobs aren't held up"""
+
+def _json_functions(conn):
+	"""
+	@note: Older SQLite builds lack JSON1; stand in for the one function 
+	we use.
+	"""
+	try:
+		conn.execute("SELECT json_array_length('[]')").fetchone()
+	except sqlite3.OperationalError:
+		conn.create_function("json_array_length", 1, lambda s: len(json.loads(s)))
+
+def _files(path):
+	"""
+	@return: the bytes on disk of the cache file and its WAL
+	"""
+	return sum(os.path.getsize(f) for f in (path, path + "-wal") if os.path.isfile(f))
+
+def stats(authcache, now=None):
+	"""
+	@param authcache: an AuthorityCache
+	@return: a dict (JSON-ready): entries by vocabulary and outcome (and how
+	many of them have expired), by age, and the file's size and free pages
+	"""
+	authcache.flush()
+	conn = authcache.conn
+	_json_functions(conn)
+	now = now or time()
+	vocabularies = {}
+	sql = "SELECT vocabulary, status, COUNT(*), SUM(expired) FROM (SELECT vocabulary, " + \
+		STATUS_SQL + " AS status, " + EXPIRED_SQL + " AS expired FROM authorities) GROUP BY vocabulary, status"
+	for vocabulary, status, count, expired in conn.execute(sql, (TTL_DEPRECATED, TTL_FOUND, TTL_NOT_FOUND, now)):
+		v = vocabularies.setdefault(vocabulary, {"entries": 0, "expired": 0})
+		v[status] = count
+		v["entries"] += count
+		v["expired"] += expired or 0
+	columns = []
+	lower = None
+	for days, label in AGES:
+		cond = "fetched_at >= %r" % (now - days * DAY)
+		if lower is not None: cond += " AND fetched_at < %r" % lower
+		columns.append("SUM(%s)" % cond)
+		lower = now - days * DAY
+	columns.append("SUM(fetched_at < %r)" % lower)
+	columns += ["MIN(fetched_at)", "MAX(fetched_at)", "COUNT(*)"]
+	row = conn.execute("SELECT " + ", ".join(columns) + " FROM authorities").fetchone()
+	ages = OrderedDict(("<" + label, row[i] or 0) for i, (days, label) in enumerate(AGES))
+	ages[">=" + AGES[-1][1]] = row[len(AGES)] or 0
+	page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+	pages = conn.execute("PRAGMA page_count").fetchone()[0]
+	free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+	return {
+		"path": authcache.path,
+		"entries": row[-1],
+		"vocabularies": vocabularies,
+		"ages": ages,
+		"oldest": row[-3],
+		"newest": row[-2],
+		"bytes": _files(authcache.path),
+		"pages": pages,
+		"free_pages": free,
+		"free_ratio": round(float(free) / pages, 4) if pages else 0.0,
+		"page_size": page_size
+	}
+
+def compact(authcache):
+	"""
+	@param authcache: an AuthorityCache
+	@return: a 2-tuple (bytes before, bytes after)
+
+	@raise sqlite3.OperationalError: when another process keeps the file 
+	busy for longer than TIMEOUT
+
+	@note: Rewrites the file without its free pages and folds the WAL back
+	in. Needs the file to itself for as long as that takes.
+	"""
+	authcache.flush()
+	before = _files(authcache.path)
+	conn = authcache.conn
+	conn.execute("ANALYZE")
+	conn.commit()
+	conn.isolation_level = None
+	try:
+		conn.execute("VACUUM")
+	finally:
+		conn.isolation_level = ""
+	conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+	return before, _files(authcache.path)
+
+def _escape(s):
+	if isinstance(s, float): return repr(s)
+	s = str(s)
+	return s.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+_UNESCAPES = {"t": "\t", "n": "\n", "r": "\r"}
+_ESCAPED = re.compile(r"\\(.)")
+
+def _unescape(s):
+	return _ESCAPED.sub(lambda m: _UNESCAPES.get(m.group(1), m.group(1)), s)
+
+def dump(authcache, fh, fmt=TSV, vocabulary=None):
+	"""
+	@param authcache: an AuthorityCache
+	@param fh: where to write, opened for writing bytes
+	@param fmt: TSV (with a header line; tabs, newlines and backslashes 
+	escaped) or JSONL (one JSON object per line)
+	@param vocabulary: only this vocabulary's entries, or all if None
+	@return: the number of entries written
+
+	@note: Streams rows off a cursor, in key order.
+	"""
+	authcache.flush()
+	conn = authcache.conn
+	_json_functions(conn)
+	sql = "SELECT heading, vocabulary, " + STATUS_SQL + ", value, type, found, alternatives, fetched_at, source FROM authorities"
+	params = ()
+	if vocabulary is not None:
+		sql += " WHERE vocabulary = ?"
+		params = (vocabulary,)
+	if fmt == TSV:
+		fh.write("\t".join(DUMP_COLUMNS) + "\n")
+	count = 0
+	for row in conn.execute(sql + " ORDER BY heading, vocabulary", params):
+		if fmt == TSV:
+			fh.write("\t".join(_escape(c) for c in row) + "\n")
+		else:
+			entry = dict(zip(DUMP_COLUMNS, row))
+			entry["found"] = bool(entry["found"])
+			entry["alternatives"] = json.loads(entry["alternatives"])
+			fh.write(json.dumps(entry, sort_keys=True) + "\n")
+		count += 1
+	return count
+
+def _parse(fh, fmt):
+	"""
+	@return: a generator of rows (in COLUMNS order) read from an export
+	"""
+	for n, line in enumerate(fh):
+		line = line.rstrip("\r\n")
+		if not line:
+			continue
+		if fmt == TSV:
+			if n == 0 and line == "\t".join(DUMP_COLUMNS):
+				continue
+			cells = line.split("\t")
+			if len(cells) != len(DUMP_COLUMNS):
+				raise ValueError("Line %d: expected %d columns" % (n + 1, len(DUMP_COLUMNS)))
+			entry = dict(zip(DUMP_COLUMNS, [_unescape(c) for c in cells]))
+			found = entry["found"] in ("1", "True", "true")
+			alternatives = entry["alternatives"]
+			json.loads(alternatives) # must be JSON
+		else:
+			entry = dict((k, _utf8(v)) for k, v in json.loads(line).items())
+			found = entry.get("found") == True
+			alternatives = json.dumps(entry.get("alternatives") or [])
+		yield (entry["heading"], entry["vocabulary"], entry.get("value") or entry["heading"],
+			entry.get("type") or "", int(found), alternatives,
+			float(entry.get("fetched_at") or time()), entry.get("source") or "")
+
+def load(authcache, fh, fmt=TSV):
+	"""
+	@param authcache: an AuthorityCache
+	@param fh: an export (see dump), opened for reading bytes
+	@param fmt: TSV or JSONL
+	@return: the number of entries read
+
+	@raise ValueError: on a line that can't be read
+
+	@note: Of an entry that is both in the cache and in the file, the one
+	looked up last is kept. Streamed, BATCH_SIZE rows per transaction.
+	"""
+	authcache.flush()
+	conn = authcache.conn
+	count = 0
+	batch = []
+	def write():
+		with conn:
+			conn.executemany("INSERT OR IGNORE INTO authorities (" + COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+			conn.executemany("UPDATE authorities SET value = ?, type = ?, found = ?, alternatives = ?, fetched_at = ?, source = ? " + \
+				"WHERE heading = ? AND vocabulary = ? AND fetched_at < ?",
+				[r[2:] + r[:2] + (r[6],) for r in batch])
+		del batch[:]
+	for row in _parse(fh, fmt):
+		batch.append(row)
+		count += 1
+		if len(batch) >= BATCH_SIZE:
+			write()
+	if batch:
+		write()
+	return count
+
+def prune(authcache, older_than, vocabulary=None, now=None):
+	"""
+	@param authcache: an AuthorityCache
+	@param older_than: days; entries looked up longer ago than this go
+	@param vocabulary: only this vocabulary's entries, or all if None
+	@return: the number of entries deleted
+
+	@note: Deletes PRUNE_BATCH rows per transaction. The file doesn't 
+	shrink until it's compacted; until then the pages are reused.
+	"""
+	authcache.flush()
+	conn = authcache.conn
+	where = "fetched_at < ?"
+	params = [(now or time()) - older_than * DAY]
+	if vocabulary is not None:
+		where += " AND vocabulary = ?"
+		params.append(vocabulary)
+	deleted = 0
+	while True:
+		with conn:
+			cur = conn.execute("DELETE FROM authorities WHERE rowid IN (SELECT rowid FROM authorities WHERE " + where + " LIMIT ?)", params + [PRUNE_BATCH])
+		deleted += cur.rowcount
+		if cur.rowcount < PRUNE_BATCH:
+			return deleted
+
+#===============================================================================
+# open_cache
+#===============================================================================
+def open_cache(path=CACHE_FILE, legacy=(), source="", vocabulary=LC):
+	"""
+	@param path: the shared SQLite cache file
+	@param legacy: old cache files (shelve, or SQLite from before the cache 
+	was shared) to copy in; each is copied once, the first time it's seen
+	@param source: the default source for records written through this cache
+	@param vocabulary: the vocabulary of keys given as a plain heading
+	@return: an AuthorityCache, behind a FrontCache unless FRONT_SIZE is 0
+	"""
+	authcache = AuthorityCache(path, source=source, vocabulary=vocabulary)
+	if isinstance(legacy, basestring):
+		legacy = [legacy]
+	for old in legacy:
+		if not os.path.isfile(old) and not whichdb.whichdb(old):
+			continue
+		done = os.path.abspath(old)
+		if authcache.conn.execute("SELECT 1 FROM migrated WHERE path = ?", (done,)).fetchone():
+			continue
+		count = migrate(old, authcache, source)
+		with authcache.conn:
+			authcache.conn.execute("INSERT OR REPLACE INTO migrated (path, migrated_at) VALUES (?, ?)", (done, time()))
+		sys.stderr.write("Migrated %d headings from %s to %s\n" % (count, old, path))
+	if FRONT_SIZE > 0:
+		return FrontCache(authcache, FRONT_SIZE, WRITE_BEHIND)
+	return authcache
+
+#===============================================================================
+# main
+#===============================================================================
+def _print_stats(st, out):
+	out.write("%s: %d entries, %d bytes (%d of %d pages free, %.1f%%)\n" % (st["path"], st["entries"], st["bytes"], st["free_pages"], st["pages"], 100 * st["free_ratio"]))
+	columns = ("entries", "found", "not_found", "deprecated", "multiple", "expired")
+	out.write("%-16s" % "vocabulary" + "".join("%12s" % c for c in columns) + "\n")
+	for vocabulary, counts in sorted(st["vocabularies"].items()):
+		out.write("%-16s" % vocabulary + "".join("%12d" % counts.get(c, 0) for c in columns) + "\n")
+	out.write("age" + "".join("  %s: %d" % a for a in st["ages"].items()) + "\n")
+
+def main(argv=None):
+	common = ArgumentParser(add_help=False)
+	common.add_argument("-d", "--db", default=CACHE_FILE, dest="db", help="The cache file (default %s)." % CACHE_FILE)
+	common.add_argument("-c", "--conf_file", default="./cfg/mrc.cfg", dest="conf_file", help="Config file with the [Cache] TTLs, used to count expired entries.")
+	parser = ArgumentParser(description=__doc__.strip().split("\n\n")[0], formatter_class=RawDescriptionHelpFormatter)
+	sub = parser.add_subparsers(dest="command")
+	st = sub.add_parser("stats", parents=[common], help="Entries by vocabulary, outcome and age; size and free pages.")
+	st.add_argument("--json", action="store_true", dest="json", help="Print the stats as JSON.")
+	sub.add_parser("vacuum", parents=[common], help="Compact the file: drop free pages, fold in the WAL.")
+	sub.add_parser("compact", parents=[common], help="Same as vacuum.")
+	ex = sub.add_parser("export", parents=[common], help="Write the entries out as TSV or JSON lines.")
+	ex.add_argument("-f", "--format", choices=(TSV, JSONL), dest="format", help="Default: from -o's extension, else tsv.")
+	ex.add_argument("-o", "--output", dest="output", help="Default: stdout.")
+	ex.add_argument("--vocabulary", dest="vocabulary", help="Only this vocabulary (e.g. %s)." % LC)
+	im = sub.add_parser("import", parents=[common], help="Read entries from an export; the newer of two copies is kept.")
+	im.add_argument("-f", "--format", choices=(TSV, JSONL), dest="format", help="Default: from the extension, else tsv.")
+	im.add_argument("input")
+	pr = sub.add_parser("prune", parents=[common], help="Delete entries looked up more than DAYS ago.")
+	pr.add_argument("--older-than", type=float, required=True, dest="older_than", metavar="DAYS")
+	pr.add_argument("--vocabulary", dest="vocabulary", help="Only this vocabulary.")
+	mi = sub.add_parser("migrate", help="Copy an old cache (shelve or SQLite) in.")
+	mi.add_argument("old")
+	mi.add_argument("db", nargs="?", default=CACHE_FILE)
+	args = parser.parse_args(argv)
+
+	if args.command != "migrate" and args.conf_file and os.path.isfile(args.conf_file):
+		config = ConfigParser.SafeConfigParser()
+		config.read([args.conf_file])
+		configure_from(config)
+	if args.command == "import" and not os.path.isfile(args.input):
+		sys.stderr.write("File " + args.input + " does not exist\n")
+		return 66
+	fmt = getattr(args, "format", None)
+	if fmt is None:
+		path = getattr(args, "output", None) or getattr(args, "input", None) or ""
+		fmt = JSONL if os.path.splitext(path)[1].lower() in (".jsonl", ".json") else TSV
+	authcache = AuthorityCache(args.db)
+	try:
+		if args.command == "stats":
+			result = stats(authcache)
+			if args.json: sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+			else: _print_stats(result, sys.stdout)
+		elif args.command in ("vacuum", "compact"):
+			before, after = compact(authcache)
+			sys.stdout.write("%s: %d -> %d bytes\n" % (args.db, before, after))
+		elif args.command == "export":
+			fh = open(args.output, "wb") if args.output else sys.stdout
+			try:
+				count = dump(authcache, fh, fmt, args.vocabulary)
+			finally:
+				if fh is not sys.stdout: fh.close()
+			sys.stderr.write("Exported %d entries\n" % count)
+		elif args.command == "import":
+			with open(args.input, "rb") as fh:
+				count = load(authcache, fh, fmt)
+			sys.stdout.write("Imported %d entries from %s\n" % (count, args.input))
+		elif args.command == "prune":
+			count = prune(authcache, args.older_than, args.vocabulary)
+			sys.stdout.write("Pruned %d entries; run vacuum to give the space back\n" % count)
+		else:
+			count = migrate(args.old, authcache)
+			sys.stdout.write("Migrated %d headings from %s to %s\n" % (count, args.old, args.db))
+	except (ValueError, KeyError), e:
+		sys.stderr.write("Bad input: %s\n" % e)
+		return 65
+	except sqlite3.OperationalError, e:
+		sys.stderr.write(str(e) + "\n")
+		return 75
+	finally:
+		authcache.close()
+	return 0
+
+if __name__ == "__main__": sys.exit(main())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Checkpoints for long runs. A small JSON sidecar next to the output file
+records how many input records have been fully written, the 001 of the last
+one and the byte length of the output at that point, so that a run that dies
+can be resumed: skip the finished records, cut the output back to the last
+good record and carry on appending.
+"""
+import json
+import os
+
+SUFFIX = ".ckpt"
+INTERVAL = 100
+"""Records between checkpoints"""
+
+#===============================================================================
+# CheckpointMismatchException
+#===============================================================================
+class CheckpointMismatchException(Exception):
+	"""
+	Raised when the input doesn't line up with the checkpoint (e.g. the file
+	changed since the run that wrote it).
+	"""
+	pass
+
+#===============================================================================
+# Checkpoint
+#===============================================================================
+class Checkpoint(object):
+	def __init__(self, outpath, inpath, interval=INTERVAL):
+		"""
+		@param outpath: the output file being written; the sidecar is
+		outpath + SUFFIX
+		@param inpath: the input file, recorded so we don't resume from the
+		wrong one
+		@param interval: records between saves
+		"""
+		self.outpath = outpath
+		self.path = outpath + SUFFIX
+		self.inpath = os.path.abspath(inpath)
+		self.interval = interval
+		self.records = 0
+		"""Input records fully written so far"""
+		self.last_id = None
+		"""001 of the last record written"""
+		self.output_bytes = 0
+		"""Length of the output file after the last record written"""
+
+	def load(self):
+		"""
+		@return: True if there was a checkpoint for this input to resume from
+
+		@raise CheckpointMismatchException: when the checkpoint is for
+		another input file
+		"""
+		if not os.path.isfile(self.path):
+			return False
+		with open(self.path, "rb") as fh:
+			state = json.load(fh)
+		if state.get("input") != self.inpath:
+			raise CheckpointMismatchException("Checkpoint " + self.path + " is for " + str(state.get("input")))
+		self.records = state["records"]
+		self.last_id = state["last_id"]
+		self.output_bytes = state["output_bytes"]
+		return True
+
+	def update(self, last_id, fh):
+		"""
+		@param last_id: the 001 of the record just written
+		@param fh: the output file handle; it is flushed before its position
+		is recorded
+		"""
+		self.records += 1
+		self.last_id = last_id
+		if self.records % self.interval == 0:
+			self.save(fh)
+
+	def save(self, fh):
+		fh.flush()
+		os.fsync(fh.fileno())
+		self.output_bytes = fh.tell()
+		state = {"input": self.inpath, "records": self.records, "last_id": self.last_id, "output_bytes": self.output_bytes}
+		tmp = self.path + ".tmp"
+		with open(tmp, "wb") as out:
+			json.dump(state, out)
+			out.flush()
+			os.fsync(out.fileno())
+		os.rename(tmp, self.path)
+
+	def clear(self):
+		"""
+		@note: Call when the run finished; there's nothing left to resume.
+		"""
+		if os.path.isfile(self.path):
+			os.remove(self.path)
+
+#===============================================================================
+# open_output
+#===============================================================================
+def open_output(checkpoint):
+	"""
+	@param checkpoint: a Checkpoint that has been load()ed
+	@return: the output file, opened for appending and cut back to the end
+	of the last checkpointed record
+	"""
+	fh = open(checkpoint.outpath, "r+b")
+	fh.truncate(checkpoint.output_bytes)
+	fh.seek(checkpoint.output_bytes)
+	return fh
+
+#===============================================================================
+# skip
+#===============================================================================
+def skip(records, checkpoint, record_id):
+	"""
+	@param records: an iterator over the input records
+	@param checkpoint: a Checkpoint that has been load()ed
+	@param record_id: a function that gets the 001 from a record
+	@return: the iterator, advanced past the records already written
+
+	@raise CheckpointMismatchException: when the last skipped record isn't
+	the one the checkpoint says was written last
+	"""
+	records = iter(records)
+	last = None
+	for i in xrange(checkpoint.records):
+		try:
+			last = next(records)
+		except StopIteration:
+			raise CheckpointMismatchException("Input has fewer records than the checkpoint")
+	if last is not None and record_id(last) != checkpoint.last_id:
+		raise CheckpointMismatchException("Record %d is %s, checkpoint says %s" % (checkpoint.records, record_id(last), checkpoint.last_id))
+	return records
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Shared HTTP client layer for mrc.py, ead.py and owi.py. Keeps one persistent,
+pooled requests.Session per host so that lookups reuse a few kept-alive
+sockets rather than opening a new connection (and TLS handshake) per heading.
+
+Every request also waits on the host's token bucket (see ratelimit.py) and
+backs off and retries when the service answers 429 or 503. Redirects (e.g.
+id.loc.gov's known-label 302) are followed here rather than by requests, so
+that each hop is a request of its own: it takes a token, and is retried on
+its own.
+"""
+from urlparse import urljoin, urlparse
+from requests.adapters import HTTPAdapter
+from time import time
+import metrics
+import ratelimit
+import threading
+import requests
+
+POOL_CONNECTIONS = 4
+"""Number of per-host connection pools to cache in each Session"""
+
+POOL_MAXSIZE = 8
+"""Max number of connections to keep alive in each pool"""
+
+TIMEOUT = 30.0
+"""Seconds to wait for the server before giving up"""
+
+KEEP_ALIVE = True
+"""Send Connection: keep-alive and hold sockets open between requests"""
+
+MAX_RETRIES = 2
+"""Retries on connection errors (not on HTTP error statuses)"""
+
+BACKOFF_RETRIES = 3
+"""Retries after a 429 or 503, each one after the host's backoff"""
+
+MAX_REDIRECTS = 10
+"""Redirects followed before the redirect itself is returned"""
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+_sessions = {}
+_lock = threading.Lock()
+
+#===============================================================================
+# configure
+#===============================================================================
+def configure(pool_connections=None, pool_maxsize=None, timeout=None, keep_alive=None, max_retries=None, backoff_retries=None):
+	"""
+	@param pool_connections: number of connection pools per Session
+	@param pool_maxsize: max connections kept alive per pool
+	@param timeout: request timeout in seconds
+	@param keep_alive: False to close the socket after every request
+	@param max_retries: retries on connection errors
+	@param backoff_retries: retries after a 429 or 503
+
+	@note: Sessions already opened are closed so that new settings take effect.
+	"""
+	global POOL_CONNECTIONS, POOL_MAXSIZE, TIMEOUT, KEEP_ALIVE, MAX_RETRIES, BACKOFF_RETRIES
+	if pool_connections is not None: POOL_CONNECTIONS = int(pool_connections)
+	if pool_maxsize is not None: POOL_MAXSIZE = int(pool_maxsize)
+	if timeout is not None: TIMEOUT = float(timeout)
+	if keep_alive is not None: KEEP_ALIVE = keep_alive
+	if max_retries is not None: MAX_RETRIES = int(max_retries)
+	if backoff_retries is not None: BACKOFF_RETRIES = int(backoff_retries)
+	close()
+
+#===============================================================================
+# configure_from
+#===============================================================================
+def configure_from(config, section='HTTP'):
+	"""
+	@param config: a ConfigParser that has already read the config file
+	@param section: the section holding pool_connections, pool_maxsize,
+	timeout, keep_alive, max_retries and backoff_retries. Missing options 
+	keep their defaults.
+	"""
+	if not config.has_section(section):
+		return
+	opts = {}
+	for k in ('pool_connections', 'pool_maxsize', 'max_retries', 'backoff_retries'):
+		if config.has_option(section, k): opts[k] = config.getint(section, k)
+	if config.has_option(section, 'timeout'):
+		opts['timeout'] = config.getfloat(section, 'timeout')
+	if config.has_option(section, 'keep_alive'):
+		opts['keep_alive'] = config.getboolean(section, 'keep_alive')
+	configure(**opts)
+
+#===============================================================================
+# session_for
+#===============================================================================
+def session_for(url):
+	"""
+	@param url: any URL on the host we want to talk to
+	@return: the (shared) requests.Session for that scheme and host
+	"""
+	parsed = urlparse(url)
+	key = (parsed.scheme, parsed.netloc)
+	with _lock:
+		session = _sessions.get(key)
+		if session is None:
+			session = requests.Session()
+			adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+				pool_maxsize=POOL_MAXSIZE, max_retries=MAX_RETRIES, pool_block=True)
+			session.mount("http://", adapter)
+			session.mount("https://", adapter)
+			if KEEP_ALIVE:
+				session.headers["Connection"] = "keep-alive"
+			else:
+				session.headers["Connection"] = "close"
+			_sessions[key] = session
+	return session
+
+#===============================================================================
+# get
+#===============================================================================
+def get(url, **kwargs):
+	"""
+	@param url: the URL to GET
+	@param kwargs: passed on to requests.Session.get (headers, params, etc.)
+	@return: a requests.Response, with the redirects that led to it in its
+	history
+
+	@note: A drop-in for requests.get that goes through the pooled Session
+	for the host, applies the default timeout and the host's rate limit.
+	Latency and status codes are recorded in metrics.
+	"""
+	kwargs.setdefault("timeout", TIMEOUT)
+	follow = kwargs.pop("allow_redirects", True)
+	history = []
+	while True:
+		resp = _get(url, allow_redirects=False, **kwargs)
+		if not follow or resp.status_code not in REDIRECT_STATUSES or "location" not in resp.headers or len(history) >= MAX_REDIRECTS:
+			resp.history = history
+			return resp
+		history.append(resp)
+		url = urljoin(resp.url, resp.headers["location"])
+		kwargs.pop("params", None) # (the Location has them already)
+
+def _get(url, **kwargs):
+	"""
+	@return: the response to one GET, after any backing off and retrying
+	"""
+	session = session_for(url)
+	host = urlparse(url).hostname
+	bucket = ratelimit.bucket_for(host)
+	attempt = 0
+	while True:
+		metrics.add_time("ratelimit_wait", bucket.acquire())
+		start = time()
+		resp = session.get(url, **kwargs)
+		elapsed = time() - start
+		metrics.add_time("http", elapsed)
+		metrics.observe(host, elapsed)
+		metrics.incr("http.%s.%d" % (host, resp.status_code))
+		if resp.status_code not in ratelimit.BACKOFF_STATUSES:
+			bucket.relax()
+			return resp
+		bucket.backoff(ratelimit.retry_after(resp))
+		if attempt >= BACKOFF_RETRIES:
+			return resp
+		attempt += 1
+
+#===============================================================================
+# close
+#===============================================================================
+def close():
+	"""
+	@note: Close all pooled Sessions (and their sockets).
+	"""
+	with _lock:
+		for session in _sessions.values():
+			session.close()
+		_sessions.clear()
@@ -1,19 +1,23 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
 from argparse import ArgumentParser, RawTextHelpFormatter, RawDescriptionHelpFormatter
+from collections import OrderedDict
+from glob import glob
 from sys import exit
-from time import sleep
+from time import time
 import ConfigParser
-import httplib
+import cache
+import client
+import lcindex
+import metrics
 import libxml2
 import logging
+import multiprocessing
+import normalize
 import os
-import pickle
-import pymarc
+import ratelimit
 import re
-import requests
-import shelve
-import subprocess
+import resolver
 import urllib2
 
 NAMESPACES = {
@@ -32,12 +36,19 @@ ID_SUBJECT_RESOLVER = "http://id.loc.gov/vocabulary/subject/label/"
 VIAF_SEARCH = "http://viaf.org/viaf/search"
 RSS_XML = "application/rss+xml" 
 APPLICATION_XML = "application/xml"
+CONFIG = "./cfg/ead.cfg"
 SHELF_FILE = "cache.db"
+"""The old shelve cache, migrated into CACHE_FILE the first time it is seen"""
 LOG_FILENAME = "./log/alts.log"
 LOG_FORMAT = "%(asctime)s %(filename)s %(message)s"
 OUTDIR = "./out/"
 LOGDIR = "./log/"
+JOB_LOG = "./log/jobs.log"
 DBDIR = "./db"
+CACHE_FILE = cache.CACHE_FILE
+"""Shared with mrc.py and owi.py"""
+OLD_CACHE_FILE = DBDIR + "/ead.cache.sqlite"
+"""ead.py's own cache from before it was shared; migrated like SHELF_FILE"""
 
 #===============================================================================
 # HeadingNotFoundException
@@ -91,6 +102,8 @@ class Heading(object):
 		"""boolean, True if one or more URIs was found"""
 		self.alternatives = ""
 		""""A list of 2-tuple (uri, label) possibilities"""
+		self.source = ""
+		"""The service the heading was looked up in, e.g. 'viaf.org'"""
 	@staticmethod	
 	def pers_or_corp_from_node(node):
 		# TODO: make sure that node.get_name() returns the local name, and not, 
@@ -114,16 +127,23 @@ class XPaths(object):
 		"/ead:ead/ead:archdesc/ead:did/ead:origination/*" + \
 			"[not(@authfilenumber)]"
 			
-	NAMES_RECURSIVE = "//ead:corpname[not(@authfilenumber)]|" + \
-					"//ead:famname[not(@authfilenumber)]|" + \
-					"//ead:persname[not(@authfilenumber)]|" + \
-					"//ead:origination/*[not(@authfilenumber)]"
+	# The recursive names (and names and subjects) XPaths scan the document 
+	# once, testing each element in one predicate, rather than once per 
+	# element name as a union would.
+	NAMES_RECURSIVE = "//*[not(@authfilenumber) and " + \
+					"(self::ead:corpname or self::ead:famname or " + \
+					"self::ead:persname or parent::ead:origination)]"
 				
 	SUBJECTS = "//ead:archdesc/ead:controlaccess/ead:subject" + \
 					"[not(@source = 'local') and not(@authfilenumber)]"
 	
 	SUBJECTS_RECURSIVE = "//ead:subject" + \
 							"[not(@source = 'local') and not(@authfilenumber)]"
+
+	HEADINGS_RECURSIVE = "//*[not(@authfilenumber) and " + \
+					"((self::ead:subject and not(@source = 'local')) or " + \
+					"self::ead:corpname or self::ead:famname or " + \
+					"self::ead:persname or parent::ead:origination)]"
 							
 #===============================================================================
 # setup
@@ -148,7 +168,9 @@ def _normalize_heading(heading):
 	@param heading: A heading from the source data.
 	@return: A normalized version of the heading.
 	 
-	@note: 	Other users may need to modify or extend this function. This
+	@note: 	For the VIAF names; subjects go to id.loc.gov and are normalized
+	with normalize.lc_heading, as in mrc.py, so the two share cache entries.
+	Other users may need to modify or extend this function. This
 	version, in order:
 	 1. collapeses whitespace
 	 2. strips spaces that trail or follow hyphens ("-")
@@ -184,60 +206,68 @@ def query_viaf(name, type, accept=RSS_XML):
 	q = 'local.' + type + 'Names+%3D+"' + name + '"+and+local.sources+any+"lc"'
 	headers = {'Accept': accept}
 	params = {"query":q}
-	resp = requests.get(VIAF_SEARCH, headers=headers, params=params)
+	resp = client.get(VIAF_SEARCH, headers=headers, params=params)
+	count, items = _viaf_items(resp.content)
+
+	if count == 1:
+		return items[0]
+	elif count == 0:
+		msg = "Not found: " + name + os.linesep
+		raise HeadingNotFoundException(msg, name, type)	
+	elif count > 1:
+		# check for an exact match, we'll return that; then try again with a 
+		# stop appended
+		by_title = {}
+		for uri, label in items:
+			by_title.setdefault(label, []).append(uri)
+		for title in (name, name + "."):
+			uris = by_title.get(title)
+			if uris != None and len(uris) == 1:
+				return (uris[0], title)
+		# the exception reports the (uri, authform) 2-tuples
+		msg = "Multiple matches for " + name + "\n"
+		raise MultipleMatchesException(msg, name, type, items)
+	else:
+		raise Exception("Could not retrieve count (" + name + ")")
+
+def _viaf_items(content):
+	"""
+	@param content: the body of a VIAF RSS response, as bytes
+	@return: a 2-tuple (total results, [(uri, title), ...] for the items)
+
+	@raise LookupError: when the response isn't one we can read
+
+	@note: One parse straight from the bytes (libxml2 reads the encoding 
+	from the document, and recovers from bad bytes) and one walk over the 
+	items.
+	"""
 	ctxt = None
 	doc = None
 	try:
-		doc = libxml2.parseDoc(resp.text.encode("UTF-8", errors="ignore"))
-		
+		options = libxml2.XML_PARSE_RECOVER | libxml2.XML_PARSE_NOERROR | \
+			libxml2.XML_PARSE_NOWARNING | libxml2.XML_PARSE_NONET
+		try:
+			doc = libxml2.readMemory(content, len(content), None, None, options)
+		except libxml2.treeError:
+			raise LookupError("VIAF response isn't XML")
 		ctxt = doc.xpathNewContext()
-		for ns in NAMESPACES.keys():
-			ctxt.xpathRegisterNs(ns, NAMESPACES[ns])
-
-		count = int(ctxt.xpathEval("//opensearch:totalResults")[0].content)
-		
-		if count == 1:
-			uri = ctxt.xpathEval("//link[parent::item]")[0].content
-			label = ctxt.xpathEval("//title[parent::item]")[0].content
-			return (uri, label)
-		elif count == 0:
-			msg = "Not found: " + name + os.linesep
-			raise HeadingNotFoundException(msg, name, type)	
-		elif count > 1:
-			# check for an exact match, we'll return that
-			name4xpath = name.replace("'", "&apos;").replace('"', "&quot;")
-			if int(ctxt.xpathEval("count(//title[. = '" + name4xpath + "'])")) == 1:
-				# (re. above magic: if count of titles with exactly our name is 1) 
-				label = ctxt.xpathEval("//title[. = '" + name4xpath + "']")[0].content
-				uri = ctxt.xpathEval("//item[title[. = '" + name4xpath + "']]/link")[0].content
-				return (uri, label)
-			# try again with a stop appended.
-			elif int(ctxt.xpathEval("count(//title[. = '" + name4xpath + "." + "'])")) == 1:
-				# (re. above magic: if count of titles with exactly our name is 1) 
-				label = ctxt.xpathEval("//title[. = '" + name4xpath + "." + "']")[0].content
-				uri = ctxt.xpathEval("//item[title[. = '" + name4xpath + "." + "']]/link")[0].content
-				return (uri, label)
-			else:
-				# We make a list of (uri, authform ) two-tuples that the 
-				# exception can report.
-				msg = "Multiple matches for " + name + "\n"
-				items = []
-				for item in ctxt.xpathEval("//item"):
-					uri = ""
-					authform = ""
-					for child in item.children:
-						if child.type == "element":
-							if child.name == "title":
-								authform = child.content 
-							elif child.name == "link":
-								uri = child.content
-							else: pass
-					items.append((uri, authform))
-				raise MultipleMatchesException(msg, name, type, items)
-		else:
-			raise Exception("Could not retrieve count (" + name + ")")
-	
- 	finally:
+		ctxt.xpathRegisterNs("opensearch", NAMESPACES["opensearch"])
+		total = ctxt.xpathEval("//opensearch:totalResults")
+		if not total:
+			raise LookupError("No totalResults in VIAF response")
+		items = []
+		for item in ctxt.xpathEval("//item"):
+			uri = ""
+			title = ""
+			child = item.children
+			while child != None:
+				if child.type == "element":
+					if child.name == "title": title = child.content
+					elif child.name == "link": uri = child.content
+				child = child.next
+			items.append((uri, title))
+		return int(total[0].content), items
+	finally:
 		# clean up!
 		if ctxt != None: ctxt.xpathFreeContext()
 		if doc != None: doc.freeDoc()
@@ -258,7 +288,7 @@ def query_lc(subject):
 	"""
 	to_get = ID_SUBJECT_RESOLVER + subject
 	headers = {"Accept":"application/xml"}
-	resp = requests.get(to_get, headers=headers, allow_redirects=True)
+	resp = client.get(to_get, headers=headers, allow_redirects=True)
 	if resp.status_code == 200:
 		uri = resp.headers["x-uri"]
 		label = resp.headers["x-preflabel"]
@@ -271,58 +301,218 @@ def query_lc(subject):
 		msg += resp.status_code + os.linesep
 		raise UnexpectedResponseException(msg)
 
+#===============================================================================
+# _heading_type
+#===============================================================================
+def _heading_type(node):
+	"""
+	@param node: a subject, persname, corpname or famname node
+	@return: Heading.SUBJECT, Heading.CORPORATE or Heading.PERSONAL
+	"""
+	element_name = node.get_name()
+	if element_name == Heading.SUBJECT: return Heading.SUBJECT
+	return Heading.pers_or_corp_from_node(node)
+
+def _source_for(heading_type):
+	if heading_type == Heading.SUBJECT: return ID_SUBJECT_RESOLVER
+	return "viaf.org"
+
+VOCABULARIES = {
+	Heading.SUBJECT: cache.LCSH,
+	Heading.PERSONAL: cache.VIAF_PERSONAL,
+	Heading.CORPORATE: cache.VIAF_CORPORATE
+}
+"""Heading type -> the vocabulary it is cached under"""
+
+#===============================================================================
+# _fetch_heading
+#===============================================================================
+def _fetch_heading(heading, heading_type, index=None):
+	"""
+	@param heading: a normalized heading
+	@param heading_type: Heading.SUBJECT (looked up at id.loc.gov), or 
+	Heading.PERSONAL or Heading.CORPORATE (looked up in VIAF)
+	@param index: an lcindex.LocalIndex to try before id.loc.gov
+	@return: a Heading record for the cache, found or not
+
+	@raise UnexpectedResponseException: passed on from query_lc
+	@raise LookupError: when VIAF sends data we can't parse
+
+	@note: Never touches the cache, so it is safe to call from the 
+	resolver's worker threads.
+	"""
+	record = Heading()
+	record.value = heading
+	record.type = heading_type
+	record.source = _source_for(heading_type)
+	try:
+		if heading_type == Heading.SUBJECT:
+			# try the local index of id.loc.gov labels before the network
+			entry = None
+			if index != None:
+				entry = index.lookup(heading)
+			if entry != None and entry.deprecated:
+				msg = "Not found (deprecated): " + heading + os.linesep
+				raise HeadingNotFoundException(msg, heading, Heading.SUBJECT)
+			elif entry != None:
+				uri, auth = entry.uri, entry.preflabel
+			else:
+				uri, auth = query_lc(heading)
+		else:
+			uri, auth = query_viaf(heading, heading_type)
+		record.found = True
+		record.alternatives = [(uri, auth)]
+	except HeadingNotFoundException, e:
+		record.found = False
+		record.alternatives = []
+	except MultipleMatchesException, m:
+		record.found = True
+		record.alternatives = m.items
+	return record
+
+#===============================================================================
+# _prefetch
+#===============================================================================
+def _collect(xpath, ctxt):
+	"""
+	@param xpath: the XPath for the headings to update (see _xpath)
+	@param ctxt: the XPath context for the document
+	@return: an OrderedDict of (normalized heading, vocabulary) -> 
+	(heading type, [nodes]), in the order the headings first come in the 
+	document; the keys are the cache's
+
+	@note: The document is scanned once, whatever mix of names and subjects
+	is asked for; each node is normalized once and the rest of the run works
+	on distinct headings.
+	"""
+	groups = OrderedDict()
+	normalizing = 0.0
+	nodes = ctxt.xpathEval(xpath)
+	for node in nodes:
+		heading_type = _heading_type(node)
+		vocabulary = VOCABULARIES[heading_type]
+		start = time()
+		if vocabulary == cache.LCSH:
+			# as mrc.py does; a label is a label at id.loc.gov
+			heading = normalize.lc_heading(node.content)
+		else:
+			heading = _normalize_heading(node.content)
+		normalizing += time() - start
+		key = (heading, vocabulary)
+		group = groups.get(key)
+		if group is None:
+			group = groups[key] = (heading_type, [])
+		group[1].append(node)
+	metrics.add_time("normalize", normalizing, len(nodes))
+	return groups
+
+def _prefetch(groups, shelf, workers=resolver.WORKERS, verbose=False, ignore_cache=False, index=None):
+	"""
+	@param groups: the document's headings, from _collect
+	@param shelf: the cache
+	@param index: an lcindex.LocalIndex to try before id.loc.gov
+	@return: a 3-tuple (distinct headings, occurrences, headings looked up)
+
+	@note: Resolves each distinct heading that isn't in the cache exactly 
+	once, most frequent first and concurrently. Results go into the cache, 
+	so _update_headings then finds them there.
+	"""
+	occurrences = sum(len(nodes) for heading_type, nodes in groups.itervalues())
+	by_count = sorted(groups, key=lambda k: len(groups[k][1]), reverse=True)
+	misses = [k for k in by_count if ignore_cache or k not in shelf]
+	metrics.incr("prefetch.distinct", len(groups))
+	metrics.incr("prefetch.miss", len(misses))
+	metrics.incr("cache.hit", len(groups) - len(misses))
+	metrics.incr("cache.miss", len(misses))
+	fetch = lambda key: _fetch_heading(key[0], groups[key][0], index)
+	for key, record, error in resolver.resolve(misses, fetch, workers):
+		if error is not None:
+			metrics.incr("lookup.error")
+			os.sys.stderr.write(str(error))
+			continue
+		if verbose:
+			if record.found == True: os.sys.stdout.write("Found: " + key[0] + "\n")
+			else: os.sys.stderr.write("Not found: " + key[0] + "\n")
+		shelf[key] = record
+	return len(groups), occurrences, len(misses)
+
+#===============================================================================
+# _refresh_stale
+#===============================================================================
+def _refresh_stale(shelf, workers=resolver.WORKERS, verbose=False, index=None):
+	"""
+	@param shelf: the cache
+	@param index: an lcindex.LocalIndex to try before id.loc.gov
+	@return: a 2-tuple (expired headings, headings refreshed)
+
+	@note: Looks up again only the headings whose TTL has passed (see 
+	cache.py), each in the service it came from: VIAF names, and subjects 
+	at id.loc.gov's subject headings. A heading that can't be looked up 
+	keeps its old entry and is tried again next time.
+	"""
+	types = {}
+	for heading_type, vocabulary in VOCABULARIES.items():
+		for key, record in shelf.stale(vocabulary):
+			types[key] = heading_type
+	fetch = lambda key: _fetch_heading(key[0], types[key], index)
+	refreshed = 0
+	for key, record, error in resolver.resolve(list(types), fetch, workers):
+		if error is not None:
+			metrics.incr("lookup.error")
+			os.sys.stderr.write(str(error))
+			continue
+		if verbose:
+			if record.found == True: os.sys.stdout.write("Refreshed: " + key[0] + "\n")
+			else: os.sys.stderr.write("Refreshed, not found: " + key[0] + "\n")
+		shelf[key] = record
+		refreshed += 1
+	metrics.incr("refresh.stale", len(types))
+	metrics.incr("refresh.done", refreshed)
+	return len(types), refreshed
+
 #===============================================================================
 # update_headings
 #===============================================================================
-def _update_headings(xpath, ctxt, shelf, annotate=False, verbose=False):
-	for node in ctxt.xpathEval(xpath):
+def _update_headings(groups, shelf, annotate=False, verbose=False, index=None, ignore_cache=False, log=False):
+	"""
+	@param groups: the document's headings, from _collect
+
+	@note: Each distinct heading is looked up (in the cache) once and the
+	result applied to every node that has it.
+	"""
+	for key, (heading_type, nodes) in groups.iteritems():
+		heading = key[0]
 		try:
-			heading = _normalize_heading(node.content)
-			
-			element_name = node.get_name()
-			heading_type = ""
-			if element_name == Heading.SUBJECT: heading_type = Heading.SUBJECT
-			elif element_name == "corpname":  heading_type = Heading.CORPORATE
-			else: heading_type == Heading.PERSONAL
-				
 			# Check the shelf right off
-			if ignore_cache==False and heading in shelf:
-				cached = shelf[heading]
-				if len(cached.alternatives) == 1:
-					# we only get here if no exceptions above 
-					if verbose:	os.sys.stdout.write("[Cache] Found: " + heading + "\n") 
-					uri = cached.alternatives[0][0]
-					node.setProp("authfilenumber", uri)
-				elif len(cached.alternatives) > 1:
-					msg = "[Cache] Multiple matches for " + heading + "\n"
-					raise MultipleMatchesException(msg, heading, heading_type, cached.alternatives)
-				else: # 0 
-					msg = "[Cache] Not found: " + heading + "\n"
-					raise HeadingNotFoundException(msg, heading, heading_type)
+			if ignore_cache==False and key in shelf:
+				cached = shelf[key]
+				where = "[Cache] "
 			else:
-				if heading_type == Heading.SUBJECT:
-					uri, auth = query_lc(heading)
-					# we only get here if no exceptions above 
-					if verbose:	os.sys.stdout.write("Found: " + heading + "\n")
-					node.setProp("authfilenumber", uri)
-					
-				else:
-					uri, auth = query_viaf(heading, Heading.pers_or_corp_from_node(node))
-					# we only get here if no exceptions above 
-					if verbose:	os.sys.stdout.write("Found: " + heading + "\n")
-					node.setProp("authfilenumber", uri)
-
-				# we put the heading we found in the db
-				record = Heading()
-				record.value = heading
-				record.type = type
-				record.found = True
-				record.alternatives = [(uri, auth)]
-				shelf[heading] = record
+				# (hits and misses are counted, once per heading, by _prefetch;
+				# this is one it didn't resolve)
+				cached = _fetch_heading(heading, heading_type, index)
+				where = ""
+				metrics.incr("cache.late_miss")
+				# we put the heading in the db, found or not
+				shelf[key] = cached
 
-				node.setProp("authfilenumber", uri)
-				
-				sleep(1) # A courtesy to the services.
+			# (mrc.py caches a deprecated LC heading as not found, with what 
+			# to use instead as its one alternative)
+			if cached.found == True and len(cached.alternatives) == 1:
+				# we only get here if no exceptions above 
+				metrics.incr("heading.found", len(nodes))
+				if verbose:	os.sys.stdout.write(where + "Found: " + heading + "\n") 
+				uri = cached.alternatives[0][0]
+				for node in nodes:
+					node.setProp("authfilenumber", uri)
+			elif len(cached.alternatives) > 1:
+				metrics.incr("heading.multiple", len(nodes))
+				msg = where + "Multiple matches for " + heading + "\n"
+				raise MultipleMatchesException(msg, heading, heading_type, cached.alternatives)
+			else: # 0 
+				metrics.incr("heading.not_found", len(nodes))
+				msg = where + "Not found: " + heading + "\n"
+				raise HeadingNotFoundException(msg, heading, heading_type)
 
 		except UnexpectedResponseException, e:
 			os.sys.stderr.write(str(e))
@@ -330,14 +520,6 @@ def _update_headings(xpath, ctxt, shelf, annotate=False, verbose=False):
 		except HeadingNotFoundException, e:
 			if verbose:
 				os.sys.stderr.write(str(e))
-			if not heading in shelf:
-				# We still want to put this in the db
-				record = Heading()
-				record.value = e.heading
-				record.type = e.type
-				record.found = False
-				record.alternatives = []
-				shelf[heading] = record
 		
 		except MultipleMatchesException, m:
 			if verbose:
@@ -349,8 +531,9 @@ def _update_headings(xpath, ctxt, shelf, annotate=False, verbose=False):
 					# the doc stays well-formed
 					content += alt[0].replace("--", "-\-") + " : " + \
 					alt[1].replace("--", "-\-") + os.linesep 
-				comment = libxml2.newComment(content)
-				node.addNextSibling(comment)
+				for node in nodes:
+					comment = libxml2.newComment(content)
+					node.addNextSibling(comment)
 			if log: # TODO: test this
 				logging.basicConfig(filename=LOG_FILENAME,level=logging.INFO,format=LOG_FORMAT)
 				content = os.linesep + "Possible URIs:" + os.linesep
@@ -358,14 +541,6 @@ def _update_headings(xpath, ctxt, shelf, annotate=False, verbose=False):
 					content += alt[0].replace("--", "-\-") + " : " + \
 					alt[1].replace("--", "-\-") + os.linesep 
 				logging.info(content)
-			if not heading in shelf:
-				# We still want to put this in the db
-				record = Heading()
-				record.value = m.heading
-				record.type = m.type
-				record.found = True
-				record.alternatives = m.items
-				shelf[heading] = record
 
 		except LookupError, e:
 			record = Heading()
@@ -373,13 +548,160 @@ def _update_headings(xpath, ctxt, shelf, annotate=False, verbose=False):
 			record.type = heading_type
 			record.found = True
 			record.alternatives = []
-			shelf[heading] = record
+			record.source = _source_for(heading_type)
+			shelf[key] = record
 			e.message = "Error: " + e.message + "\nThis is related to VIAF " + \
 			" sending data for\n\"" + heading + "\"\nthat we can't parse." +\
 			"\nThis has been been noted in the cache and this\nheading will" +\
 			" ignored in the future.\nRun again.\n"
 			raise e
 		
+#===============================================================================
+# _xpath
+#===============================================================================
+def _xpath(names=False, subjects=False, recursive=False):
+	"""
+	@return: one XPath for all the headings to update
+	"""
+	if recursive:
+		if names and subjects: return XPaths.HEADINGS_RECURSIVE
+		if names: return XPaths.NAMES_RECURSIVE
+		return XPaths.SUBJECTS_RECURSIVE
+	xpaths = []
+	if subjects: xpaths.append(XPaths.SUBJECTS)
+	if names: xpaths.append(XPaths.NAMES)
+	return "|".join(xpaths)
+
+#===============================================================================
+# enrich
+#===============================================================================
+def enrich(path, outpath, shelf, xpath, index=None, workers=resolver.WORKERS, annotate=False, verbose=False, ignore_cache=False, log=False, prefetch_only=False):
+	"""
+	@param path: the EAD file
+	@param outpath: where to write the enriched file; stdout if None
+	@param shelf: the cache
+	@param xpath: the headings to update (see _xpath)
+	@param index: an lcindex.LocalIndex to try before id.loc.gov
+	@return: a 3-tuple (distinct headings, occurrences, headings looked up)
+
+	@raise libxml2.parserError: when the file can't be parsed
+	"""
+	doc = None
+	try:
+		doc = libxml2.parseFile(path)
+		stats = enrich_doc(doc, shelf, xpath, index=index, workers=workers, annotate=annotate, verbose=verbose, ignore_cache=ignore_cache, log=log, prefetch_only=prefetch_only)
+		if not prefetch_only:
+			with metrics.timer("serialize"):
+				if outpath == None:
+					os.sys.stdout.write(doc.serialize("UTF-8", 1))
+				else:
+					doc.saveFormatFileEnc(outpath, "UTF-8", 1)
+		return stats
+	finally:
+		# clean up!
+		if doc != None: doc.freeDoc()
+
+def enrich_doc(doc, shelf, xpath, index=None, workers=resolver.WORKERS, annotate=False, verbose=False, ignore_cache=False, log=False, prefetch_only=False, prefetch=_prefetch):
+	"""
+	@param doc: a parsed EAD document (libxml2), updated in place
+	@param shelf: the cache
+	@param xpath: the headings to update (see _xpath)
+	@param index: an lcindex.LocalIndex to try before id.loc.gov
+	@param prefetch: resolves the document's headings into the cache; takes
+	the same arguments as _prefetch
+	@return: a 3-tuple (distinct headings, occurrences, headings looked up)
+
+	@note: For documents that don't come from a file, e.g. in service.py;
+	serializing (and freeing) the document is left to the caller.
+	"""
+	ctxt = doc.xpathNewContext()
+	try:
+		for ns in NAMESPACES.keys():
+			ctxt.xpathRegisterNs(ns, NAMESPACES[ns])
+
+		# one pass over the document, then resolve each distinct heading that
+		# isn't cached once, up front
+		with metrics.timer("prefetch"):
+			groups = _collect(xpath, ctxt)
+			stats = prefetch(groups, shelf, workers=workers, verbose=verbose, ignore_cache=ignore_cache, index=index)
+		if not prefetch_only:
+			# the prefetch already refreshed the cache
+			_update_headings(groups, shelf, annotate=annotate, verbose=verbose, index=index, log=log)
+		metrics.incr("records")
+		return stats
+	finally:
+		ctxt.xpathFreeContext()
+
+#===============================================================================
+# Batch mode
+#===============================================================================
+def _expand(inputs):
+	"""
+	@param inputs: files, directories (every *.xml in them) or glob patterns
+	@return: the EAD files, in order, without duplicates
+	"""
+	paths = []
+	for i in inputs:
+		if os.path.isdir(i): found = sorted(glob(os.path.join(i, "*.xml")))
+		elif os.path.isfile(i): found = [i]
+		else: found = sorted(glob(i))
+		for path in found:
+			if path not in paths:
+				paths.append(path)
+	return paths
+
+_worker = {}
+"""Per-process state for batch workers: the cache, the index and options"""
+
+def _init_worker(buckets, lcindex_path, options):
+	ratelimit.install(buckets)
+	_worker["shelf"] = cache.open_cache(CACHE_FILE)
+	_worker["index"] = None
+	if lcindex_path and os.path.isfile(lcindex_path):
+		_worker["index"] = lcindex.LocalIndex(lcindex_path)
+	_worker["options"] = options
+
+def _enrich_one(path):
+	"""
+	@return: a 5-tuple (path, seconds, stats, error, metrics); error is None 
+	if all went well, metrics is this file's metrics.summary()
+	"""
+	metrics.reset()
+	start = time()
+	outpath = os.path.join(OUTDIR, os.path.basename(path))
+	error = None
+	stats = (0, 0, 0)
+	try:
+		stats = enrich(path, outpath, _worker["shelf"], index=_worker["index"], **_worker["options"])
+	except Exception, e:
+		error = str(e).strip() or e.__class__.__name__
+	finally:
+		# other workers should see what we found straight away
+		_worker["shelf"].flush()
+	return path, time() - start, stats, error, metrics.summary()
+
+def run_batch(paths, jobs, lcindex_path=None, **options):
+	"""
+	@param paths: the EAD files
+	@param jobs: the number of worker processes
+	@param lcindex_path: the local index file, if any
+	@param options: passed on to enrich (xpath, workers, annotate, etc.)
+	@return: a generator of (path, seconds, stats, error) 4-tuples, in the 
+	order the files finish. Enriched files go to OUTDIR under their own names.
+
+	@note: The workers share the SQLite cache (each has its own connection)
+	and one set of rate limits, so the services see one polite client.
+	Each file's metrics are merged into this process's.
+	"""
+	pool = multiprocessing.Pool(max(1, jobs), _init_worker, (ratelimit.shared_buckets(), lcindex_path, options))
+	try:
+		for result in pool.imap_unordered(_enrich_one, paths):
+			metrics.merge(result[4])
+			yield result[:4]
+	finally:
+		pool.close()
+		pool.join()
+
 class CLI(object):
 	EX_OK = 0
 	"""All good"""
@@ -450,11 +772,35 @@ class CLI(object):
 		
 		lHelp = "Log alternatives.\n"
 		
+		iHelp = "Local index of id.loc.gov labels (see lcindex.py). " + \
+			"Headings are looked up there first, and only the misses go to " + \
+			"the network. Ignored if the file doesn't exist."
+		
+		wHelp = "Number of worker threads used to look up headings that " + \
+			"aren't in the cache."
+		
+		pHelp = "Only look up the headings that aren't in the cache (warm " + \
+			"the cache); don't write the document."
+		
+		jHelp = "Number of worker processes in batch mode."
+		
+		profileHelp = "Run under cProfile; the stats are dumped to " + \
+			LOGDIR + " and the slowest calls printed to stderr. In batch " + \
+			"mode only the parent process is profiled."
+		
+		refreshHelp = "Look up again every cached heading whose TTL has " + \
+			"passed (see the [Cache] section of the config file), then exit. " + \
+			"No EAD file needed."
+		
+		recHelp = "The EAD file. Give several files, a directory or a glob " + \
+			"for batch mode: each file is written to " + OUTDIR + " under " + \
+			"its own name and a summary is printed."
+		
 		cfgHelp = "Specify the config file. Defaults can be overridden. " + \
 			"At minimum, run e.g.: python addauths.py myfile.ead.xml"
 					
 		conf_parser = ArgumentParser(add_help=False, description=desc)
-		conf_parser.add_argument("-c", "--conf_file", default="addauths.cfg",required=False, dest="conf_file", help=cfgHelp)
+		conf_parser.add_argument("-c", "--conf_file", default=CONFIG,required=False, dest="conf_file", help=cfgHelp)
 		args, remaining_argv = conf_parser.parse_known_args()
 		defaults = {
 			"outpath": None,
@@ -465,19 +811,38 @@ class CLI(object):
 			"verbose" : False,
 			"ignore_cache" : False,
 			"record": None,
-			"log" : False
+			"log" : False,
+			"workers" : resolver.WORKERS,
+			"prefetch_only" : False,
+			"lcindex" : lcindex.INDEX_FILE
 		}
 		# if -c or --conf_file, override the defaults above
 		if args.conf_file:
 			config = ConfigParser.SafeConfigParser()
 			config.read([args.conf_file])
-			cfgdict = dict(config.items('Paths')) # Paths section of config file
-			booldict = dict(config.items('Booleans')) # Booleans section of config file
-			for k,v in booldict.iteritems():
-				# need to get the booleans as booleans, not as 'strings'
-				boo = config.getboolean('Booleans',k)
-				cfgdict[k]=boo
+			# (a missing file, or section, leaves the defaults above)
+			cfgdict = dict(defaults)
+			if config.has_section('Paths'):
+				cfgdict.update(config.items('Paths')) # Paths section of config file
+			if config.has_section('Booleans'):
+				booldict = dict(config.items('Booleans')) # Booleans section of config file
+				for k,v in booldict.iteritems():
+					# need to get the booleans as booleans, not as 'strings'
+					boo = config.getboolean('Booleans',k)
+					cfgdict[k]=boo
+			# Resolver section of config file: worker threads
+			cfgdict['workers'] = resolver.WORKERS
+			cfgdict['prefetch_only'] = False
+			cfgdict['profile'] = False
+			cfgdict['refresh_stale'] = False
+			if config.has_option('Resolver','workers'):
+				cfgdict['workers'] = max(1, config.getint('Resolver','workers'))
 			defaults = cfgdict
+			# HTTP section of config file: connection pool size, timeout, keep-alive
+			client.configure_from(config)
+			# RateLimits section of config file: requests per second and burst, per host
+			ratelimit.configure_from(config)
+			cache.configure_from(config)
 			
 		parser = ArgumentParser(parents=[conf_parser],description=desc,formatter_class=RawDescriptionHelpFormatter,epilog=epi)
 		parser.set_defaults(**defaults)
@@ -489,21 +854,29 @@ class CLI(object):
 		parser.add_argument("-v", "--verbose", required=False, dest="verbose", action="store_true", help=vHelp)
 		parser.add_argument("-C", "--ignore-cache",required=False, dest="ignore_cache", action="store_true", help=cHelp)
 		parser.add_argument("-l", "--log",required=False, dest="log", action="store_true", help=lHelp)
-		parser.add_argument("record")
+		parser.add_argument("-i", "--index",required=False, dest="lcindex", help=iHelp)
+		parser.add_argument("-w", "--workers",required=False, dest="workers", type=int, help=wHelp)
+		parser.add_argument("-P", "--prefetch-only",required=False, dest="prefetch_only", action="store_true", help=pHelp)
+		parser.add_argument("-j", "--jobs",required=False, dest="jobs", type=int, default=multiprocessing.cpu_count(), help=jHelp)
+		parser.add_argument("--profile",required=False, dest="profile", action="store_true", help=profileHelp)
+		parser.add_argument("--refresh-stale",required=False, dest="refresh_stale", action="store_true", help=refreshHelp)
+		parser.add_argument("record", nargs="*", help=recHelp)
 		args = parser.parse_args(remaining_argv)
 		print(args)
 		#=======================================================================
 		# Checks on our args and options. We can exit before we do any work.
 		#=======================================================================
-		if not os.path.exists(args.record):
-			os.sys.stderr.write("File " + args.record + " does not exist\n")
-			exit(CLI.EX_NO_INPUT)
-			
-		if args.record == None:
+		if not args.record and not args.refresh_stale:
 			os.sys.stderr.write("No input file supplied. See --help for usage\n")
 			exit(CLI.EX_WRONG_USAGE)
+
+		paths = _expand(args.record)
+		batch = len(paths) > 1 or (len(paths) > 0 and os.path.isdir(args.record[0]))
+		if not paths and not args.refresh_stale:
+			os.sys.stderr.write("File " + " ".join(args.record) + " does not exist\n")
+			exit(CLI.EX_NO_INPUT)
 	
-		if not args.names and not args.subjects:
+		if not args.names and not args.subjects and not args.refresh_stale:
 			msg = "Supply -n and or -s to link headings. Use --help " + \
 			"for more details.\n"
 			os.sys.stderr.write(msg)
@@ -524,27 +897,46 @@ class CLI(object):
 		#=======================================================================
 		# The work...
 		#=======================================================================
-		shelf = shelve.open(SHELF_FILE, protocol=pickle.HIGHEST_PROTOCOL)
-		doc = None
-		ctxt = None
+		run = metrics.new_run(JOB_LOG)
+		started = time()
+		profiler = None
+		if args.profile:
+			profiler = metrics.start_profile()
+		xpath = _xpath(args.names, args.subjects, args.recursive)
+		options = {'workers':args.workers, 'annotate':args.annotate, 'verbose':args.verbose, 'ignore_cache':args.ignore_cache, 'log':args.log, 'prefetch_only':args.prefetch_only}
+		shelf = cache.open_cache(CACHE_FILE, legacy=[SHELF_FILE, OLD_CACHE_FILE])
+		if batch and not args.refresh_stale:
+			# the workers open their own connections to the cache
+			shelf.close()
+			status = CLI.EX_OK
+			totals = [0, 0, 0]
+			os.sys.stdout.write("file\tseconds\tdistinct\toccurrences\tlooked up\tstatus\n")
+			start = time()
+			for path, seconds, stats, error in run_batch(paths, args.jobs, args.lcindex, xpath=xpath, **options):
+				os.sys.stdout.write("%s\t%.2f\t%d\t%d\t%d\t%s\n" % ((path, seconds) + stats + (error or "ok",)))
+				totals = [t + n for t, n in zip(totals, stats)]
+				if error != None:
+					status = CLI.EX_DATA_ERR
+			os.sys.stdout.write("%d files\t%.2f\t%d\t%d\t%d\n" % tuple([len(paths), time() - start] + totals))
+			if profiler != None:
+				metrics.stop_profile(profiler, LOGDIR + "ead_" + run + ".prof", os.sys.stderr)
+			metrics.add_time("total", time() - started)
+			metrics.write(JOB_LOG, run, tool="ead", input=args.record, status=status)
+			exit(status)
+
+		index = None
+		if args.lcindex and os.path.isfile(args.lcindex):
+			index = lcindex.LocalIndex(args.lcindex)
 		try:
-			doc = libxml2.parseFile(args.record)
-			ctxt = doc.xpathNewContext()
-			for ns in NAMESPACES.keys():
-				ctxt.xpathRegisterNs(ns, NAMESPACES[ns])
-
-			if args.subjects:
-				if args.recursive: xpath = XPaths.SUBJECTS_RECURSIVE
-				else: xpath = XPaths.SUBJECTS	
-				_update_headings(xpath, ctxt, shelf, annotate=args.annotate, verbose=args.verbose)
-			if args.names:
-				if args.recursive: xpath = XPaths.NAMES_RECURSIVE
-				else: xpath = XPaths.NAMES	
-				_update_headings(xpath, ctxt, shelf, annotate=args.annotate, verbose=args.verbose)
-			if args.outpath == None:
-				os.sys.stdout.write(doc.serialize("UTF-8", 1))
+			if args.refresh_stale:
+				# just bring the expired part of the cache up to date
+				with metrics.timer("refresh"):
+					stats = _refresh_stale(shelf, workers=args.workers, verbose=args.verbose, index=index)
+				os.sys.stderr.write("%d expired headings; refreshed %d\n" % stats)
 			else:
-				doc.saveFormatFileEnc(args.outpath, "UTF-8", 1)
+				stats = enrich(paths[0], args.outpath, shelf, xpath, index=index, **options)
+				if args.prefetch_only:
+					os.sys.stderr.write("%d distinct headings (%d occurrences); looked up %d\n" % stats)
 			# if we got here...
 			status = CLI.EX_OK
 
@@ -569,10 +961,13 @@ class CLI(object):
 		
 		finally:
 			# clean up!	
-			subprocess.Popen(['xmllint','--format','-o', args.outpath,'tmp.xml'])
 			shelf.close()
-			if ctxt != None: ctxt.xpathFreeContext()
-			if doc != None: doc.freeDoc()
+			client.close()
+			if index != None: index.close()
+			if profiler != None:
+				metrics.stop_profile(profiler, LOGDIR + "ead_" + run + ".prof", os.sys.stderr)
+			metrics.add_time("total", time() - started)
+			metrics.write(JOB_LOG, run, tool="ead", input=args.record, status=status)
 			exit(status)
 		 
 
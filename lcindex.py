@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Offline index of id.loc.gov labels, built from the LC Names and Subjects bulk
+downloads (MADS/RDF or SKOS). Maps each authoritative label to its URI and
+preferred label, and notes deprecated headings and what to use instead, so
+that mrc.py and ead.py can resolve most headings without the network.
+
+N-Triples dumps (.nt, optionally gzipped) are streamed line by line; anything
+else is handed to rdflib.
+
+Usage:
+	python lcindex.py import [-o INDEX] DUMP [DUMP ...]
+	python lcindex.py lookup [-o INDEX] LABEL
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import gzip
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+INDEX_FILE = "./db/lcindex.sqlite"
+
+MADS = "http://www.loc.gov/mads/rdf/v1#"
+SKOS = "http://www.w3.org/2004/02/skos/core#"
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+LABELS = (MADS + "authoritativeLabel", SKOS + "prefLabel", MADS + "deprecatedLabel")
+"""Predicates whose literal is the heading's label"""
+INSTEAD = (MADS + "useInstead", "http://purl.org/dc/terms/isReplacedBy")
+"""Predicates pointing from a deprecated heading to its replacement"""
+DEPRECATED_TYPE = MADS + "DeprecatedAuthority"
+
+URI_PREFIX = "http://id.loc.gov/authorities/"
+"""Only subjects under this prefix are indexed"""
+
+BATCH_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS labels (
+	label TEXT PRIMARY KEY COLLATE NOCASE,
+	uri TEXT NOT NULL,
+	preflabel TEXT NOT NULL,
+	deprecated INTEGER NOT NULL DEFAULT 0,
+	instead_uri TEXT,
+	instead_label TEXT
+);
+CREATE TEMP TABLE IF NOT EXISTS stage_labels (uri TEXT, label TEXT);
+CREATE TEMP TABLE IF NOT EXISTS stage_deprecated (uri TEXT PRIMARY KEY);
+CREATE TEMP TABLE IF NOT EXISTS stage_instead (uri TEXT PRIMARY KEY, instead TEXT);
+"""
+
+# <s> <p> <o> . | <s> <p> "literal"@lang . | <s> <p> "literal"^^<type> .
+_TRIPLE = re.compile(r'^<([^>]*)>\s+<([^>]*)>\s+(?:<([^>]*)>|"((?:[^"\\]|\\.)*)"(?:@[\w-]+|\^\^<[^>]*>)?)\s*\.\s*$')
+_ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+_SIMPLE = {'t': u'\t', 'b': u'\b', 'n': u'\n', 'r': u'\r', 'f': u'\f', '"': u'"', "'": u"'", '\\': u'\\'}
+
+#===============================================================================
+# Entry
+#===============================================================================
+class Entry(object):
+	def __init__(self, uri, preflabel, deprecated=False, instead=None):
+		self.uri = uri
+		"""The id.loc.gov URI"""
+		self.preflabel = preflabel
+		"""The authoritative label, as LC has it"""
+		self.deprecated = deprecated
+		"""True if the heading has been deprecated"""
+		self.instead = instead
+		"""A 2-tuple (uri, label) to use instead, for deprecated headings"""
+
+#===============================================================================
+# LocalIndex
+#===============================================================================
+class LocalIndex(object):
+	"""
+	Read access to an index built by build_index. Safe to share between the
+	resolver's threads (each gets its own connection; close() closes them
+	all).
+	"""
+	def __init__(self, path=INDEX_FILE):
+		if not os.path.isfile(path):
+			raise IOError("No local index at " + path)
+		self.path = path
+		self._local = threading.local()
+		self._conns = []
+		"""Every thread's connection, for close()"""
+		self._lock = threading.Lock()
+
+	def _conn(self):
+		conn = getattr(self._local, "conn", None)
+		if conn is None:
+			conn = sqlite3.connect(self.path, check_same_thread=False)
+			conn.text_factory = str
+			self._local.conn = conn
+			with self._lock:
+				self._conns.append(conn)
+		return conn
+
+	def lookup(self, label):
+		"""
+		@param label: a normalized heading
+		@return: an Entry, or None if the label isn't in the index
+		"""
+		row = self._conn().execute("SELECT uri, preflabel, deprecated, instead_uri, instead_label FROM labels WHERE label = ?", (label,)).fetchone()
+		if row is None:
+			return None
+		instead = None
+		if row[3]:
+			instead = (row[3], row[4] or "")
+		return Entry(row[0], row[1], bool(row[2]), instead)
+
+	def close(self):
+		"""
+		@note: Closes the connection of every thread that has used the index,
+		not just this one's; a lookup after this opens a new one.
+		"""
+		with self._lock:
+			for conn in self._conns:
+				conn.close()
+			self._conns = []
+			self._local = threading.local()
+
+#===============================================================================
+# _unescape
+#===============================================================================
+def _unescape_one(m):
+	esc = m.group(1)
+	if esc[0] in "uU":
+		return unichr(int(esc[1:], 16))
+	return _SIMPLE.get(esc, esc)
+
+def _unescape(literal):
+	return _ESCAPE.sub(_unescape_one, literal)
+
+#===============================================================================
+# iter_ntriples
+#===============================================================================
+def iter_ntriples(path):
+	"""
+	@param path: an N-Triples file, gzipped if it ends in .gz
+	@return: a generator of (subject, predicate, object, is_literal) 4-tuples,
+	as unicode. Lines that aren't simple URI-subject triples are skipped.
+	"""
+	if path.endswith(".gz"): fh = gzip.open(path, "rb")
+	else: fh = open(path, "rb")
+	try:
+		for line in fh:
+			m = _TRIPLE.match(line.decode("utf-8", "replace"))
+			if m is None:
+				continue
+			s, p, o_uri, o_lit = m.groups()
+			if o_uri is not None:
+				yield s, p, o_uri, False
+			else:
+				yield s, p, _unescape(o_lit), True
+	finally:
+		fh.close()
+
+#===============================================================================
+# iter_rdflib
+#===============================================================================
+def iter_rdflib(path):
+	"""
+	@param path: any RDF file rdflib can guess the format of (RDF/XML, Turtle)
+	@return: a generator like iter_ntriples
+
+	@note: rdflib loads the whole graph, so prefer N-Triples for the big dumps.
+	"""
+	import rdflib
+	graph = rdflib.Graph()
+	graph.parse(path, format=rdflib.util.guess_format(path))
+	for s, p, o in graph:
+		if not isinstance(s, rdflib.URIRef):
+			continue
+		yield unicode(s), unicode(p), unicode(o), isinstance(o, rdflib.Literal)
+
+#===============================================================================
+# build_index
+#===============================================================================
+def build_index(dumps, path=INDEX_FILE, verbose=False):
+	"""
+	@param dumps: paths to the bulk download files
+	@param path: the index file; existing labels are kept unless a dump
+	has them too
+	@return: the number of labels in the index
+
+	@note: Triples are staged in temp tables and joined at the end, since
+	a heading's label, type and replacement needn't be on adjacent lines.
+	Where a live and a deprecated heading share a label, the live one wins.
+	"""
+	conn = sqlite3.connect(path)
+	conn.execute("PRAGMA journal_mode=WAL")
+	conn.execute("PRAGMA synchronous=OFF")
+	conn.executescript(SCHEMA)
+	labels, deprecated, instead = [], [], []
+
+	def stage():
+		conn.executemany("INSERT INTO stage_labels VALUES (?, ?)", labels)
+		conn.executemany("INSERT OR IGNORE INTO stage_deprecated VALUES (?)", deprecated)
+		conn.executemany("INSERT OR REPLACE INTO stage_instead VALUES (?, ?)", instead)
+		conn.commit()
+		del labels[:], deprecated[:], instead[:]
+
+	for dump in dumps:
+		if verbose: sys.stderr.write("Reading " + dump + "\n")
+		if re.search(r"\.nt(\.gz)?$", dump): triples = iter_ntriples(dump)
+		else: triples = iter_rdflib(dump)
+		for s, p, o, is_literal in triples:
+			if not s.startswith(URI_PREFIX):
+				continue
+			if p in LABELS and is_literal:
+				labels.append((s, o))
+			elif p == RDF_TYPE and o == DEPRECATED_TYPE:
+				deprecated.append((s,))
+			elif p in INSTEAD and not is_literal:
+				instead.append((s, o))
+			else:
+				continue
+			if len(labels) + len(deprecated) + len(instead) >= BATCH_SIZE:
+				stage()
+	stage()
+
+	conn.execute("CREATE INDEX IF NOT EXISTS temp.stage_labels_uri ON stage_labels (uri)")
+	conn.execute("""
+		INSERT OR REPLACE INTO labels (label, uri, preflabel, deprecated, instead_uri, instead_label)
+		SELECT l.label, l.uri, l.label, d.uri IS NOT NULL, i.instead,
+			(SELECT label FROM stage_labels WHERE uri = i.instead LIMIT 1)
+		FROM stage_labels l
+		LEFT JOIN stage_deprecated d ON d.uri = l.uri
+		LEFT JOIN stage_instead i ON i.uri = l.uri
+		ORDER BY d.uri IS NOT NULL DESC
+	""")
+	conn.commit()
+	count = conn.execute("SELECT COUNT(*) FROM labels").fetchone()[0]
+	conn.close()
+	return count
+
+#===============================================================================
+# main
+#===============================================================================
+def main(argv=None):
+	parser = ArgumentParser(description=__doc__.strip().split("\n\n")[0], formatter_class=RawDescriptionHelpFormatter)
+	sub = parser.add_subparsers(dest="command")
+	imp = sub.add_parser("import", help="Build (or add to) the index from bulk downloads.")
+	imp.add_argument("-o", "--index", default=INDEX_FILE, dest="index", help="The index file.")
+	imp.add_argument("-v", "--verbose", action="store_true", dest="verbose")
+	imp.add_argument("dumps", nargs="+", help="N-Triples (.nt, .nt.gz) or other RDF files.")
+	look = sub.add_parser("lookup", help="Look a label up in the index.")
+	look.add_argument("-o", "--index", default=INDEX_FILE, dest="index", help="The index file.")
+	look.add_argument("label")
+	args = parser.parse_args(argv)
+
+	if args.command == "import":
+		count = build_index(args.dumps, args.index, args.verbose)
+		sys.stdout.write("%d labels in %s\n" % (count, args.index))
+		return 0
+	index = LocalIndex(args.index)
+	entry = index.lookup(args.label)
+	if entry is None:
+		sys.stdout.write("Not found: " + args.label + "\n")
+		return 1
+	sys.stdout.write("%s\t%s%s\n" % (entry.uri, entry.preflabel, "\t(DEPRECATED)" if entry.deprecated else ""))
+	if entry.instead:
+		sys.stdout.write("Use instead: %s\t%s\n" % entry.instead)
+	return 0
+
+if __name__ == "__main__": sys.exit(main())
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Streaming MARC readers and writers for MARCXML, binary MARC (ISO 2709) and
+MARC-in-JSON. Records are parsed incrementally (lxml iterparse, one ISO 2709
+record or one JSON object at a time) and handed out one at a time as 
+pymarc.Records; each one is freed as soon as the next is read, so memory 
+stays flat whatever the file size.
+
+iter_records() and open_writer() pick the reader or writer for a format;
+detect_format() tells the formats apart from the first bytes of a file.
+
+pymarc (slow to import) is imported where records are made or written, so 
+that just importing this module, e.g. for mrc.py --help, stays cheap.
+"""
+from lxml import etree
+import io
+import json
+import os
+
+MARC_NS = "http://www.loc.gov/MARC21/slim"
+
+MRX_HEADER = """<?xml version="1.0" encoding="UTF-8" ?>
+<collection xmlns="http://www.loc.gov/MARC21/slim" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.loc.gov/MARC21/slim http://www.loc.gov/standards/marcxml/schema/MARC21slim.xsd">
+"""
+MRX_FOOTER = "</collection>\n"
+
+MRX = "mrx"
+MRC = "mrc"
+JSON = "json"
+FORMATS = (MRX, MRC, JSON)
+"""MARCXML, binary MARC (ISO 2709) and MARC-in-JSON"""
+EXTENSIONS = {".xml": MRX, ".mrx": MRX, ".mrc": MRC, ".marc": MRC, ".dat": MRC, ".json": JSON}
+
+CHUNK = 65536
+"""Characters read at a time when streaming MARC-in-JSON"""
+
+#===============================================================================
+# _localname
+#===============================================================================
+def _localname(elem):
+	tag = elem.tag
+	if isinstance(tag, basestring) and tag.startswith("{"):
+		return tag.split("}", 1)[1]
+	return tag
+
+def _text(elem):
+	text = elem.text or u""
+	if not isinstance(text, unicode):
+		text = text.decode("utf-8")
+	return text
+
+#===============================================================================
+# _to_record
+#===============================================================================
+def _to_record(elem):
+	"""
+	@param elem: a MARCXML <record> element
+	@return: a pymarc.Record
+	"""
+	import pymarc
+	rec = pymarc.Record()
+	for child in elem:
+		name = _localname(child)
+		if name == "leader":
+			rec.leader = _text(child)
+		elif name == "controlfield":
+			rec.add_field(pymarc.Field(tag=child.get("tag"), data=_text(child)))
+		elif name == "datafield":
+			subfields = []
+			for sub in child:
+				if _localname(sub) == "subfield":
+					subfields.append(sub.get("code"))
+					subfields.append(_text(sub))
+			rec.add_field(pymarc.Field(tag=child.get("tag"),
+				indicators=[child.get("ind1", " "), child.get("ind2", " ")],
+				subfields=subfields))
+	return rec
+
+#===============================================================================
+# iter_marcxml
+#===============================================================================
+def iter_marcxml(path):
+	"""
+	@param path: a MARCXML file (a <collection> or a single <record>)
+	@return: a generator of pymarc.Records, in file order
+
+	@raise etree.XMLSyntaxError: when the file isn't well-formed
+	"""
+	for event, elem in etree.iterparse(path, events=("end",), huge_tree=True):
+		if _localname(elem) != "record":
+			continue
+		yield _to_record(elem)
+		# drop the record, and anything before it, from the tree
+		elem.clear()
+		while elem.getprevious() is not None:
+			del elem.getparent()[0]
+
+#===============================================================================
+# MARCXMLWriter
+#===============================================================================
+class MARCXMLWriter(object):
+	"""
+	Writes records straight to a file handle as they come, pretty-printed,
+	inside a MARCXML <collection>.
+	"""
+	def __init__(self, fh, header=True):
+		"""
+		@param fh: a file (or file-like) object opened for writing bytes
+		@param header: False when appending to a collection that was
+		already started (e.g. resuming from a checkpoint)
+		"""
+		self.fh = fh
+		self._parser = etree.XMLParser(remove_blank_text=True)
+		if header:
+			self.fh.write(MRX_HEADER)
+
+	def write(self, rec):
+		"""
+		@param rec: a pymarc.Record
+		"""
+		import pymarc
+		node = etree.fromstring(pymarc.record_to_xml(rec), self._parser)
+		self.fh.write(etree.tostring(node, pretty_print=True, encoding="utf-8"))
+
+	def close(self):
+		"""
+		@note: Closes the collection; the file handle is left to the caller.
+		"""
+		self.fh.write(MRX_FOOTER)
+		self.fh.flush()
+
+#===============================================================================
+# iter_marc
+#===============================================================================
+def iter_marc(path):
+	"""
+	@param path: a binary MARC (ISO 2709) file
+	@return: a generator of pymarc.Records, in file order
+
+	@raise pymarc.exceptions.PymarcException: on a record that can't be read
+	"""
+	import pymarc
+	with open(path, "rb") as fh:
+		for rec in pymarc.MARCReader(fh, to_unicode=True):
+			yield rec
+
+#===============================================================================
+# iter_marcjson
+#===============================================================================
+def _from_dict(obj):
+	"""
+	@param obj: one MARC-in-JSON record, decoded
+	@return: a pymarc.Record
+	"""
+	import pymarc
+	rec = pymarc.Record()
+	rec.leader = obj["leader"]
+	for field in obj["fields"]:
+		tag, value = field.items()[0]
+		if isinstance(value, dict):
+			subfields = []
+			for sub in value.get("subfields", []):
+				for code, text in sub.items():
+					subfields.append(code)
+					subfields.append(text)
+			rec.add_field(pymarc.Field(tag=tag,
+				indicators=[value.get("ind1", " "), value.get("ind2", " ")],
+				subfields=subfields))
+		else:
+			rec.add_field(pymarc.Field(tag=tag, data=value))
+	return rec
+
+def iter_marcjson(path):
+	"""
+	@param path: a MARC-in-JSON file: an array of records, a single record, 
+	or one record per line
+	@return: a generator of pymarc.Records, in file order
+
+	@raise ValueError: when the file isn't valid JSON
+
+	@note: Decodes one record at a time off a buffer, rather than loading the
+	whole array as pymarc.JSONReader does.
+	"""
+	decoder = json.JSONDecoder(strict=False)
+	with io.open(path, "r", encoding="utf-8") as fh:
+		buf = u""
+		pos = 0
+		eof = False
+		while True:
+			# skip what lies between records: whitespace, [ , and ]
+			while pos < len(buf) and buf[pos] in u" \t\r\n[,]":
+				pos += 1
+			if pos == len(buf):
+				if eof:
+					return
+				buf = fh.read(CHUNK)
+				pos = 0
+				eof = not buf
+				continue
+			try:
+				obj, pos = decoder.raw_decode(buf, pos)
+			except ValueError:
+				if eof:
+					raise
+				# the record runs on past the buffer
+				more = fh.read(CHUNK)
+				eof = not more
+				buf = buf[pos:] + more
+				pos = 0
+				continue
+			yield _from_dict(obj)
+
+#===============================================================================
+# detect_format
+#===============================================================================
+def detect_format(path):
+	"""
+	@param path: a MARC file
+	@return: MRX, MRC or JSON, from the first bytes of the file, or from its 
+	extension if they don't say; None if neither does
+	"""
+	with open(path, "rb") as fh:
+		head = fh.read(64).lstrip()
+	if head.startswith("\xef\xbb\xbf"): # UTF-8 BOM
+		head = head[3:].lstrip()
+	if head.startswith("<"):
+		return MRX
+	if head.startswith("[") or head.startswith("{"):
+		return JSON
+	if len(head) >= 24 and head[:5].isdigit():
+		return MRC # ISO 2709: the leader starts with the record length
+	return format_for(path)
+
+def format_for(path):
+	"""
+	@return: the format that goes with the file's extension, or None
+	"""
+	return EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+#===============================================================================
+# iter_records
+#===============================================================================
+def iter_records(path, fmt=None):
+	"""
+	@param path: a MARC file
+	@param fmt: MRX, MRC or JSON; detected from the file if None
+	@return: a generator of pymarc.Records, in file order
+
+	@raise ValueError: when the format isn't one we know
+	"""
+	fmt = fmt or detect_format(path)
+	if fmt == MRX: return iter_marcxml(path)
+	if fmt == MRC: return iter_marc(path)
+	if fmt == JSON: return iter_marcjson(path)
+	raise ValueError("Can't tell what kind of MARC %s is" % path)
+
+#===============================================================================
+# MARCWriter
+#===============================================================================
+class MARCWriter(object):
+	"""
+	Writes records straight to a file handle as binary MARC (ISO 2709).
+	"""
+	def __init__(self, fh, header=True):
+		"""
+		@param fh: a file (or file-like) object opened for writing bytes
+		@param header: ignored; ISO 2709 has no header, but the writers all
+		take the same arguments
+		"""
+		self.fh = fh
+
+	def write(self, rec):
+		"""
+		@note: Records are held as unicode whatever they were read from 
+		(MARC-8 included), so they are always written as UTF-8, and the 
+		leader says so (position 9 'a').
+		"""
+		if rec.leader[9] != "a":
+			rec.leader = rec.leader[:9] + "a" + rec.leader[10:]
+		self.fh.write(rec.as_marc())
+
+	def close(self):
+		"""
+		@note: The file handle is left to the caller.
+		"""
+		self.fh.flush()
+
+#===============================================================================
+# MARCJSONWriter
+#===============================================================================
+class MARCJSONWriter(object):
+	"""
+	Writes records straight to a file handle as a MARC-in-JSON array, one
+	record per line.
+	"""
+	def __init__(self, fh, header=True):
+		"""
+		@param fh: a file (or file-like) object opened for writing bytes
+		@param header: False when appending to an array that already has
+		records in it (e.g. resuming from a checkpoint)
+		"""
+		self.fh = fh
+		self._first = header
+		if header:
+			self.fh.write("[\n")
+
+	def write(self, rec):
+		if not self._first:
+			self.fh.write(",\n")
+		self._first = False
+		self.fh.write(json.dumps(rec.as_dict(), separators=(",", ":")))
+
+	def close(self):
+		"""
+		@note: Closes the array; the file handle is left to the caller.
+		"""
+		self.fh.write("\n]\n")
+		self.fh.flush()
+
+WRITERS = {MRX: MARCXMLWriter, MRC: MARCWriter, JSON: MARCJSONWriter}
+
+def open_writer(fh, fmt=MRX, header=True):
+	"""
+	@param fh: the output, opened for writing bytes
+	@param fmt: MRX, MRC or JSON
+	@param header: False when appending to output that was already started
+	@return: a writer with write(rec) and close()
+	"""
+	return WRITERS[fmt](fh, header=header)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Per-run instrumentation for mrc.py, ead.py and owi.py: stage timers, counters
+(cache hits and misses, lookup outcomes, HTTP statuses) and per-service
+latency histograms, shared by every thread in the process.
+
+At the end of a run the summary is appended to log/jobs.log as one line,
+"<batch number>\t<json>", next to the line that allocated the batch number.
+Worker processes send their summary() back to the parent, which merge()s it.
+
+Stages can nest (e.g. 'http' time is also 'prefetch' time), so stage times
+don't add up to the total.
+"""
+from contextlib import contextmanager
+from time import strftime, time
+import fcntl
+import json
+import os
+import threading
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""Upper bounds, in seconds, of the latency histogram buckets; slower
+responses go in '+inf'"""
+
+SEQ_SUFFIX = ".seq"
+"""The last batch number handed out is kept in the jobs log + this"""
+TAIL = 65536
+"""Bytes at the end of the jobs log read for the last batch number, when 
+there's no counter file yet"""
+
+_lock = threading.Lock()
+_timers = {}
+"""stage -> [seconds, calls]"""
+_counters = {}
+"""name -> count"""
+_latency = {}
+"""service -> [count per bucket (and one for +inf), total seconds]"""
+
+#===============================================================================
+# incr / add_time / timer / observe
+#===============================================================================
+def incr(name, n=1):
+	"""
+	@param name: a counter, e.g. 'cache.hit' or 'http.id.loc.gov.200'
+	"""
+	with _lock:
+		_counters[name] = _counters.get(name, 0) + n
+
+def add_time(stage, seconds, calls=1):
+	"""
+	@param stage: e.g. 'normalize', 'cache', 'serialize'
+	@param seconds: time spent in it
+	"""
+	with _lock:
+		t = _timers.get(stage)
+		if t is None:
+			t = _timers[stage] = [0.0, 0]
+		t[0] += seconds
+		t[1] += calls
+
+@contextmanager
+def timer(stage):
+	"""
+	@note: with metrics.timer('serialize'): ... adds the block's wall time
+	to the stage.
+	"""
+	start = time()
+	try:
+		yield
+	finally:
+		add_time(stage, time() - start)
+
+def observe(service, seconds):
+	"""
+	@param service: the host that answered
+	@param seconds: how long it took
+	"""
+	with _lock:
+		h = _latency.get(service)
+		if h is None:
+			h = _latency[service] = [[0] * (len(BUCKETS) + 1), 0.0]
+		i = 0
+		while i < len(BUCKETS) and seconds > BUCKETS[i]:
+			i += 1
+		h[0][i] += 1
+		h[1] += seconds
+
+#===============================================================================
+# summary / merge / reset
+#===============================================================================
+def _bucket_names():
+	return ["<=%g" % b for b in BUCKETS] + ["+inf"]
+
+def summary():
+	"""
+	@return: a dict (JSON-ready) of everything recorded so far
+	"""
+	with _lock:
+		timers = dict((k, {"seconds": round(v[0], 6), "calls": v[1]}) for k, v in _timers.items())
+		latency = {}
+		for service, (counts, total) in _latency.items():
+			n = sum(counts)
+			latency[service] = {
+				"count": n,
+				"mean": round(total / n, 6) if n else 0.0,
+				"buckets": [[name, c] for name, c in zip(_bucket_names(), counts)],
+			}
+		return {"timers": timers, "counters": dict(_counters), "latency": latency}
+
+def merge(other):
+	"""
+	@param other: a summary() from another process (e.g. a batch worker)
+	"""
+	for stage, t in other.get("timers", {}).items():
+		add_time(stage, t["seconds"], t["calls"])
+	for name, n in other.get("counters", {}).items():
+		incr(name, n)
+	with _lock:
+		for service, h in other.get("latency", {}).items():
+			mine = _latency.get(service)
+			if mine is None:
+				mine = _latency[service] = [[0] * (len(BUCKETS) + 1), 0.0]
+			for i, (name, n) in enumerate(h["buckets"]):
+				mine[0][i] += n
+			mine[1] += h["mean"] * h["count"]
+
+def reset():
+	with _lock:
+		_timers.clear()
+		_counters.clear()
+		_latency.clear()
+
+#===============================================================================
+# new_run
+#===============================================================================
+def new_run(job_log):
+	"""
+	@param job_log: the jobs log, e.g. './log/jobs.log'
+	@return: the next batch number, e.g. '0000000001_yyyymmdd', which is
+	appended to the log
+
+	@note: The counter lives in a one-line file next to the log, locked 
+	while it's bumped, so this costs the same however long the log gets and
+	jobs started at the same moment get different numbers. The first time, 
+	it starts from the highest number near the end of the log.
+	"""
+	logdir = os.path.dirname(job_log)
+	if logdir and not os.path.isdir(logdir):
+		os.makedirs(logdir)
+	with open(job_log + SEQ_SUFFIX, 'a+b') as seq:
+		fcntl.flock(seq, fcntl.LOCK_EX)
+		seq.seek(0)
+		last = seq.read().strip()
+		if last.isdigit():
+			last = int(last)
+		else:
+			last = _last_run(job_log)
+		run = "%010d_%s" % (last + 1, strftime('%Y%m%d'))
+		seq.truncate(0)
+		seq.write("%d\n" % (last + 1))
+		seq.flush()
+		with open(job_log, 'a+b') as jr:
+			jr.write(run + '\n')
+	return run
+
+def _last_run(job_log):
+	"""
+	@return: the highest batch number in the last TAIL bytes of the log, or 0
+
+	@note: Takes the highest number, not the last line's, since a summary 
+	from a run that started earlier can come after a later run's line.
+	"""
+	if not os.path.isfile(job_log):
+		return 0
+	last = 0
+	with open(job_log, 'rb') as jr:
+		jr.seek(0, os.SEEK_END)
+		start = max(0, jr.tell() - TAIL)
+		jr.seek(start)
+		lines = jr.read().splitlines()
+		if start > 0:
+			lines = lines[1:] # (probably cut short)
+		for line in lines:
+			n = line.split("_", 1)[0]
+			if n.isdigit():
+				last = max(last, int(n))
+	return last
+
+#===============================================================================
+# write
+#===============================================================================
+def write(job_log, run, **extra):
+	"""
+	@param job_log: the jobs log
+	@param run: the batch number from new_run
+	@param extra: added to the summary, e.g. tool='mrc', status=0
+	@return: the summary that was written
+	"""
+	report = summary()
+	report.update(extra)
+	with open(job_log, 'a+b') as jr:
+		jr.write(run + '\t' + json.dumps(report, sort_keys=True) + '\n')
+	return report
+
+#===============================================================================
+# profile
+#===============================================================================
+def start_profile():
+	"""
+	@return: a running cProfile.Profile
+	"""
+	import cProfile
+	profiler = cProfile.Profile()
+	profiler.enable()
+	return profiler
+
+def stop_profile(profiler, path, out=None, top=25):
+	"""
+	@param profiler: from start_profile
+	@param path: where to dump the stats (load them with pstats)
+	@param out: a file to print the top functions (by cumulative time) to
+	"""
+	import pstats
+	profiler.disable()
+	profiler.dump_stats(path)
+	if out is not None:
+		out.write("Profile written to " + path + "\n")
+		pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(top)
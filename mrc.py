@@ -3,26 +3,30 @@
 """
 Based on URIs-to-EAD, gets uris from id.loc.gov into MaRC bib records.
 """
-from argparse import ArgumentParser, RawTextHelpFormatter, RawDescriptionHelpFormatter
-from lxml import html
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import Counter
+from functools import partial
+from hashlib import md5
+from itertools import islice
+from lxml import etree
 from sys import exit
-from time import sleep, strftime
+from time import strftime, time
 import ConfigParser
-import httplib
-import libxml2
+import cache
+import checkpoint
+import client
+import lcindex
 import logging
+import marcio
+import metrics
+import normalize
 import os
-import pickle
-import pymarc
-import rdflib
-import re
-import requests
-import shelve
-import subprocess
+import ratelimit
+import recstate
+import resolver
 
 # TODOs:
-# - input / output mrk or mrc or mrx: test file extension
-# - output mrc, mrk and marcxml
+# - input / output mrk
 # - remove -o, output, automatically using name of input file (but leave option for new name)
 # - VIAF?
 # - logging
@@ -34,6 +38,14 @@ RSS_XML = "application/rss+xml"
 APPLICATION_XML = "application/xml"
 CONFIG = "./cfg/mrc.cfg"
 SHELF_FILE = "./db/cache.db"
+"""The old shelve cache, migrated into CACHE_FILE the first time it is seen"""
+CACHE_FILE = cache.CACHE_FILE
+"""Shared with ead.py and owi.py; mrc.py's headings are in the LC vocabulary"""
+SOURCES = (ID_SUBJECT_RESOLVER, "id.loc.gov", "")
+"""The source of the LC headings looked up as mrc.py does: its endpoint, or
+(from before the endpoint was recorded) just the host, or nothing"""
+STATE_FILE = "./db/mrc.state.sqlite"
+"""The 005 of each record as it was last enriched, for -U"""
 JOB_LOG = './log/jobs.log'
 LOG_FILENAME = "./log/alts.log"
 LOG_FORMAT = "%(asctime)s %(filename)s %(message)s"
@@ -41,27 +53,10 @@ REPORTS = "./reports/"
 OUTDIR = "./out/"
 LOGDIR = "./log/"
 INDIR = "./in/"
+DBDIR = "./db/"
 
-# Generate batch no. for reports e.g. 0000000001_yyyymmdd
-if not os.path.isfile(JOB_LOG):
-	try:
-		f = open(JOB_LOG, "w")
-	except IOError:
-		pass
-
-if os.stat(JOB_LOG)[6]<=1:
-	run = "%010d" % (1,)
-	run = "%s_%s" % (str(run), today)
-else:
-	with open(JOB_LOG,'r+b') as jr:
-		last = jr.readlines()[-1].decode()
-		run = "%010d" % (int(last.split("_")[0])+1)
-		run = "%s_%s" % (str(run), today)
-		
-with open(JOB_LOG,'a+b') as jr:
-	jr.write(run+'\n')
-	
-thisrun = REPORTS + 'mrc_uris_'+run+'.tsv'
+REPORT = REPORTS + 'mrc_uris_%s.tsv'
+"""The per-run report, named for the batch number"""
 
 #===============================================================================
 # HeadingNotFoundException
@@ -115,6 +110,55 @@ class Heading(object):
 		self.alternatives = ""
 		""""A list of 2-tuple (uri, label) possibilities"""
 
+#===============================================================================
+# ReportWriter
+#===============================================================================
+class ReportWriter(object):
+	"""
+	The per-run TSV report (bib, tag, heading, uri). Stays open for the whole
+	run, drops duplicate rows by checking a set of row digests (16 bytes a 
+	row, so it stays small on huge runs) and writes in buffered batches.
+	"""
+	def __init__(self, path, buffer_size=1000):
+		"""
+		@param path: the report file; rows already in it count as seen
+		@param buffer_size: rows to hold before writing them out
+		"""
+		self.path = path
+		self.buffer_size = buffer_size
+		self.seen = set()
+		self._buffer = []
+		if os.path.isfile(path):
+			with open(path, 'rb') as br:
+				for line in br:
+					self.seen.add(md5(line).digest())
+		self.fh = open(path, 'ab')
+
+	def write(self, *columns):
+		"""
+		@param columns: the values for one row
+		@return: False if the row was a duplicate, otherwise True
+		"""
+		row = '\t'.join([str(c) for c in columns]) + '\n'
+		key = md5(row).digest()
+		if key in self.seen:
+			return False
+		self.seen.add(key)
+		self._buffer.append(row)
+		if len(self._buffer) >= self.buffer_size:
+			self.flush()
+		return True
+
+	def flush(self):
+		if self._buffer:
+			self.fh.write(''.join(self._buffer))
+			self._buffer = []
+		self.fh.flush()
+
+	def close(self):
+		self.flush()
+		self.fh.close()
+
 #===============================================================================
 # setup
 #===============================================================================
@@ -130,6 +174,8 @@ def setup():
 		os.mkdir(INDIR)
 	if not os.path.isdir(REPORTS):
 		os.mkdir(REPORTS)
+	if not os.path.isdir(DBDIR):
+		os.mkdir(DBDIR)
 
 #===============================================================================
 # _normalize_heading
@@ -138,25 +184,12 @@ def _normalize_heading(heading):
 	"""
 	@param heading: A heading from the source data.
 	@return: A normalized version of the heading.
-	 
-	@note: 	Other users may need to modify or extend this function. This
-	version, in order:
-	 1. collapses whitespace
-	 2. strips spaces that trail or follow hyphens ("-")
-	 3. strips double hyphens when following punctuation ("[\.,]--")
-	 4. strips trailing stops (".")
+
+	@note: See normalize.lc_heading, which ead.py uses for its subjects too,
+	so that both look LC headings up (and cache them) under the same key.
 	"""
-	collapsed = " ".join(heading.split()).replace(" -", "-").replace("- ", "-").replace(",--",", ").replace("--("," (").replace(' d. ',' -').replace('.--','--')
-	abbrev = re.search("[\.\s][A-Z][a-z]?\.$",collapsed)
-	a = ' '
-	if abbrev is not None:
-		a = abbrev.group(0)
-	if (collapsed.endswith(".") or collapsed.endswith(",")) and not collapsed.endswith("etc.") and not collapsed.endswith(a):
-		stripped = collapsed[:-1]
-	else:
-		stripped = collapsed
-	return stripped
-		
+	return normalize.lc_heading(heading)
+
 #===============================================================================
 # query_lc
 #===============================================================================
@@ -173,13 +206,14 @@ def query_lc(subject):
 	"""
 	to_get = ID_SUBJECT_RESOLVER + subject
 	headers = {"Accept":"application/xml"}
-	resp = requests.get(to_get, headers=headers, allow_redirects=True)
+	resp = client.get(to_get, headers=headers, allow_redirects=True)
 	if resp.status_code == 200:
 		uri = resp.headers["x-uri"]
 		try: 
 			label = resp.headers["x-preflabel"]
 		except: # x-preflabel is not returned for deprecated headings
 			msg = "Not found (lc; deprecated): " + subject + os.linesep
+			from lxml import html # only needed here, and rarely
 			tree = html.fromstring(resp.text)
 			see = tree.xpath("//h3/text()= 'Use Instead'") # this info isn't in the header, so grabbing from html
 			seeother = ''
@@ -196,49 +230,229 @@ def query_lc(subject):
 		msg += resp.status_code + os.linesep
 		raise UnexpectedResponseException(msg)
 
+#===============================================================================
+# _fetch_heading
+#===============================================================================
+def _fetch_heading(heading, index=None):
+	"""
+	@param heading: a normalized name or subject heading
+	@param index: an lcindex.LocalIndex to try before going to the network
+	@return: a Heading record for the cache, found or not
+
+	@raise UnexpectedResponseException: passed on from query_lc
+
+	@note: Only talks to the local index and the network, never to the 
+	cache, so it is safe to call from the resolver's worker threads.
+	"""
+	record = Heading()
+	record.type = ""
+	entry = None
+	if index != None:
+		entry = index.lookup(heading)
+	if entry != None:
+		if entry.deprecated:
+			record.found = False
+			record.value = '(DEPRECATED) ' + heading
+			record.alternatives = [entry.instead or '']
+		else:
+			record.found = True
+			record.value = heading
+			record.alternatives = [(entry.uri, entry.preflabel)]
+		return record
+	# not in the local index (or no index); ask id.loc.gov
+	try:
+		uri, auth = query_lc(heading)
+		record.value = heading
+		record.found = True
+		record.alternatives = [(uri, auth)]
+	except HeadingNotFoundException, e:
+		record.type = e.type
+		record.found = False
+		if e.instead != None:
+			record.value = '(DEPRECATED) ' + e.heading
+			record.alternatives = [e.instead]
+		else:
+			record.value = e.heading
+			record.alternatives = []
+	return record
+
+#===============================================================================
+# _heading_fields
+#===============================================================================
+def _heading_fields(rec, names=False, subjects=False):
+	"""
+	@param rec: a pymarc.Record
+	@param names: include 1XX/7XX name fields
+	@param subjects: include 6XX subject fields
+	@return: a generator of (scheme, field, heading) 3-tuples, where scheme 
+	is 'nam' or 'sub' and heading is the subfields joined with "--" (not yet
+	normalized)
+
+	@note: Fields that already have an id.loc.gov $0 (e.g. from an earlier
+	run) are left out, as ead.py leaves out elements with an @authfilenumber.
+	"""
+	if names:
+		#=======================
+		# NAMES
+		#=======================
+		# get names data from these subfields
+		namesubf = ['a','c','d','q']
+		tags = ['100','110','130','700','710','730']
+		for n in rec.get_fields(*tags):
+			if _has_lc_uri(n):
+				continue
+			mrx_subs = [s.encode('utf8') for s in n.get_subfields(*namesubf)]
+			yield 'nam', n, "--".join(mrx_subs)
+	if subjects:
+		#=======================
+		# SUBJECTS
+		#=======================
+		# get subjects data from these subfields (all but 0,2,3,6,8)
+		tags = ['600','610','611','630','650','651']
+		subsubf = ['a', 'b', 'c', 'd', 'f', 'g', 'h', 'j', 'k', 'l', 
+		'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'x', 'y', 'z', '4'] 
+		for f in rec.get_fields(*tags):
+			if _has_lc_uri(f):
+				continue
+			mrx_subs = [s.encode('utf8') for s in f.get_subfields(*subsubf)]
+			yield 'sub', f, "--".join(mrx_subs)
+
+def _has_lc_uri(field):
+	"""
+	@return: True if the field has a $0 with an id.loc.gov URI
+	"""
+	for uri in field.get_subfields('0'):
+		if 'id.loc.gov/' in uri:
+			return True
+	return False
+
+#===============================================================================
+# _record_id
+#===============================================================================
+def _record_id(rec):
+	"""
+	@return: the record's 001, or None if it doesn't have one
+	"""
+	f001 = rec.get_fields('001')
+	if f001: return f001[-1].value()
+	return None
+
+#===============================================================================
+# _prefetch
+#===============================================================================
+def _prefetch(records, shelf, names=False, subjects=False, workers=resolver.WORKERS, verbose=False, ignore_cache=False, index=None):
+	"""
+	@param records: the pymarc.Records to be enriched
+	@param shelf: the cache
+	@param index: an lcindex.LocalIndex to try before the network
+	@return: a 3-tuple (distinct headings, occurrences, headings looked up)
+
+	@note: Counts the distinct normalized headings in the batch and resolves
+	each one that isn't in the cache exactly once, most frequent first and
+	concurrently. Results go into the cache, so that _update_headings can 
+	then apply them without touching the network.
+	"""
+	raw = Counter()
+	for rec in records:
+		for scheme, field, h in _heading_fields(rec, names, subjects):
+			raw[h] += 1
+	# each distinct raw heading is normalized once (and then remembered for
+	# the second pass)
+	start = time()
+	counts = Counter()
+	for h, n in raw.iteritems():
+		counts[_normalize_heading(h)] += n
+	metrics.add_time("normalize", time() - start, sum(raw.itervalues()))
+	misses = [h for h, n in counts.most_common() if ignore_cache or h not in shelf]
+	metrics.incr("prefetch.distinct", len(counts))
+	metrics.incr("prefetch.miss", len(misses))
+	metrics.incr("cache.hit", len(counts) - len(misses))
+	metrics.incr("cache.miss", len(misses))
+	for heading, record, error in resolver.resolve(misses, partial(_fetch_heading, index=index), workers):
+		if error is not None:
+			metrics.incr("lookup.error")
+			os.sys.stderr.write(str(error))
+			continue
+		if verbose:
+			if record.found == True: os.sys.stdout.write("Found (lc): " + heading + "\n")
+			else: os.sys.stderr.write("Not found (lc): " + heading + "\n")
+		shelf[heading] = record
+	return len(counts), sum(counts.itervalues()), len(misses)
+
+#===============================================================================
+# _refresh_stale
+#===============================================================================
+def _refresh_stale(shelf, workers=resolver.WORKERS, verbose=False, index=None):
+	"""
+	@param shelf: the cache
+	@param index: an lcindex.LocalIndex to try before the network
+	@return: a 2-tuple (expired headings, headings refreshed)
+
+	@note: Looks up again only the headings whose TTL has passed (see 
+	cache.py); the rest of the cache is left alone. A heading that can't be
+	looked up keeps its old entry and is tried again next time. Headings 
+	whose source names another endpoint are left to whatever wrote them.
+	"""
+	stale = [heading for (heading, vocabulary), record in shelf.stale(cache.LC) if record.source in SOURCES]
+	refreshed = 0
+	for heading, record, error in resolver.resolve(stale, partial(_fetch_heading, index=index), workers):
+		if error is not None:
+			metrics.incr("lookup.error")
+			os.sys.stderr.write(str(error))
+			continue
+		if verbose:
+			if record.found == True: os.sys.stdout.write("Refreshed (lc): " + heading + "\n")
+			else: os.sys.stderr.write("Refreshed, not found (lc): " + heading + "\n")
+		shelf[heading] = record
+		refreshed += 1
+	metrics.incr("refresh.stale", len(stale))
+	metrics.incr("refresh.done", refreshed)
+	return len(stale), refreshed
+
 #===============================================================================
 # update_headings
 #===============================================================================
-def _update_headings(bib, scheme, h, ctxt, shelf, tag, annotate=False, verbose=False, mrx=False, log=False, ignore_cache=False):
+def _update_headings(bib, scheme, h, ctxt, shelf, tag, annotate=False, verbose=False, mrx=False, log=False, ignore_cache=False, report=None, index=None):
 	
 	uri = ""
 
 	try:
 		heading_type = ""
-		heading = _normalize_heading(h)
+		heading = _normalize_heading(h) # (memoized by the prefetch; timed there)
 			
 		# Check the shelf right off
 		if ignore_cache==False and heading in shelf:
 			cached = shelf[heading]
-			if cached.found == True and len(cached.alternatives) == 1:
-				## we only get here if no exceptions above 
-				if verbose:	os.sys.stdout.write("[Cache] Found: " + heading + "\n") 
-				uri = cached.alternatives[0][0]
-				if 'authorities/classification' not in uri:
-					if (scheme == 'nam' and 'authorities/names' in uri) or (scheme == 'sub' and 'authorities/subjects' in uri): 
-						pymarc.Field.add_subfield(ctxt,"0",uri)
-			elif len(cached.alternatives) > 1:
-				msg = "[Cache] Multiple matches for " + heading + "\n"
-				raise MultipleMatchesException(msg, heading, heading_type, cached.alternatives)
-			else: # 0 
-				msg = "[Cache] Not found: " + heading + "\n"
-				raise HeadingNotFoundException(msg, heading, heading_type)
+			where = "[Cache] "
 		else:
-			uri, auth = query_lc(heading)
+			# (hits and misses are counted, once per heading, by _prefetch;
+			# this is one it didn't resolve)
+			cached = _fetch_heading(heading, index)
+			where = ""
+			metrics.incr("cache.late_miss")
+			# we put the heading in the db, found or not
+			shelf[heading] = cached
+
+		if cached.found == True and len(cached.alternatives) == 1:
 			## we only get here if no exceptions above 
-			if verbose:	os.sys.stdout.write("Found (lc): " + heading + "\n")
+			metrics.incr("heading.found")
+			if verbose:	os.sys.stdout.write(where + "Found: " + heading + "\n") 
+			uri = cached.alternatives[0][0]
 			if 'authorities/classification' not in uri:
-					if (scheme == 'nam' and 'authorities/names' in uri) or (scheme == 'sub' and 'authorities/subjects' in uri): 
-						pymarc.Field.add_subfield(ctxt,"0",uri)
-			# we put the heading we found in the db
-			record = Heading()
-			record.value = heading
-			record.type = type
-			record.found = True
-			record.alternatives = [(uri, auth)]
-			shelf[heading] = record
-			
-			sleep(1) # A courtesy to the services.
+				if (scheme == 'nam' and 'authorities/names' in uri) or (scheme == 'sub' and 'authorities/subjects' in uri): 
+					ctxt.add_subfield("0", uri)
+		elif len(cached.alternatives) > 1:
+			metrics.incr("heading.multiple")
+			msg = where + "Multiple matches for " + heading + "\n"
+			raise MultipleMatchesException(msg, heading, heading_type, cached.alternatives)
+		elif cached.value.startswith('(DEPRECATED) '):
+			metrics.incr("heading.deprecated")
+			msg = where + "Not found (lc; deprecated): " + heading + "\n"
+			raise HeadingNotFoundException(msg, heading, heading_type, cached.alternatives[0])
+		else: # 0 
+			metrics.incr("heading.not_found")
+			msg = where + "Not found: " + heading + "\n"
+			raise HeadingNotFoundException(msg, heading, heading_type)
 			
 	except UnexpectedResponseException, e:
 		os.sys.stderr.write(str(e))
@@ -246,18 +460,6 @@ def _update_headings(bib, scheme, h, ctxt, shelf, tag, annotate=False, verbose=F
 	except HeadingNotFoundException, e:
 		if verbose:
 			os.sys.stderr.write(str(e))
-		if not heading in shelf:
-			# We still want to put this in the db
-			record = Heading()
-			record.type = e.type
-			record.found = False
-			if e.instead != None:
-				record.value = '(DEPRECATED) ' + e.heading
-				record.alternatives = [e.instead]
-			else:
-				record.value = e.heading
-				record.alternatives = []
-			shelf[heading] = record
 	
 	except MultipleMatchesException, m:
 		if verbose:
@@ -269,6 +471,7 @@ def _update_headings(bib, scheme, h, ctxt, shelf, tag, annotate=False, verbose=F
 				# the doc stays well-formed
 				content += alt[0].replace("--", "-\-") + " : " + \
 				alt[1].replace("--", "-\-") + os.linesep 
+			import libxml2
 			comment = libxml2.newComment(content)
 			node.addNextSibling(comment)
 		if log: 
@@ -279,14 +482,6 @@ def _update_headings(bib, scheme, h, ctxt, shelf, tag, annotate=False, verbose=F
 				content += alt[0].replace("--", "-\-") + " : " + \
 				alt[1].replace("--", "-\-") + os.linesep 
 			logging.info(content)
-		if not heading in shelf:
-			# We still want to put this in the db
-			record = Heading()
-			record.value = m.heading
-			record.type = m.type
-			record.found = True
-			record.alternatives = m.items
-			shelf[heading] = record
 
 	except LookupError, e:
 		record = Heading()
@@ -299,10 +494,8 @@ def _update_headings(bib, scheme, h, ctxt, shelf, tag, annotate=False, verbose=F
 		raise e
 		
 	# write bib and heading to report
-	bh = str(bib)+'\t'+str(tag)+'\t'+str(heading)+'\t'+str(uri)+'\n'
-	with open(thisrun,'a+b') as br:
-		if bh not in br:
-			br.write(bh)
+	if report != None:
+		report.write(bib, tag, heading, uri)
 
 class CLI(object):
 	EX_OK = 0
@@ -355,7 +548,13 @@ class CLI(object):
 		
 		rHelp = "The input file."
 		
-		mHelp = "The input file is MaRCXML rather than EAD. Found URIs are put into $0."
+		mHelp = "The input file is MaRC rather than EAD: MaRCXML, binary " + \
+			"MaRC (ISO 2709) or MaRC-in-JSON, told apart by its first bytes. " + \
+			"Found URIs are put into $0."
+	
+		formatHelp = "Output format: mrx (MaRCXML), mrc (binary MaRC) or " + \
+			"json (MaRC-in-JSON). Defaults to the output file's extension, " + \
+			"else the input's format."
 	
 		oHelp = "Path to the output file. Writes to stdout if no option " + \
 			"is supplied."
@@ -375,6 +574,33 @@ class CLI(object):
 		
 		lHelp = "Log alternatives.\n"
 		
+		iHelp = "Local index of id.loc.gov labels (see lcindex.py). " + \
+			"Headings are looked up there first, and only the misses go to " + \
+			"the network. Ignored if the file doesn't exist."
+		
+		wHelp = "Number of worker threads used to look up headings that " + \
+			"aren't in the cache."
+		
+		pHelp = "Only look up the headings that aren't in the cache (warm " + \
+			"the cache); don't write any records."
+		
+		resumeHelp = "Pick up where an interrupted run with the same input " + \
+			"and output left off (see the .ckpt file next to the output)."
+		
+		rateHelp = "Max requests per second to id.loc.gov, across all " + \
+			"workers. Overrides the [RateLimits] section of the config file."
+		
+		changedHelp = "Incremental run: pass over records whose 005 is the " + \
+			"same as when they were last enriched (tracked by 001 in " + \
+			STATE_FILE + "). They are neither looked up nor written out.\n"
+		
+		refreshHelp = "Look up again every cached heading whose TTL has " + \
+			"passed (see the [Cache] section of the config file), then exit. " + \
+			"No input file needed."
+		
+		profileHelp = "Run under cProfile; the stats are dumped to " + \
+			LOGDIR + " and the slowest calls printed to stderr."
+		
 		cfgHelp = "Specify the config file. Defaults can be overridden. " + \
 			"At minimum, run e.g.: python addauths.py myfile.marc.xml"
 					
@@ -390,7 +616,14 @@ class CLI(object):
 			"verbose" : False,
 			"ignore_cache" : False,
 			"record": None,
-			"log" : False
+			"log" : False,
+			"workers" : resolver.WORKERS,
+			"rate" : None,
+			"prefetch_only" : False,
+			"resume" : False,
+			"outformat" : None,
+			"changed_only" : False,
+			"lcindex" : lcindex.INDEX_FILE
 		}
 		# if -c or --conf_file, override the defaults above
 		if args.conf_file:
@@ -402,20 +635,49 @@ class CLI(object):
 				# need to get the booleans as booleans, not as 'strings'
 				boo = config.getboolean('Booleans',k)
 				cfgdict[k]=boo
+			# Resolver section of config file: worker threads
+			cfgdict['workers'] = resolver.WORKERS
+			cfgdict['rate'] = None
+			cfgdict['prefetch_only'] = False
+			cfgdict['resume'] = False
+			cfgdict['profile'] = False
+			cfgdict['refresh_stale'] = False
+			cfgdict['outformat'] = None
+			cfgdict.setdefault('changed_only', False)
+			cfgdict.setdefault('lcindex', lcindex.INDEX_FILE)
+			if config.has_option('Resolver','workers'):
+				cfgdict['workers'] = max(1, config.getint('Resolver','workers'))
 			defaults = cfgdict
+			# HTTP section of config file: connection pool size, timeout, keep-alive
+			client.configure_from(config)
+			# RateLimits section of config file: requests per second and burst, per host
+			ratelimit.configure_from(config)
+			cache.configure_from(config)
 
 		parser = ArgumentParser(parents=[conf_parser],description=desc,formatter_class=RawDescriptionHelpFormatter,epilog=epi)
 		parser.set_defaults(**defaults)
 		parser.add_argument("-m", "--marc", required=False, dest="mrx", action="store_true", help=mHelp)
 		parser.add_argument("-o", "--output", required=False, dest="outpath", help=oHelp)
+		parser.add_argument("-F", "--format", required=False, dest="outformat", choices=marcio.FORMATS, help=formatHelp)
 		parser.add_argument("-n", "--names", required=False, dest="names", action="store_true", help=nHelp)
 		parser.add_argument("-s", "--subjects", required=False, dest="subjects", action="store_true", help=sHelp)
 		parser.add_argument("-a", "--annotate", required=False, dest="annotate", action="store_true", help=aHelp)
 		parser.add_argument("-v", "--verbose", required=False, dest="verbose", action="store_true", help=vHelp)
 		parser.add_argument("-C", "--ignore-cache",required=False, dest="ignore_cache", action="store_true", help=cHelp)
 		parser.add_argument("-l", "--log",required=False, dest="log", action="store_true", help=lHelp)
-		parser.add_argument("-f", "--file",required=True, dest="record", help=rHelp)
+		parser.add_argument("-i", "--index",required=False, dest="lcindex", help=iHelp)
+		parser.add_argument("-w", "--workers",required=False, dest="workers", type=int, help=wHelp)
+		parser.add_argument("-P", "--prefetch-only",required=False, dest="prefetch_only", action="store_true", help=pHelp)
+		parser.add_argument("-R", "--resume",required=False, dest="resume", action="store_true", help=resumeHelp)
+		parser.add_argument("-U", "--changed-only",required=False, dest="changed_only", action="store_true", help=changedHelp)
+		parser.add_argument("--rate",required=False, dest="rate", type=float, help=rateHelp)
+		parser.add_argument("--profile",required=False, dest="profile", action="store_true", help=profileHelp)
+		parser.add_argument("--refresh-stale",required=False, dest="refresh_stale", action="store_true", help=refreshHelp)
+		parser.add_argument("-f", "--file",required=False, dest="record", help=rHelp)
 		args = parser.parse_args(remaining_argv)
+		import pymarc # (slow to import; not needed for --help)
+		if args.rate:
+			ratelimit.configure("id.loc.gov", args.rate, ratelimit.LIMITS["id.loc.gov"][1])
 
 		# TODO args to log (along with batch no.) -pmg		
 		print(args)
@@ -423,29 +685,43 @@ class CLI(object):
 		#=======================================================================
 		# Checks on our args and options. We can exit before we do any work.
 		#=======================================================================
-		if not os.path.exists(args.record):
-			os.sys.stderr.write("File " + args.record + " does not exist\n")
-			exit(CLI.EX_NO_INPUT)
-			
-		if args.record == None:
+		if args.record == None and not args.refresh_stale:
 			os.sys.stderr.write("No input file supplied. See --help for usage\n")
 			exit(CLI.EX_WRONG_USAGE)
+
+		if args.record != None and not os.path.exists(args.record):
+			os.sys.stderr.write("File " + args.record + " does not exist\n")
+			exit(CLI.EX_NO_INPUT)
 	
-		if not args.names and not args.subjects:
+		if not args.names and not args.subjects and not args.refresh_stale:
 			msg = "Supply -n and or -s to link headings. Use --help " + \
 			"for more details.\n"
 			os.sys.stderr.write(msg)
 			exit(CLI.EX_WRONG_USAGE)
 			
-		if args.mrx == True:
+		informat = None
+		if args.record != None:
+			informat = marcio.detect_format(args.record)
+		if args.mrx == True and args.record != None:
 			marc_path = args.record
-			# a quick and dirty test...
-			reader = pymarc.marcxml.parse_xml_to_array(marc_path)
-			if not reader:
-				msg = "-m flag used but input file isn't MaRCXML.\n"
+			# a quick and dirty test: only parses up to the first record
+			try:
+				first = next(marcio.iter_records(marc_path, informat), None)
+			except (etree.XMLSyntaxError, ValueError, pymarc.exceptions.PymarcException):
+				first = None
+			if first is None:
+				msg = "-m flag used but input file isn't MaRC (MaRCXML, binary or JSON).\n"
 				os.sys.stderr.write(msg)
 				exit(CLI.EX_WRONG_USAGE)
+		outformat = args.outformat
+		if outformat == None and args.outpath != None:
+			outformat = marcio.format_for(args.outpath)
+		outformat = outformat or informat or marcio.MRX
 	
+		if args.resume and not args.outpath:
+			os.sys.stderr.write("--resume needs an output file (-o)\n")
+			exit(CLI.EX_WRONG_USAGE)
+
 		if args.outpath:
 			outdir = os.path.dirname(args.outpath)
 			if not os.path.exists(outdir):
@@ -460,60 +736,88 @@ class CLI(object):
 		#=======================================================================
 		# The work...
 		#=======================================================================
-		shelf = shelve.open(SHELF_FILE, protocol=pickle.HIGHEST_PROTOCOL)
+		# Generate batch no. for reports e.g. 0000000001_yyyymmdd
+		run = metrics.new_run(JOB_LOG)
+		started = time()
+		profiler = None
+		if args.profile:
+			profiler = metrics.start_profile()
+		shelf = cache.open_cache(CACHE_FILE, legacy=SHELF_FILE, source=ID_SUBJECT_RESOLVER, vocabulary=cache.LC)
 		ctxt = None
-		mrx_subs = []
-		h = ""
-		mrxheader = """<?xml version="1.0" encoding="UTF-8" ?>
-<collection xmlns="http://www.loc.gov/MARC21/slim" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.loc.gov/MARC21/slim http://www.loc.gov/standards/marcxml/schema/MARC21slim.xsd">"""
+		fh = None
+		report = None
+		ckpt = None
+		index = None
+		state = None
+		if args.lcindex and os.path.isfile(args.lcindex):
+			index = lcindex.LocalIndex(args.lcindex)
 		try:
-			reader = pymarc.marcxml.parse_xml_to_array(args.record)
-			#writer = codecs.open("test_out.marc.xml", 'w', 'utf-8')
-			options = {'annotate':args.annotate, 'verbose':args.verbose, 'mrx':args.mrx, 'log':args.log, 'ignore_cache':args.ignore_cache}
-			fh = open(OUTDIR+'tmp.xml', 'wb+')
-			fh.write(mrxheader)
-			for rec in reader:
-				f001 = rec.get_fields('001')
-				for b in f001:
-					bbid = b.value()
-				if args.names:
-					#=======================
-					# NAMES
-					#=======================
-					# get names data from these subfields
-					namesubf = ['a','c','d','q']
-					names = ['100','110','130','700','710','730']
-					for n in rec.get_fields(*names):
-						for s in n.get_subfields(*namesubf):
-							s = s.encode('utf8')
-							mrx_subs.append(s)
-						h = "--".join(mrx_subs)
-						tag = n.tag
-						_update_headings(bbid, 'nam', h, n, shelf, tag, **options)
-						mrx_subs = []
-				if args.subjects:
-					#=======================
-					# SUBJECTS
-					#=======================
-					# get subjects data from these subfields (all but 0,2,3,6,8)
-					subs = ['600','610','611','630','650','651']
-					subsubf = ['a', 'b', 'c', 'd', 'f', 'g', 'h', 'j', 'k', 'l', 
-					'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'x', 'y', 'z', '4'] 
-					for f in rec.get_fields(*subs):
-						for s in f.get_subfields(*subsubf):
-							s = s.encode('utf8')
-							mrx_subs.append(s)
-						h = "--".join(mrx_subs)
-						tag = f.tag
-						_update_headings(bbid, 'sub', h, f, shelf, tag, **options)
-						mrx_subs = []
-				out = "%s" % (pymarc.record_to_xml(rec))
-				fh.write(out)
-			fh.write("</collection>")
-			fh.close()
-			
-			if args.outpath == None:
-				os.sys.stdout.write(out)
+			if args.refresh_stale:
+				# just bring the expired part of the cache up to date
+				with metrics.timer("refresh"):
+					stats = _refresh_stale(shelf, workers=args.workers, verbose=args.verbose, index=index)
+				os.sys.stderr.write("%d expired headings; refreshed %d\n" % stats)
+			else:
+				if not args.prefetch_only:
+					report = ReportWriter(REPORT % run)
+				if args.changed_only:
+					state = recstate.RecordState(STATE_FILE)
+				options = {'annotate':args.annotate, 'verbose':args.verbose, 'mrx':args.mrx, 'log':args.log, 'ignore_cache':args.ignore_cache, 'report':report, 'index':index}
+				if args.outpath != None:
+					ckpt = checkpoint.Checkpoint(args.outpath, args.record)
+					if args.resume:
+						ckpt.load()
+				# first pass: resolve the batch's cache misses concurrently
+				records = marcio.iter_records(args.record, informat)
+				if ckpt != None and ckpt.records:
+					records = islice(records, ckpt.records, None)
+				if state != None:
+					records = (rec for rec in records if not state.unchanged(rec))
+				with metrics.timer("prefetch"):
+					stats = _prefetch(records, shelf, names=args.names, subjects=args.subjects, workers=args.workers, verbose=args.verbose, ignore_cache=args.ignore_cache, index=index)
+				if args.prefetch_only:
+					os.sys.stderr.write("%d distinct headings (%d occurrences); looked up %d\n" % stats)
+				else:
+					options['ignore_cache'] = False # the prefetch already refreshed the cache
+					# second pass: stream each record through, enrich it, write it and drop it
+					records = marcio.iter_records(args.record, informat)
+					if args.outpath == None:
+						fh = os.sys.stdout
+						writer = marcio.open_writer(fh, outformat)
+					elif ckpt.records:
+						# pick up after the last checkpointed record
+						os.sys.stderr.write("Resuming after record %d (%s)\n" % (ckpt.records, ckpt.last_id))
+						fh = checkpoint.open_output(ckpt)
+						writer = marcio.open_writer(fh, outformat, header=False)
+						records = checkpoint.skip(records, ckpt, _record_id)
+					else:
+						fh = open(args.outpath, 'wb')
+						writer = marcio.open_writer(fh, outformat)
+					for rec in records:
+						if state != None and state.unchanged(rec):
+							metrics.incr("records.unchanged")
+							if ckpt != None:
+								ckpt.update(_record_id(rec), fh)
+							continue
+						f001 = rec.get_fields('001')
+						for b in f001:
+							bbid = b.value()
+						for scheme, field, h in _heading_fields(rec, args.names, args.subjects):
+							_update_headings(bbid, scheme, h, field, shelf, field.tag, **options)
+						with metrics.timer("serialize"):
+							writer.write(rec)
+						metrics.incr("records")
+						if state != None:
+							state.update(rec)
+						if ckpt != None:
+							ckpt.update(_record_id(rec), fh)
+					writer.close()
+					if state != None:
+						state.commit()
+					if ckpt != None:
+						# finished; nothing to resume
+						ckpt.clear()
+						ckpt = None
 
 			# if we got here...
 			status = CLI.EX_OK
@@ -521,9 +825,18 @@ class CLI(object):
 		#=======================================================================
 		# Problems while doing "the work" are handled w/ Exceptions
 		#=======================================================================
-		except libxml2.parserError, e: # TODO: pymarc exceptions
-			os.sys.stderr.write(str(e.message) + "\n")
+		except (etree.XMLSyntaxError, pymarc.exceptions.PymarcException), e:
+			os.sys.stderr.write(str(e) + "\n")
+			status = CLI.EX_DATA_ERR
+
+		except ValueError, e: # bad MaRC-in-JSON, or a format we don't know
+			os.sys.stderr.write(str(e) + "\n")
+			status = CLI.EX_DATA_ERR
+
+		except checkpoint.CheckpointMismatchException, e:
+			os.sys.stderr.write(str(e) + "\n")
 			status = CLI.EX_DATA_ERR
+			ckpt = None # leave it as it is
 
 		except IOError, e:
 			os.sys.stderr.write(str(e.message) + "\n")
@@ -539,9 +852,26 @@ class CLI(object):
 		
 		finally:
 			# clean up!
-			if args.outpath != None:
-				subprocess.Popen(['xmllint','--format','-o', args.outpath, OUTDIR+'tmp.xml'])
+			if ckpt != None and fh != None and status != CLI.EX_IOERR:
+				# everything written so far is whole records; save our place
+				ckpt.save(fh)
+				if state != None:
+					state.commit()
+				os.sys.stderr.write("Checkpoint saved; run again with --resume\n")
+			if fh != None and fh is not os.sys.stdout:
+				fh.close()
+			if report != None:
+				report.close()
+			if index != None:
+				index.close()
+			if state != None:
+				state.close()
 			shelf.close()
+			client.close()
+			if profiler != None:
+				metrics.stop_profile(profiler, LOGDIR + "mrc_" + run + ".prof", os.sys.stderr)
+			metrics.add_time("total", time() - started)
+			metrics.write(JOB_LOG, run, tool="mrc", input=args.record, status=status)
 			exit(status)
 			
 if __name__ == "__main__": CLI()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Normalization of LC headings, shared by mrc.py, ead.py (subjects) and
+bulk.py. Headings are cached under their normalized form in the shared
+cache, so every tool that looks headings up in the same vocabulary at 
+id.loc.gov has to normalize them the same way for one tool's lookups to be
+hits for the others.
+"""
+import re
+
+ABBREVIATION = re.compile(r"[\.\s][A-Z][a-z]?\.$")
+"""A heading ending in an initial or abbreviation, e.g. 'Smith, J.' or
+'Washington (D.C.)', whose stop is kept"""
+MEMO_SIZE = 100000
+"""Raw headings whose normalized form is remembered; the memo is emptied
+when it fills up"""
+_memo = {}
+"""raw heading -> normalized heading"""
+
+#===============================================================================
+# lc_heading
+#===============================================================================
+def lc_heading(heading):
+	"""
+	@param heading: A heading from the source data.
+	@return: A normalized version of the heading.
+
+	@note: 	Other users may need to modify or extend this function. This
+	version, in order:
+	 1. collapses whitespace
+	 2. strips spaces that trail or follow hyphens ("-")
+	 3. strips double hyphens when following punctuation ("[\.,]--")
+	 4. strips trailing stops (".") and commas, but not after "etc" or an
+	    initial or abbreviation (see ABBREVIATION)
+
+	The same few thousand headings come up over and over in a batch, so
+	each raw heading is normalized once and remembered (up to MEMO_SIZE of
+	them).
+	"""
+	stripped = _memo.get(heading)
+	if stripped is not None:
+		return stripped
+	# str.replace is a C loop; these few passes over a short heading are
+	# quicker than one re.sub with an alternation for every rule, which
+	# needs a Python callback per match (~3.6 against ~5.2 usec a heading;
+	# see bench/normalize.py, "single_pass")
+	collapsed = " ".join(heading.split()).replace(" -", "-").replace("- ", "-").replace(",--",", ").replace("--("," (").replace(' d. ',' -').replace('.--','--')
+	if collapsed.endswith(",") or (collapsed.endswith(".") and not collapsed.endswith("etc.") and ABBREVIATION.search(collapsed) is None):
+		stripped = collapsed[:-1]
+	else:
+		stripped = collapsed
+	if len(_memo) >= MEMO_SIZE:
+		_memo.clear()
+	_memo[heading] = stripped
+	return stripped
@@ -2,41 +2,176 @@
 #-*- coding: utf-8 -*-
 """
 A simple, one-off, experimental script to get OCLC Work IDs (OWIs) into a batch of bib records. Here, they went into 787$o.
-Uses pymarc, libxml2 and xmllint.
+Uses pymarc, libxml2 and lxml.
 NOTE: There's a quota of 1,000 queries per day by default (this isn't immediately obvious). Check the following:
 http://oclc.org/developer/develop/linked-data/worldcat-entities/worldcat-work-entity.en.html
 http://www.oclc.org/developer/develop/web-services/xid-api.en.html
 """
-from time import sleep
+from argparse import ArgumentParser
+from time import strftime, time
+import ConfigParser
+import cache
+import checkpoint
+import client
+import json
 import libxml2
+import marcio
+import metrics
 import os
-import pickle
 import pymarc
-import requests
-import shelve
-import subprocess
+import ratelimit
 import sys
 
 XID_RESOLVER = "http://xisbn.worldcat.org/webservices/xid/oclcnum/%s"
 WORK_ID = "http://worldcat.org/entity/work/id/"
 SHELF_FILE = "./owi.db"
+"""The old shelve cache, migrated into CACHE_FILE the first time it is seen"""
+CACHE_FILE = cache.CACHE_FILE
+"""Shared with mrc.py and ead.py; work ids are in the OWI vocabulary"""
+QUOTA_FILE = "./owi.quota.json"
+"""How much of today's xID quota has been used, across runs"""
+QUOTA = 1000
+"""xID queries allowed per day"""
+QUEUE_SUFFIX = ".queue"
+"""The queue of OCLC numbers still to look up is kept in outfile + this"""
+SAVE_EVERY = 50
+"""Lookups between saves of the queue and quota"""
+LOGDIR = "./log/"
+JOB_LOG = LOGDIR + "jobs.log"
+CONFIG = "./cfg/owi.cfg"
+"""Read for its [HTTP], [RateLimits] and [Cache] sections, if it's there"""
 
 infile = "./input.marc.xml"
 outfile = "./output_w_owis.marc.xml"
 
-def check_shelf(ocn):
-	shelf = shelve.open(SHELF_FILE, protocol=pickle.HIGHEST_PROTOCOL)
+#===============================================================================
+# OverLimitException
+#===============================================================================
+# we throw when xID says we've used up today's quota
+class OverLimitException(Exception): pass
+
+#===============================================================================
+# Quota
+#===============================================================================
+class Quota(object):
+	"""
+	Today's xID budget. Kept in QUOTA_FILE so that every run, whatever its
+	input, draws on the same one.
+	"""
+	def __init__(self, path=QUOTA_FILE, limit=QUOTA):
+		"""
+		@param path: the state file
+		@param limit: queries allowed per day
+		"""
+		self.path = path
+		self.limit = limit
+		self.day = strftime('%Y%m%d')
+		self.used = 0
+		"""Queries sent today"""
+		if os.path.isfile(path):
+			with open(path, 'rb') as fh:
+				state = json.load(fh)
+			if state.get("day") == self.day:
+				self.used = state.get("used", 0)
+
+	def remaining(self):
+		return max(0, self.limit - self.used)
+
+	def use(self):
+		self.used += 1
+
+	def exhaust(self):
+		"""
+		@note: Call when xID says 'overlimit', whatever our count says.
+		"""
+		self.used = max(self.used, self.limit)
+
+	def save(self):
+		_save_json(self.path, {"day": self.day, "used": self.used})
+
+#===============================================================================
+# Queue
+#===============================================================================
+class Queue(object):
+	"""
+	The OCLC numbers in one input that are still to be looked up, in the 
+	order their records come. Kept next to the output so that a job bigger
+	than a day's quota carries on where it stopped the next day.
+	"""
+	def __init__(self, outpath, inpath):
+		self.path = outpath + QUEUE_SUFFIX
+		self.inpath = os.path.abspath(inpath)
+		self.pending = []
+
+	def load(self):
+		"""
+		@return: True if there was a queue for this input
+		"""
+		if not os.path.isfile(self.path):
+			return False
+		with open(self.path, 'rb') as fh:
+			state = json.load(fh)
+		if state.get("input") != self.inpath:
+			return False
+		self.pending = [str(ocn) for ocn in state["pending"]]
+		return True
+
+	def save(self):
+		_save_json(self.path, {"input": self.inpath, "pending": self.pending})
+
+	def clear(self):
+		if os.path.isfile(self.path):
+			os.remove(self.path)
+
+def _save_json(path, state):
+	tmp = path + ".tmp"
+	with open(tmp, 'wb') as fh:
+		json.dump(state, fh)
+	os.rename(tmp, path)
+
+#===============================================================================
+# check_shelf
+#===============================================================================
+def check_shelf(ocn, shelf, quota=None):
+	"""
+	@param ocn: an OCLC number
+	@param shelf: the (open) cache, in the OWI vocabulary
+	@param quota: a Quota to charge, if we have to ask xID
+	@return: the work id URI, or None
+
+	@raise OverLimitException: passed on from query_oclc
+	"""
+	start = time()
 	if ocn in shelf:
-		workid = shelf[ocn]
+		workid = _workid(shelf, ocn)
+		metrics.add_time("cache", time() - start)
+		metrics.incr("cache.hit")
 		os.sys.stdout.write("[Cache] Found: " + ocn + "\n") 
-	else:
-		workid = query_oclc(ocn)
-		if workid != None and workid != '':
-			shelf[ocn] = workid
-			os.sys.stdout.write('put %s %s into db\n' % (ocn,workid))
-	shelf.close()
+		return workid
+	metrics.add_time("cache", time() - start)
+	metrics.incr("cache.miss")
+	if quota != None:
+		quota.use()
+	workid = query_oclc(ocn)
+	if workid != None and workid != '':
+		record = cache.Heading()
+		record.value = ocn
+		record.found = True
+		record.alternatives = [(workid, "")]
+		record.source = "xisbn.worldcat.org"
+		shelf[ocn] = record
+		os.sys.stdout.write('put %s %s into db\n' % (ocn,workid))
 	return workid
 
+def _workid(shelf, ocn):
+	"""
+	@return: the cached work id URI for the OCLC number, or None
+	"""
+	record = shelf.get(ocn)
+	if record == None or not record.alternatives:
+		return None
+	return record.alternatives[0][0]
+
 def query_oclc(xid):
 	'''
 	See the following for parameters:
@@ -46,22 +181,26 @@ def query_oclc(xid):
 	to_get += "?method=getMetadata&format=xml&fl=*" # could also try &fl=owi
 	print(to_get) # uncomment to get the full request URI
 	headers = {"Accept":"application/xml"}
-	resp = requests.get(to_get, headers=headers, allow_redirects=True)
+	resp = client.get(to_get, headers=headers, allow_redirects=True)
 	if resp.status_code == 200:
 		doc = libxml2.parseDoc(resp.text.encode("UTF-8", errors="ignore"))
 		ctxt = doc.xpathNewContext()
 		if ctxt.xpathEval("//@stat[.='overlimit']"):
-			print("over limit with %s" % xid)
-			sys.exit() 
+			metrics.incr("owi.overlimit")
+			raise OverLimitException("over limit with %s" % xid)
 		else: 
 			try:
 				owi = ctxt.xpathEval("//@owi")[0].content
 				cleanowi = owi.replace('owi','')
+				metrics.incr("owi.found")
 				return WORK_ID + cleanowi
 			except:
+				metrics.incr("owi.not_found")
 				print("no owi found")
-				
+				return None
+
 	elif resp.status_code == 404:
+		metrics.incr("owi.not_found")
 		msg = "Not found: %s%s" % (xid, os.linesep)
 	elif resp.status_code == 500:
 		msg = "Server error (%s)" % xid
@@ -70,33 +209,186 @@ def query_oclc(xid):
 		msg += "%s%s" % (resp.status_code, os.linesep)
 	print(msg)
 	
-	sleep(1)
-	
 	
+def _record_id(rec):
+	f001 = rec.get_fields('001')
+	if f001: return f001[-1].value()
+	return None
+
+def _ocns(rec):
+	"""
+	@return: the OCLC numbers in the record's 035$a, in order
+	"""
+	ocns = []
+	for n in rec.get_fields('035'):
+		for s in n.get_subfields('a'):
+			if 'OCoLC' in s:
+				ocns.append(str(s.replace('(OCoLC)','')))
+	return ocns
+
+#===============================================================================
+# distinct_ocns
+#===============================================================================
+def distinct_ocns(inpath, shelf):
+	"""
+	@param inpath: the MARCXML input
+	@param shelf: the cache
+	@return: every OCLC number in the input that isn't cached yet, once
+	each, in the order the records come
+	"""
+	seen = set()
+	ocns = []
+	for rec in marcio.iter_marcxml(inpath):
+		for ocn in _ocns(rec):
+			if ocn not in seen:
+				seen.add(ocn)
+				if ocn not in shelf:
+					ocns.append(ocn)
+	return ocns
+
+#===============================================================================
+# look_up
+#===============================================================================
+def look_up(queue, shelf, quota):
+	"""
+	@param queue: a Queue
+	@param shelf: the cache
+	@param quota: today's Quota
+	@return: the number of OCLC numbers sent to xID
+
+	@note: Works through the queue until it, or today's quota, runs out.
+	Progress is saved as we go, so a crash loses at most a few lookups.
+	"""
+	done = 0
+	i = 0
+	try:
+		while i < len(queue.pending) and quota.remaining() > 0:
+			ocn = queue.pending[i]
+			if ocn in shelf: # (a crash may have left it queued)
+				i += 1
+				continue
+			check_shelf(ocn, shelf, quota)
+			i += 1
+			done += 1
+			if done % SAVE_EVERY == 0:
+				queue.pending = queue.pending[i:]
+				i = 0
+				shelf.flush() # what we found, before the queue forgets it
+				queue.save()
+				quota.save()
+	except OverLimitException, e:
+		print(str(e))
+		quota.exhaust()
+	finally:
+		queue.pending = queue.pending[i:]
+		shelf.flush()
+		queue.save()
+		quota.save()
+	return done
+
+#===============================================================================
+# write_ready
+#===============================================================================
+def write_ready(inpath, outpath, shelf, pending, resume=False):
+	"""
+	@param pending: OCLC numbers still to be looked up
+	@param resume: carry on from the output's checkpoint, if there is one
+	@return: a 2-tuple (records written this time, True if the output is 
+	finished)
+
+	@note: Writes records, with their 787s, up to the first one that still
+	has an OCLC number in the queue, then saves a checkpoint; the next day's
+	run carries on from there.
+	"""
+	ckpt = checkpoint.Checkpoint(outpath, inpath)
+	records = marcio.iter_marcxml(inpath)
+	if resume and ckpt.load() and ckpt.records:
+		print("Resuming after record %d (%s)" % (ckpt.records, ckpt.last_id))
+		fh = checkpoint.open_output(ckpt)
+		writer = marcio.MARCXMLWriter(fh, header=False)
+		records = checkpoint.skip(records, ckpt, _record_id)
+	else:
+		fh = open(outpath, 'wb')
+		writer = marcio.MARCXMLWriter(fh)
+	written = 0
+	finished = False
+	try:
+		for rec in records:
+			ocns = _ocns(rec)
+			if pending.intersection(ocns):
+				break
+			workid = ""
+			for ocn in ocns:
+				workid = _workid(shelf, ocn) or workid
+			if workid != None and workid != '':
+				field = pymarc.Field(
+					tag = '787', 
+					indicators = ['0',' '],
+					subfields = [
+						'o', str(workid)
+					])
+				rec.add_field(field)
+			with metrics.timer("serialize"):
+				writer.write(rec)
+			metrics.incr("records")
+			written += 1
+			ckpt.update(_record_id(rec), fh)
+		else:
+			writer.close()
+			ckpt.clear()
+			finished = True
+	finally:
+		if not finished:
+			# everything written so far is whole records; save our place
+			ckpt.save(fh)
+		fh.close()
+	return written, finished
+
 if __name__ == "__main__":
-	mrxheader = """<?xml version="1.0" encoding="UTF-8" ?>
-<collection xmlns="http://www.loc.gov/MARC21/slim" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.loc.gov/MARC21/slim http://www.loc.gov/standards/marcxml/schema/MARC21slim.xsd">"""
-	fh = open('out/owi_tmp.xml', 'w+')
-	fh.write(mrxheader)
-	reader = pymarc.marcxml.parse_xml_to_array(infile)
-	for rec in reader:
-		for n in rec.get_fields('035'):
-			for s in n.get_subfields('a'):
-				if 'OCoLC' in s:
-					num = s.replace('(OCoLC)','')
-					workid = check_shelf(str(num))
-		if workid != None and workid != '':
-			field = pymarc.Field(
-				tag = '787', 
-				indicators = ['0',' '],
-				subfields = [
-					'o', str(workid)
-				])
-			rec.add_field(field)
-		workid = ""
-		out = "%s" % (pymarc.record_to_xml(rec))
-		fh.write(out)
-	fh.write("</collection>")
-	fh.close()
-	# format output for readability
-	subprocess.Popen(['xmllint','--format','-o', outfile,'owi_tmp.xml'])
+	parser = ArgumentParser(description="Get OCLC Work Ids into 787$o. A file with more OCLC numbers than the day's xID quota is done over several days: run it again each day with --resume.")
+	parser.add_argument("-R", "--resume", action="store_true", dest="resume", help="Carry on with the queue and output left by an earlier run on the same input.")
+	parser.add_argument("-q", "--quota", type=int, default=QUOTA, dest="quota", help="xID queries allowed per day (default %d)." % QUOTA)
+	parser.add_argument("-c", "--conf_file", default=CONFIG, dest="conf_file", help="The config file ([HTTP], [RateLimits] and [Cache] sections; default %s)." % CONFIG)
+	parser.add_argument("infile", nargs="?", default=infile)
+	parser.add_argument("outfile", nargs="?", default=outfile)
+	parser.add_argument("--profile", action="store_true", dest="profile", help="Run under cProfile; the stats are dumped to " + LOGDIR + " and the slowest calls printed.")
+	args = parser.parse_args()
+
+	config = ConfigParser.SafeConfigParser()
+	if config.read([args.conf_file]):
+		# HTTP section of config file: connection pool size, timeout, keep-alive
+		client.configure_from(config)
+		# RateLimits section of config file: requests per second and burst, per host
+		ratelimit.configure_from(config)
+		cache.configure_from(config)
+
+	run = metrics.new_run(JOB_LOG)
+	started = time()
+	profiler = None
+	if args.profile:
+		profiler = metrics.start_profile()
+	status = "error"
+	shelf = cache.open_cache(CACHE_FILE, legacy=SHELF_FILE, source="xisbn.worldcat.org", vocabulary=cache.OWI)
+	try:
+		quota = Quota(limit=args.quota)
+		queue = Queue(args.outfile, args.infile)
+		if not (args.resume and queue.load()):
+			queue.pending = distinct_ocns(args.infile, shelf)
+			queue.save()
+		print("%d OCLC numbers to look up; %d left of today's quota" % (len(queue.pending), quota.remaining()))
+		looked_up = look_up(queue, shelf, quota)
+		written, finished = write_ready(args.infile, args.outfile, shelf, set(queue.pending), args.resume)
+		print("Looked up %d; wrote %d records; %d OCLC numbers still queued" % (looked_up, written, len(queue.pending)))
+		if finished:
+			queue.clear()
+			status = "ok"
+		else:
+			print("Quota used up for today; run again tomorrow with --resume")
+			status = "queued"
+	finally:
+		shelf.close()
+		client.close()
+		if profiler != None:
+			metrics.stop_profile(profiler, LOGDIR + "owi_" + run + ".prof", sys.stdout)
+		metrics.add_time("total", time() - started)
+		metrics.write(JOB_LOG, run, tool="owi", input=args.infile, status=status)
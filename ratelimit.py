@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Per-host rate limiting for the services we query. Each host gets a token
+bucket (a steady rate with some burst capacity) shared by every thread in the
+process. 429 and 503 responses, and their Retry-After headers, push the
+bucket into an adaptive (exponential) backoff that relaxes again on success.
+
+For a pool of worker processes, create shared_buckets() in the parent and
+install() them in each worker so that every process draws on the same budget.
+"""
+from email.utils import parsedate_tz, mktime_tz
+from time import sleep, time
+import multiprocessing
+import threading
+
+LIMITS = {
+	"id.loc.gov" : (1.0, 3),
+	"viaf.org" : (1.0, 3),
+	"xisbn.worldcat.org" : (1.0, 1)
+}
+"""(requests per second, burst) for each service"""
+
+DEFAULT_LIMIT = (1.0, 1)
+"""(requests per second, burst) for any host not in LIMITS"""
+
+MAX_BACKOFF = 300.0
+"""Longest we'll back off for, in seconds, when we don't get a Retry-After"""
+
+BACKOFF_STATUSES = (429, 503)
+"""HTTP statuses that mean 'slow down'"""
+
+_buckets = {}
+_lock = threading.Lock()
+
+#===============================================================================
+# TokenBucket
+#===============================================================================
+class TokenBucket(object):
+	"""
+	A thread-safe token bucket. acquire() blocks until a token is available
+	(and any backoff has passed).
+	"""
+	def __init__(self, rate, burst=1):
+		self.rate = float(rate)
+		"""Tokens added per second"""
+		self.burst = max(1, int(burst))
+		"""Max tokens held, i.e. how many requests can go out back-to-back"""
+		self.tokens = float(self.burst)
+		self.updated = time()
+		self.delay = 0.0
+		"""Current backoff, in seconds; 0 when the service is happy"""
+		self.blocked_until = 0.0
+		self._lock = threading.Lock()
+
+	def _refill(self, now):
+		if self.rate > 0:
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		else:
+			self.tokens = float(self.burst)
+		self.updated = now
+
+	def acquire(self):
+		"""
+		@return: the number of seconds we waited
+		"""
+		waited = 0.0
+		while True:
+			with self._lock:
+				now = time()
+				self._refill(now)
+				if now < self.blocked_until:
+					wait = self.blocked_until - now
+				elif self.tokens >= 1:
+					self.tokens -= 1
+					return waited
+				else:
+					wait = (1 - self.tokens) / self.rate
+			sleep(wait)
+			waited += wait
+
+	def backoff(self, retry_after=None):
+		"""
+		@param retry_after: seconds the service asked us to wait, if it said
+
+		@note: Without a Retry-After the delay doubles each time we're told to
+		slow down, from one token interval up to MAX_BACKOFF.
+		"""
+		with self._lock:
+			if retry_after is not None:
+				self.delay = max(0.0, retry_after)
+			else:
+				floor = 1.0 / self.rate if self.rate > 0 else 1.0
+				self.delay = min(MAX_BACKOFF, max(floor, self.delay * 2))
+			self.blocked_until = max(self.blocked_until, time() + self.delay)
+			self.tokens = 0.0
+
+	def relax(self):
+		"""
+		@note: Call on a successful response to reset the backoff.
+		"""
+		with self._lock:
+			self.delay = 0.0
+
+#===============================================================================
+# SharedTokenBucket
+#===============================================================================
+class SharedTokenBucket(TokenBucket):
+	"""
+	A TokenBucket whose state lives in shared memory, guarded by a process
+	lock, so that it can be handed to worker processes when they're created.
+	"""
+	def __init__(self, rate, burst=1):
+		self._state = multiprocessing.Array('d', 4, lock=False)
+		TokenBucket.__init__(self, rate, burst)
+		self._lock = multiprocessing.Lock()
+
+	def _get(i):
+		return property(lambda self: self._state[i], lambda self, v: self._state.__setitem__(i, v))
+
+	tokens = _get(0)
+	updated = _get(1)
+	delay = _get(2)
+	blocked_until = _get(3)
+	del _get
+
+#===============================================================================
+# shared_buckets / install
+#===============================================================================
+def shared_buckets():
+	"""
+	@return: a dict of host -> SharedTokenBucket for every host in LIMITS.
+	Pass it to worker processes (e.g. as a Pool initializer argument).
+	"""
+	return dict((host, SharedTokenBucket(rate, burst)) for host, (rate, burst) in LIMITS.items())
+
+def install(buckets):
+	"""
+	@param buckets: a dict from shared_buckets(), to be used by this process
+	"""
+	with _lock:
+		_buckets.update(buckets)
+
+#===============================================================================
+# configure
+#===============================================================================
+def configure(host, rate, burst=1):
+	"""
+	@param host: e.g. 'id.loc.gov'
+	@param rate: requests per second
+	@param burst: requests that can go out back-to-back
+	"""
+	with _lock:
+		LIMITS[host] = (float(rate), int(burst))
+		_buckets.pop(host, None)
+
+#===============================================================================
+# configure_from
+#===============================================================================
+def configure_from(config, section='RateLimits'):
+	"""
+	@param config: a ConfigParser that has already read the config file
+	@param section: the section with one 'host : rate, burst' line per service
+	"""
+	if not config.has_section(section):
+		return
+	for host, value in config.items(section):
+		parts = [p.strip() for p in value.split(",")]
+		if len(parts) > 1: configure(host, parts[0], parts[1])
+		else: configure(host, parts[0])
+
+#===============================================================================
+# bucket_for
+#===============================================================================
+def bucket_for(host):
+	"""
+	@param host: the host name we're about to send a request to
+	@return: the (shared) TokenBucket for that host
+	"""
+	with _lock:
+		bucket = _buckets.get(host)
+		if bucket is None:
+			rate, burst = LIMITS.get(host, DEFAULT_LIMIT)
+			bucket = TokenBucket(rate, burst)
+			_buckets[host] = bucket
+	return bucket
+
+#===============================================================================
+# retry_after
+#===============================================================================
+def retry_after(resp):
+	"""
+	@param resp: a requests.Response
+	@return: the Retry-After header in seconds, or None if there isn't one
+	(or we can't read it). Handles both delta-seconds and HTTP-date forms.
+	"""
+	value = resp.headers.get("retry-after")
+	if not value:
+		return None
+	try:
+		return float(value)
+	except ValueError:
+		parsed = parsedate_tz(value)
+		if parsed is None:
+			return None
+		return max(0.0, mktime_tz(parsed) - time())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+State index for incremental runs of mrc.py: the 005 (date and time of latest
+transaction) each bib record had when it was last enriched, keyed by its 001.
+A record whose 005 hasn't changed since then can be passed over.
+
+Updates are staged and only committed when the caller says the records they
+belong to are safely written (end of run, or a checkpoint), so a run that
+dies part way never marks a record done that didn't make it to the output.
+"""
+from time import time
+import os
+import sqlite3
+
+STATE_FILE = "./db/mrc.state.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+	id TEXT PRIMARY KEY,
+	stamp TEXT NOT NULL,
+	enriched_at REAL NOT NULL
+);
+"""
+
+#===============================================================================
+# _stamp
+#===============================================================================
+def _stamp(rec):
+	"""
+	@param rec: a pymarc.Record
+	@return: a 2-tuple (001, 005); either is None if the record doesn't have it
+	"""
+	ids = rec.get_fields('001')
+	stamps = rec.get_fields('005')
+	rec_id = ids[-1].value().encode("utf-8") if ids else None
+	stamp = stamps[-1].value().encode("utf-8") if stamps else None
+	return rec_id, stamp
+
+#===============================================================================
+# RecordState
+#===============================================================================
+class RecordState(object):
+	def __init__(self, path=STATE_FILE):
+		"""
+		@param path: the SQLite file; created if it doesn't exist
+		"""
+		self.path = path
+		self._pending = {}
+		"""001 -> 005 of the records enriched since the last commit"""
+		statedir = os.path.dirname(path)
+		if statedir and not os.path.isdir(statedir):
+			os.makedirs(statedir)
+		self.conn = sqlite3.connect(path)
+		self.conn.text_factory = str
+		self.conn.executescript(SCHEMA)
+		self.conn.commit()
+
+	def unchanged(self, rec):
+		"""
+		@param rec: a pymarc.Record
+		@return: True if the record was enriched before with the same 005
+
+		@note: Records without a 001 or a 005 always count as changed. Staged
+		updates aren't looked at, so both passes over a file agree.
+		"""
+		rec_id, stamp = _stamp(rec)
+		if rec_id is None or stamp is None:
+			return False
+		row = self.conn.execute("SELECT stamp FROM records WHERE id = ?", (rec_id,)).fetchone()
+		return row is not None and row[0] == stamp
+
+	def update(self, rec):
+		"""
+		@param rec: a pymarc.Record that has been enriched and written
+		"""
+		rec_id, stamp = _stamp(rec)
+		if rec_id is not None and stamp is not None:
+			self._pending[rec_id] = stamp
+
+	def commit(self):
+		"""
+		@note: Call once the records passed to update() are safely written.
+		"""
+		if not self._pending:
+			return
+		now = time()
+		with self.conn:
+			self.conn.executemany("INSERT OR REPLACE INTO records (id, stamp, enriched_at) VALUES (?, ?, ?)",
+				((k, v, now) for k, v in self._pending.iteritems()))
+		self._pending.clear()
+
+	def close(self):
+		"""
+		@note: Anything not committed is dropped; those records will be done
+		again next time.
+		"""
+		self._pending.clear()
+		self.conn.close()
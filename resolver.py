@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Concurrent heading resolution. Takes the distinct headings that missed the
+cache and looks them up in a bounded pool of worker threads. Politeness is
+left to the per-host token buckets in ratelimit.py, which all the workers share.
+"""
+from multiprocessing.pool import ThreadPool
+import threading
+
+WORKERS = 4
+"""Default number of worker threads"""
+
+#===============================================================================
+# resolve
+#===============================================================================
+def resolve(headings, fetch, workers=WORKERS):
+	"""
+	@param headings: an iterable of (normalized) headings to look up
+	@param fetch: a function that takes a heading and returns a result. It is
+	called from worker threads, so it must not touch the cache.
+	@param workers: the number of worker threads
+	@return: a generator of (heading, result, error) 3-tuples, in the order
+	the lookups finish. error is None unless fetch raised, in which case
+	result is None and error is the exception.
+
+	@note: Results come back to the calling thread, which is where they
+	should be written to the cache.
+	"""
+	def work(heading):
+		try:
+			return heading, fetch(heading), None
+		except Exception, e:
+			return heading, None, e
+
+	pool = ThreadPool(max(1, workers))
+	try:
+		for result in pool.imap_unordered(work, headings):
+			yield result
+	finally:
+		pool.terminate()
+		pool.join()
+
+#===============================================================================
+# SingleFlight
+#===============================================================================
+class SingleFlight(object):
+	"""
+	Shares lookups between batches resolved at the same time in one process
+	(e.g. service.py's concurrent requests): a heading another batch is 
+	already looking up is waited for, not looked up again.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._inflight = {}
+		"""heading -> threading.Event, set when its lookup is done"""
+
+	def claim(self, headings):
+		"""
+		@param headings: the headings a batch needs looked up
+		@return: a 2-tuple (mine, theirs): the headings this batch should 
+		look up (and release() after), and the Events of those some other
+		batch is already looking up
+		"""
+		mine = []
+		theirs = []
+		with self._lock:
+			for heading in headings:
+				event = self._inflight.get(heading)
+				if event is None:
+					self._inflight[heading] = threading.Event()
+					mine.append(heading)
+				else:
+					theirs.append(event)
+		return mine, theirs
+
+	def release(self, headings):
+		"""
+		@param headings: ones claimed, now looked up (and cached) or given up on
+		"""
+		with self._lock:
+			for heading in headings:
+				event = self._inflight.pop(heading, None)
+				if event is not None:
+					event.set()
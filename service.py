@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+mrc.py and ead.py as a long-running local service. One process opens the
+cache, the local index, the HTTP connection pools and the rate limits once
+and keeps them warm, and any number of clients send it work over HTTP, so a
+pipeline that enriches one file at a time no longer pays for interpreter
+startup, config parsing, opening the cache and TCP warm-up on every file.
+
+	POST /headings  a JSON list of headings, or {"headings": [...],
+	                "vocabulary": "lc" | "viaf-personal" | "viaf-corporate"}
+	                -> a JSON list, in the same order, of {heading,
+	                normalized, vocabulary, status, uri, label, alternatives}
+	                where status is found, not_found, deprecated, multiple or
+	                error
+	POST /marc      MARCXML, binary MARC or MARC-in-JSON (?names=1,
+	                ?subjects=1, ?format=mrx|mrc|json) -> the records with
+	                $0s, in the same format unless asked otherwise
+	POST /ead       an EAD document (?names=1, ?subjects=1, ?recursive=1)
+	                -> the document with @authfilenumbers
+	GET  /status    -> uptime, front cache stats and metrics so far
+
+Names and subjects both are looked up unless one of them is asked for. The
+services are reached through http_proxy like everything else, so the whole
+thing can be run against bench/stub.py.
+
+Usage: python service.py [-c CONFIG] [-p PORT] [-w WORKERS] [-i INDEX]
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from lxml import etree
+from SocketServer import ThreadingMixIn
+from time import time
+from urlparse import urlparse, parse_qs
+import ConfigParser
+import bulk
+import cache
+import client
+import ead
+import io
+import json
+import lcindex
+import libxml2
+import marcio
+import metrics
+import mrc
+import os
+import ratelimit
+import resolver
+import signal
+import sys
+import tempfile
+import threading
+
+CONFIG = "./cfg/mrc.cfg"
+JOB_LOG = "./log/jobs.log"
+HOST = "127.0.0.1"
+PORT = 8098
+MAX_CLIENTS = 8
+"""Requests worked on at once; the rest wait their turn"""
+MAX_BODY = 64 * 1024 * 1024
+"""Largest payload accepted, in bytes"""
+
+CONTENT_TYPES = {
+	marcio.MRX: "application/marcxml+xml",
+	marcio.MRC: "application/marc",
+	marcio.JSON: "application/json"
+}
+
+_flight = resolver.SingleFlight()
+"""Lookups in progress, shared by all requests"""
+
+#===============================================================================
+# BadRequestException
+#===============================================================================
+class BadRequestException(Exception):
+	def __init__(self, msg, status=400):
+		self.msg = msg
+		self.status = status
+
+	def __str__(self):
+		return self.msg
+
+#===============================================================================
+# enrich_marc
+#===============================================================================
+def enrich_marc(payload, shelf, names=True, subjects=True, outformat=None, workers=resolver.WORKERS, index=None):
+	"""
+	@param payload: MARCXML, binary MARC or MARC-in-JSON
+	@param outformat: MRX, MRC or JSON; the payload's if None
+	@return: a 2-tuple (format, the enriched records)
+
+	@raise BadRequestException: when the payload isn't MARC we can read
+	"""
+	import pymarc
+	# the readers stream from a file; a request fits in memory, so read it
+	# all and make the two passes (prefetch, then update) over a list
+	with tempfile.NamedTemporaryFile() as tmp:
+		tmp.write(payload)
+		tmp.flush()
+		informat = marcio.detect_format(tmp.name)
+		if informat == None:
+			raise BadRequestException("Not MaRCXML, binary MaRC or MaRC-in-JSON")
+		try:
+			records = list(marcio.iter_records(tmp.name, informat))
+		except (etree.XMLSyntaxError, ValueError, pymarc.exceptions.PymarcException), e:
+			raise BadRequestException("Not MaRC we can read: " + (str(e) or e.__class__.__name__))
+	with metrics.timer("prefetch"):
+		keys = set()
+		for rec in records:
+			for scheme, field, h in mrc._heading_fields(rec, names, subjects):
+				keys.add((mrc._normalize_heading(h), cache.LC))
+		misses = [k for k in keys if k not in shelf]
+		metrics.incr("prefetch.distinct", len(keys))
+		metrics.incr("prefetch.miss", len(misses))
+		metrics.incr("cache.hit", len(keys) - len(misses))
+		metrics.incr("cache.miss", len(misses))
+		bulk.look_up(misses, lambda key: mrc._fetch_heading(key[0], index), shelf, workers, _flight)
+	outformat = outformat or informat
+	out = io.BytesIO()
+	writer = marcio.open_writer(out, outformat)
+	for rec in records:
+		bbid = mrc._record_id(rec)
+		for scheme, field, h in mrc._heading_fields(rec, names, subjects):
+			mrc._update_headings(bbid, scheme, h, field, shelf, field.tag, index=index)
+		with metrics.timer("serialize"):
+			writer.write(rec)
+		metrics.incr("records")
+	writer.close()
+	return outformat, out.getvalue()
+
+#===============================================================================
+# enrich_ead
+#===============================================================================
+def _prefetch_ead(groups, shelf, workers=resolver.WORKERS, verbose=False, ignore_cache=False, index=None):
+	"""
+	@note: ead._prefetch, but sharing lookups with the other requests.
+	"""
+	misses = [k for k in groups if k not in shelf]
+	metrics.incr("prefetch.distinct", len(groups))
+	metrics.incr("prefetch.miss", len(misses))
+	metrics.incr("cache.hit", len(groups) - len(misses))
+	metrics.incr("cache.miss", len(misses))
+	bulk.look_up(misses, lambda key: ead._fetch_heading(key[0], groups[key][0], index), shelf, workers, _flight)
+	return len(groups), sum(len(nodes) for heading_type, nodes in groups.itervalues()), len(misses)
+
+def enrich_ead(payload, shelf, names=True, subjects=True, recursive=False, workers=resolver.WORKERS, index=None):
+	"""
+	@param payload: an EAD document
+	@return: the enriched document
+
+	@raise BadRequestException: when the payload can't be parsed
+	"""
+	try:
+		doc = libxml2.parseMemory(payload, len(payload))
+	except libxml2.parserError, e:
+		raise BadRequestException("Not XML we can read: " + str(e))
+	try:
+		ead.enrich_doc(doc, shelf, ead._xpath(names, subjects, recursive), index=index, workers=workers, prefetch=_prefetch_ead)
+		with metrics.timer("serialize"):
+			return doc.serialize("UTF-8", 1)
+	finally:
+		doc.freeDoc()
+
+#===============================================================================
+# Handler
+#===============================================================================
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	"""Keep-alive, so a client can send file after file down one connection"""
+
+	def _send(self, status, body, content_type="application/json"):
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _json(self, status, obj):
+		self._send(status, json.dumps(obj, sort_keys=True) + "\n")
+
+	def _flag(self, params, name):
+		return (params.get(name) or ["0"])[0].lower() in ("1", "true", "yes", "on")
+
+	def do_GET(self):
+		if urlparse(self.path).path != "/status":
+			return self._json(404, {"error": "Not found: " + self.path})
+		server = self.server
+		self._json(200, {
+			"run": server.run,
+			"uptime": round(time() - server.started, 3),
+			"cache": server.shelf.stats() if hasattr(server.shelf, "stats") else None,
+			"metrics": metrics.summary()
+		})
+
+	def do_POST(self):
+		url = urlparse(self.path)
+		params = parse_qs(url.query)
+		server = self.server
+		length = int(self.headers.get("Content-Length") or 0)
+		if length > MAX_BODY:
+			# don't read it; the connection can't be reused
+			self.close_connection = 1
+			return self._json(413, {"error": "Payload over %d bytes" % MAX_BODY})
+		payload = self.rfile.read(length)
+		names = self._flag(params, "names")
+		subjects = self._flag(params, "subjects")
+		if not names and not subjects:
+			names = subjects = True
+		metrics.incr("service.requests")
+		with server.slots:
+			try:
+				with metrics.timer("service" + url.path.replace("/", ".")):
+					if url.path == "/headings":
+						try:
+							body = json.loads(payload or "null")
+						except ValueError, e:
+							raise BadRequestException("Not JSON: " + str(e))
+						vocabulary = cache.LC
+						if isinstance(body, dict):
+							vocabulary = body.get("vocabulary", cache.LC)
+							body = body.get("headings")
+						if not isinstance(body, list) or not all(isinstance(h, basestring) for h in body):
+							raise BadRequestException("Expected a list of headings")
+						if vocabulary not in bulk.SOURCES:
+							raise BadRequestException("Unknown vocabulary: %s" % vocabulary)
+						results = bulk.resolve_many(body, vocabulary, server.shelf, server.workers, server.index, flight=_flight)
+						return self._json(200, [r.as_dict() for r in results])
+					if url.path == "/marc":
+						outformat = (params.get("format") or [None])[0]
+						if outformat is not None and outformat not in marcio.FORMATS:
+							raise BadRequestException("Unknown format: " + outformat)
+						outformat, body = enrich_marc(payload, server.shelf, names, subjects, outformat, server.workers, server.index)
+						return self._send(200, body, CONTENT_TYPES[outformat])
+					if url.path == "/ead":
+						body = enrich_ead(payload, server.shelf, names, subjects, self._flag(params, "recursive"), server.workers, server.index)
+						return self._send(200, body, "application/xml")
+					raise BadRequestException("Not found: " + url.path, 404)
+			except BadRequestException, e:
+				metrics.incr("service.status.%d" % e.status)
+				self._json(e.status, {"error": e.msg})
+			except Exception, e:
+				metrics.incr("service.status.500")
+				self._json(500, {"error": str(e).strip() or e.__class__.__name__})
+			finally:
+				# other jobs (and a restart) should see what we looked up
+				server.shelf.flush()
+
+#===============================================================================
+# Service
+#===============================================================================
+class Service(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, shelf, host=HOST, port=PORT, workers=resolver.WORKERS, index=None, max_clients=MAX_CLIENTS, run=None):
+		"""
+		@param shelf: the cache, kept open for the life of the service
+		@param port: 0 to pick a free one (see self.port)
+		@param workers: worker threads for each request's lookups
+		@param index: an lcindex.LocalIndex to try before id.loc.gov
+		@param max_clients: requests worked on at once
+		@param run: the batch number, for /status
+		"""
+		HTTPServer.__init__(self, (host, port), Handler)
+		if not isinstance(shelf, cache.FrontCache):
+			# request threads share the cache; the FrontCache's lock makes
+			# that safe, even with nothing kept in memory (front_size 0)
+			shelf = cache.FrontCache(shelf, 0, 1)
+		self.shelf = shelf
+		self.workers = workers
+		self.index = index
+		self.slots = threading.BoundedSemaphore(max(1, max_clients))
+		self.run = run
+		self.started = time()
+
+	@property
+	def port(self):
+		return self.server_address[1]
+
+#===============================================================================
+# main
+#===============================================================================
+def _stop(signum, frame):
+	raise KeyboardInterrupt
+
+def main(argv=None):
+	parser = ArgumentParser(description=__doc__.strip().split("\n\n")[0], formatter_class=RawDescriptionHelpFormatter)
+	parser.add_argument("-c", "--conf_file", default=CONFIG, dest="conf_file", help="The config file ([HTTP], [RateLimits], [Cache], [Resolver] and [Service] sections).")
+	parser.add_argument("-H", "--host", dest="host", help="Address to listen on (default %s)." % HOST)
+	parser.add_argument("-p", "--port", type=int, dest="port", help="Port to listen on (default %d)." % PORT)
+	parser.add_argument("-w", "--workers", type=int, dest="workers", help="Worker threads for each request's lookups.")
+	parser.add_argument("-i", "--index", dest="lcindex", help="Local index of id.loc.gov labels (see lcindex.py; default %s)." % lcindex.INDEX_FILE)
+	args = parser.parse_args(argv)
+
+	host, port, workers, max_clients, index_file = HOST, PORT, resolver.WORKERS, MAX_CLIENTS, lcindex.INDEX_FILE
+	config = ConfigParser.SafeConfigParser()
+	if config.read([args.conf_file]):
+		client.configure_from(config)
+		ratelimit.configure_from(config)
+		cache.configure_from(config)
+		if config.has_option('Resolver', 'workers'):
+			workers = max(1, config.getint('Resolver', 'workers'))
+		if config.has_option('Paths', 'lcindex'):
+			index_file = config.get('Paths', 'lcindex')
+		if config.has_section('Service'):
+			if config.has_option('Service', 'host'): host = config.get('Service', 'host')
+			if config.has_option('Service', 'port'): port = config.getint('Service', 'port')
+			if config.has_option('Service', 'max_clients'): max_clients = config.getint('Service', 'max_clients')
+	host = args.host or host
+	port = args.port if args.port is not None else port
+	workers = args.workers or workers
+	index_file = args.lcindex or index_file
+
+	run = metrics.new_run(JOB_LOG)
+	shelf = cache.open_cache(mrc.CACHE_FILE, source=mrc.ID_SUBJECT_RESOLVER, vocabulary=cache.LC)
+	index = None
+	if index_file and os.path.isfile(index_file):
+		index = lcindex.LocalIndex(index_file)
+	server = None
+	status = 0
+	try:
+		server = Service(shelf, host, port, workers, index, max_clients, run)
+		signal.signal(signal.SIGTERM, _stop)
+		sys.stderr.write("Listening on http://%s:%d/ (batch %s)\n" % (host, server.port, run))
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	except Exception, e:
+		sys.stderr.write(str(e) + "\n")
+		status = 1
+	finally:
+		if server != None:
+			server.server_close()
+			server.shelf.close()
+		else:
+			shelf.close()
+		if index != None:
+			index.close()
+		client.close()
+		metrics.write(JOB_LOG, run, tool="service", status=status)
+	return status
+
+if __name__ == "__main__": sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+FrontCache's hit and miss counts.
+
+Run from the top of the repo:
+	python -m unittest discover tests
+"""
+from time import time
+import unittest
+import cache
+
+def _heading(value, fetched_at=None):
+	record = cache.Heading()
+	record.value = value
+	record.found = True
+	record.alternatives = [("http://id.loc.gov/authorities/subjects/sh0", value)]
+	record.fetched_at = fetched_at or time()
+	return record
+
+#===============================================================================
+# FrontCacheCountTest
+#===============================================================================
+class FrontCacheCountTest(unittest.TestCase):
+	def setUp(self):
+		self.store = {}
+		self.front = cache.FrontCache(self.store, size=10, write_behind=100)
+
+	def test_hot_heading_is_one_hit(self):
+		self.front["Cats"] = _heading("Cats")
+		self.assertTrue("Cats" in self.front)
+		self.assertEqual(self.front["Cats"].value, "Cats")
+		self.assertEqual(self.front.hits, 1)
+		self.assertEqual(self.front.misses, 0)
+
+	def test_heading_read_from_store_is_one_miss(self):
+		self.store["Dogs"] = _heading("Dogs")
+		self.assertTrue("Dogs" in self.front)
+		self.front["Dogs"]
+		self.assertEqual((self.front.hits, self.front.misses), (0, 1))
+		# and from memory after that
+		self.assertTrue("Dogs" in self.front)
+		self.front["Dogs"]
+		self.assertEqual((self.front.hits, self.front.misses), (1, 1))
+
+	def test_missing_heading_is_one_miss(self):
+		self.assertFalse("Birds" in self.front)
+		self.assertEqual((self.front.hits, self.front.misses), (0, 1))
+
+	def test_expired_heading_is_not_a_hit(self):
+		self.front["Fish"] = _heading("Fish", fetched_at=time() - cache.TTL_FOUND - 60)
+		self.assertFalse("Fish" in self.front)
+		self.assertEqual((self.front.hits, self.front.misses), (0, 1))
+
+	def test_get(self):
+		self.front["Cats"] = _heading("Cats")
+		self.front.get("Cats")
+		self.assertEqual(self.front.get("Birds"), None)
+		self.assertEqual((self.front.hits, self.front.misses), (1, 1))
+
+if __name__ == "__main__":
+	unittest.main()